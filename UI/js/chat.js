@@ -8,6 +8,10 @@ let userId = '';
 let username = '';
 let isTyping = false;
 let typingTimeout;
+let lastTypingEmit = 0;
+let olderMessagesCursor = null;
+let loadingOlderMessages = false;
+const MESSAGE_PAGE_SIZE = 50;
 
 // Chat message handling
 function sendMessage() {
@@ -34,51 +38,21 @@ function sendMessage() {
                 sendButton.innerHTML = '<i class="fas fa-spinner fa-spin"></i>';
                 sendButton.disabled = true;
                 
-                const reader = new FileReader();
-                reader.onload = function(e) {
-                    const base64Data = e.target.result;
-                    
-                    // Send message with media
-                    window.socket.emit('message', {
-                        room: currentRoom,
-                        user_id: userId,
-                        message: message || '',
-                        media: {
-                            type: file.type,
-                            data: base64Data,
-                            name: file.name
-                        }
-                    }, function(ack) {
-                        // Callback when server acknowledges receipt
-                        console.log("Media message acknowledged:", ack);
-                        
-                        // Reset button
-                        sendButton.innerHTML = originalText;
-                        sendButton.disabled = false;
-                    });
-                    
-                    // Reset media input and button
-                    mediaInput.value = '';
-                    document.getElementById('mediaBtn').innerHTML = '<i class="fas fa-image"></i>';
-                    document.getElementById('mediaBtn').style.color = 'var(--text-secondary)';
-                    
-                    console.log("Media message sent:", {
-                        type: file.type,
-                        size: base64Data.length,
-                        name: file.name
-                    });
-                };
-                
-                reader.onerror = function(e) {
-                    console.error("FileReader error:", e);
-                    alert("Error reading file: " + e);
-                    
+                uploadMedia(file, message || '').then(ack => {
+                    console.log("Media message acknowledged:", ack);
+                }).catch(err => {
+                    console.error("Media upload failed:", err);
+                    alert("Error uploading file: " + err.message);
+                }).finally(() => {
                     // Reset button
                     sendButton.innerHTML = originalText;
                     sendButton.disabled = false;
-                };
+                });
                 
-                reader.readAsDataURL(file);
+                // Reset media input and button
+                mediaInput.value = '';
+                document.getElementById('mediaBtn').innerHTML = '<i class="fas fa-image"></i>';
+                document.getElementById('mediaBtn').style.color = 'var(--text-secondary)';
             } else {
                 // Send text-only message
                 window.socket.emit('message', {
@@ -93,50 +67,130 @@ function sendMessage() {
     }
 }
 
-// Load existing messages when joining a room
+// Emit an event and resolve with the server's ack, or null if none arrives in time
+function emitWithAck(event, payload, timeoutMs = 15000) {
+    return new Promise(resolve => {
+        const timer = setTimeout(() => resolve(null), timeoutMs);
+        window.socket.emit(event, payload, ack => {
+            clearTimeout(timer);
+            resolve(ack);
+        });
+    });
+}
+
+function waitForConnection() {
+    if (window.socket.connected) {
+        return Promise.resolve();
+    }
+    return new Promise(resolve => window.socket.once('connect', resolve));
+}
+
+// Upload a file as binary media_chunk events, one chunk in flight at a time.
+// If the connection drops, the upload resumes from the offset the server
+// reports once the socket is back.
+async function uploadMedia(file, message) {
+    const begin = await emitWithAck('media_begin', {
+        room: currentRoom,
+        user_id: userId,
+        type: file.type,
+        name: file.name,
+        size: file.size
+    });
+    if (!begin || begin.status !== 'success') {
+        throw new Error(begin ? begin.message : 'No response from server');
+    }
+    
+    const uploadId = begin.upload_id;
+    let offset = begin.offset;
+    let ack = null;
+    while (true) {
+        if (offset < file.size) {
+            const chunk = await file.slice(offset, offset + begin.chunk_size).arrayBuffer();
+            ack = await emitWithAck('media_chunk', {
+                upload_id: uploadId,
+                user_id: userId,
+                offset: offset,
+                data: chunk
+            });
+        } else {
+            ack = await emitWithAck('media_end', {
+                upload_id: uploadId,
+                user_id: userId,
+                message: message
+            });
+            if (ack && ack.status === 'success') {
+                return ack;
+            }
+        }
+        
+        if (!ack) {
+            // Lost the connection (or the ack): ask where to continue
+            await waitForConnection();
+            ack = await emitWithAck('media_begin', { room: currentRoom, user_id: userId, upload_id: uploadId });
+        }
+        if (!ack || ack.status !== 'success') {
+            throw new Error(ack ? ack.message : 'No response from server');
+        }
+        offset = ack.offset;
+    }
+}
+
+// Build the DOM nodes for a message loaded from history
+function createHistoryMessage(msg) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${msg.is_sent ? 'sent' : ''}`;
+    messageDiv.setAttribute('data-message-id', msg.id || msg.timestamp);
+    
+    const messageWrapper = document.createElement('div');
+    messageWrapper.className = 'message-wrapper';
+    
+    const content = document.createElement('div');
+    content.className = 'message-content';
+    content.textContent = msg.message;
+    content.dataset.date = msg.date;
+    
+    const timeDiv = document.createElement('div');
+    timeDiv.className = 'message-time';
+    timeDiv.textContent = msg.time;
+    
+    const reactions = document.createElement('div');
+    reactions.className = 'reactions';
+    
+    messageWrapper.appendChild(content);
+    messageWrapper.appendChild(timeDiv);
+    messageDiv.appendChild(messageWrapper);
+    messageDiv.appendChild(reactions);
+    return messageDiv;
+}
+
+// Render a page of history messages (in chronological order) into a fragment
+function renderHistoryPage(messages) {
+    const fragment = document.createDocumentFragment();
+    let currentDate = null;
+    messages.forEach(msg => {
+        // Add date separator if needed
+        if (currentDate !== msg.date) {
+            currentDate = msg.date;
+            const dateDiv = document.createElement('div');
+            dateDiv.className = 'message-date';
+            dateDiv.textContent = msg.date;
+            fragment.appendChild(dateDiv);
+        }
+        fragment.appendChild(createHistoryMessage(msg));
+    });
+    return fragment;
+}
+
+// Load the most recent page of messages when joining a room
 function loadRoomMessages(room) {
-    fetch(`/chat/${room}/messages?user_id=${userId}`)
+    olderMessagesCursor = null;
+    fetch(`/chat/${room}/messages?user_id=${userId}&limit=${MESSAGE_PAGE_SIZE}`)
         .then(response => response.json())
-        .then(messages => {
+        .then(page => {
             const messageContainer = document.getElementById('messageContainer');
             messageContainer.innerHTML = '';
-            
-            let currentDate = null;
-            messages.forEach(msg => {
-                // Add date separator if needed
-                if (currentDate !== msg.date) {
-                    currentDate = msg.date;
-                    const dateDiv = document.createElement('div');
-                    dateDiv.className = 'message-date';
-                    dateDiv.textContent = msg.date;
-                    messageContainer.appendChild(dateDiv);
-                }
-                
-                const messageDiv = document.createElement('div');
-                messageDiv.className = `message ${msg.is_sent ? 'sent' : ''}`;
-                messageDiv.setAttribute('data-message-id', msg.id || msg.timestamp);
-                
-                const messageWrapper = document.createElement('div');
-                messageWrapper.className = 'message-wrapper';
-                
-                const content = document.createElement('div');
-                content.className = 'message-content';
-                content.textContent = msg.message;
-                content.dataset.date = msg.date;
-                
-                const timeDiv = document.createElement('div');
-                timeDiv.className = 'message-time';
-                timeDiv.textContent = msg.time;
-                
-                const reactions = document.createElement('div');
-                reactions.className = 'reactions';
-                
-                messageWrapper.appendChild(content);
-                messageWrapper.appendChild(timeDiv);
-                messageDiv.appendChild(messageWrapper);
-                messageDiv.appendChild(reactions);
-                messageContainer.appendChild(messageDiv);
-            });
+            olderMessagesCursor = page.next_cursor;
+            messageContainer.appendChild(renderHistoryPage(page.messages));
             messageContainer.scrollTop = messageContainer.scrollHeight;
         })
         .catch(error => {
@@ -144,9 +198,46 @@ function loadRoomMessages(room) {
         });
 }
 
+// Load the page before the oldest message shown, keeping the scroll position
+function loadOlderMessages() {
+    if (!olderMessagesCursor || loadingOlderMessages) {
+        return;
+    }
+    loadingOlderMessages = true;
+    const room = currentRoom;
+    fetch(`/chat/${room}/messages?user_id=${userId}&limit=${MESSAGE_PAGE_SIZE}&before=${encodeURIComponent(olderMessagesCursor)}`)
+        .then(response => response.json())
+        .then(page => {
+            if (room !== currentRoom) {
+                return;
+            }
+            const messageContainer = document.getElementById('messageContainer');
+            const previousHeight = messageContainer.scrollHeight;
+            olderMessagesCursor = page.next_cursor;
+            messageContainer.insertBefore(renderHistoryPage(page.messages), messageContainer.firstChild);
+            messageContainer.scrollTop += messageContainer.scrollHeight - previousHeight;
+        })
+        .catch(error => {
+            console.error('Error loading older messages:', error);
+        })
+        .finally(() => {
+            loadingOlderMessages = false;
+        });
+}
+
 // Event listeners for chat input
 document.addEventListener('DOMContentLoaded', function() {
     const messageInput = document.getElementById('messageInput');
+    const messageContainer = document.getElementById('messageContainer');
+    
+    if (messageContainer) {
+        // Fetch older history when the user scrolls to the top
+        messageContainer.addEventListener('scroll', () => {
+            if (messageContainer.scrollTop === 0) {
+                loadOlderMessages();
+            }
+        });
+    }
     
     if (messageInput) {
         messageInput.addEventListener('keypress', (e) => {
@@ -156,8 +247,11 @@ document.addEventListener('DOMContentLoaded', function() {
         });
 
         messageInput.addEventListener('input', () => {
-            if (!isTyping) {
+            // Typing state expires on the server, so refresh it while the user keeps typing
+            const now = Date.now();
+            if (!isTyping || now - lastTypingEmit > 2000) {
                 isTyping = true;
+                lastTypingEmit = now;
                 window.socket.emit('typing', {
                     room: currentRoom,
                     user_id: userId,
@@ -191,12 +285,23 @@ window.socket.on('disconnect', () => {
     countElement.innerHTML = `<i class="fas fa-circle"></i><span>0 online</span>`;
 });
 
+// Media is served from the blob store; older messages may still carry a data URL.
+// Pass a variant name (e.g. 'preview') to get a downscaled image where one exists.
+function mediaUrl(media, variant) {
+    const url = (variant && media.variants && media.variants[variant]) || media.url;
+    if (url) {
+        const password = document.getElementById('setupRoomPassword').value;
+        return `${url}?password=${encodeURIComponent(password)}`;
+    }
+    return media.data || null;
+}
+
 window.socket.on('message', (data) => {
     console.log("Received message data:", Object.keys(data));
     if (data.media) {
         console.log("Received media message:", {
             type: data.media.type,
-            size: data.media.data.length,
+            size: data.media.size,
             name: data.media.name
         });
     }
@@ -230,15 +335,16 @@ window.socket.on('message', (data) => {
     content.dataset.date = data.date;
     
     // Handle media content if present
-    if (data.media && data.media.data) {
+    const mediaSrc = data.media ? mediaUrl(data.media) : null;
+    if (mediaSrc) {
         if (data.media.type.startsWith('image/')) {
             const img = document.createElement('img');
-            img.src = data.media.data;
+            img.src = mediaUrl(data.media, 'preview');
             img.className = 'media-preview';
             img.alt = data.media.name || 'Image';
             img.loading = 'lazy';
             img.onclick = function() {
-                openLightbox(data.media.data, 'image');
+                openLightbox(mediaSrc, 'image');
             };
             
             // If there's no text message, just show the image without the <br>
@@ -251,13 +357,13 @@ window.socket.on('message', (data) => {
             content.appendChild(img);
         } else if (data.media.type.startsWith('video/')) {
             const video = document.createElement('video');
-            video.src = data.media.data;
+            video.src = mediaSrc;
             video.className = 'media-preview';
             video.controls = true;
             video.preload = 'metadata';
             video.onclick = function(e) {
                 if (e.target === video) {
-                    openLightbox(data.media.data, 'video');
+                    openLightbox(mediaSrc, 'video');
                 }
             };
             
@@ -329,18 +435,30 @@ window.socket.on('status', (data) => {
     }, 5000);
 });
 
-window.socket.on('typing_status', (data) => {
+// Users currently typing in the room; the server sends a full list on join
+// and coalesced typing_update deltas afterwards
+const typingUsersInRoom = new Set();
+
+function renderTypingIndicator() {
     const indicator = document.getElementById('typingIndicator');
-    if (data.typing_users && data.typing_users.length > 0) {
-        const typingUsers = data.typing_users.filter(id => id !== userId);
-        if (typingUsers.length > 0) {
-            indicator.textContent = `${typingUsers.join(', ')} ${typingUsers.length === 1 ? 'is' : 'are'} typing...`;
-        } else {
-            indicator.textContent = '';
-        }
+    const typingUsers = [...typingUsersInRoom].filter(id => id !== userId);
+    if (typingUsers.length > 0) {
+        indicator.textContent = `${typingUsers.join(', ')} ${typingUsers.length === 1 ? 'is' : 'are'} typing...`;
     } else {
         indicator.textContent = '';
     }
+}
+
+window.socket.on('typing_status', (data) => {
+    typingUsersInRoom.clear();
+    (data.typing_users || []).forEach(id => typingUsersInRoom.add(id));
+    renderTypingIndicator();
+});
+
+window.socket.on('typing_update', (data) => {
+    (data.started || []).forEach(id => typingUsersInRoom.add(id));
+    (data.stopped || []).forEach(id => typingUsersInRoom.delete(id));
+    renderTypingIndicator();
 });
 
 window.socket.on('reaction_update', (data) => {
@@ -408,5 +526,6 @@ window.socket.on('message_deleted', (data) => {
 // Export functions for use in other modules
 window.chatFunctions = {
     sendMessage,
-    loadRoomMessages
+    loadRoomMessages,
+    loadOlderMessages
 }; 
\ No newline at end of file
@@ -5,6 +5,7 @@ import socket
 import config
 from sockets.events import register_socket_events
 from utils.helpers import get_local_ip
+from utils.jobs import job_queue
 
 # Create Flask app
 app = Flask(__name__, template_folder='UI', static_folder=None)
@@ -30,7 +31,7 @@ def serve_js(filename):
     return response
 
 # Initialize Socket.IO
-socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=50 * 1024 * 1024)  # 50MB buffer
+socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=config.SOCKET_MAX_BUFFER_SIZE)
 
 # Register socket events
 socket_handlers = register_socket_events(socketio)
@@ -45,13 +46,9 @@ def handle_file_deletion(filename, room):
 def handle_message_deletion(message_id, user_id, is_admin_delete, room):
     socket_handlers['emit_message_deleted'](message_id, user_id, is_admin_delete, room)
 
-def handle_messages_read(room_id, message_ids, user_id):
-    socket_handlers['emit_messages_read'](room_id, message_ids, user_id)
-
 app.handle_file_upload = handle_file_upload
 app.handle_file_deletion = handle_file_deletion
 app.handle_message_deletion = handle_message_deletion
-app.handle_messages_read = handle_messages_read
 app.socketio = socketio  # Make socketio available to routes
 
 # Register blueprints with url prefixes
@@ -67,6 +64,11 @@ app.register_blueprint(room_bp, url_prefix='/room')
 app.register_blueprint(admin_bp, url_prefix='/admin')
 app.register_blueprint(auth_bp, url_prefix='/auth')
 
+# Queue again the background jobs an earlier run did not finish. The debug
+# reloader's parent process serves nothing, so it leaves them alone.
+if __name__ != '__main__' or not config.DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    job_queue.resume()
+
 # Define routes
 @app.route('/')
 def home():
@@ -1,6 +1,8 @@
+from flask import request
 from flask_socketio import emit, join_room, leave_room
 from app.utils.helpers import get_current_time
 from app.config.config import MAX_MESSAGES_PER_ROOM
+from utils.presence import Presence
 
 chat_rooms = {}
 room_passwords = {}
@@ -10,6 +12,7 @@ online_users = {}
 message_reactions = {}
 typing_users = {}
 user_socket_map = {}
+presence = Presence(online_users, user_socket_map)
 
 def register_socket_events(socketio):
     @socketio.on('join')
@@ -17,38 +20,34 @@ def register_socket_events(socketio):
         room = data['room']
         user_id = data['user_id']
         
-        user_socket_map[user_id] = request.sid
-        
         if room not in chat_rooms:
             chat_rooms[room] = []
-        if room not in online_users:
-            online_users[room] = set()
         if room not in message_reactions:
             message_reactions[room] = {}
         if room not in typing_users:
             typing_users[room] = set()
         
         join_room(room)
-        online_users[room].add(user_id)
+        first_tab = presence.join(request.sid, user_id, room)
         
         emit('online_count', {
             'room': room,
             'count': len(online_users[room])
         }, room=room, broadcast=True)
         
-        emit('status', {
-            'msg': f'👋 {user_id} has joined the room'
-        }, room=room, broadcast=True)
+        if first_tab:
+            emit('status', {
+                'msg': f'👋 {user_id} has joined the room'
+            }, room=room, broadcast=True)
 
     @socketio.on('leave')
     def on_leave(data):
         room = data['room']
         user_id = data['user_id']
         
-        if room in online_users:
-            online_users[room].discard(user_id)
-            if user_id in typing_users.get(room, set()):
-                typing_users[room].discard(user_id)
+        leave_room(room)
+        if presence.leave(request.sid, user_id, room):
+            typing_users.get(room, set()).discard(user_id)
             
             emit('online_count', {
                 'room': room,
@@ -107,26 +106,16 @@ def register_socket_events(socketio):
 
     @socketio.on('disconnect')
     def handle_disconnect():
-        user_id = None
-        for uid, sid in user_socket_map.items():
-            if sid == request.sid:
-                user_id = uid
-                break
+        user_id, rooms = presence.disconnect(request.sid)
         
-        if user_id:
-            for room in list(online_users.keys()):
-                if user_id in online_users[room]:
-                    online_users[room].discard(user_id)
-                    if user_id in typing_users.get(room, set()):
-                        typing_users[room].discard(user_id)
-                    
-                    emit('online_count', {
-                        'room': room,
-                        'count': len(online_users[room])
-                    }, room=room, broadcast=True)
-                    
-                    emit('status', {
-                        'msg': f'👋 {user_id} has disconnected'
-                    }, room=room, broadcast=True)
+        for room in rooms:
+            typing_users.get(room, set()).discard(user_id)
+            
+            emit('online_count', {
+                'room': room,
+                'count': len(online_users[room])
+            }, room=room, broadcast=True)
             
-            del user_socket_map[user_id]
\ No newline at end of file
+            emit('status', {
+                'msg': f'👋 {user_id} has disconnected'
+            }, room=room, broadcast=True)
\ No newline at end of file
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Compare the cipher suites on encrypt/decrypt time and stored record size.
+
+Usage:
+    python benchmarks/bench_ciphers.py --messages 20000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from utils import ciphers
+from utils.helpers import encrypt_message, decrypt_message
+
+ROOM_ID = "12345"
+
+
+def make_messages(count):
+    base = int(time.time() * 1000)
+    return [{
+        'id': str(base + i),
+        'user_id': 'sender',
+        'message': f'message number {i} with a little more text to be typical',
+        'timestamp': base + i
+    } for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cipher suite benchmark")
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages encrypted per suite")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    plaintext_size = sum(len(json.dumps(message)) for message in messages) / len(messages)
+    # Keep the benchmark's data keys out of the real key file
+    ciphers.room_keys.path = os.path.join(tempfile.mkdtemp(), 'room_keys.json')
+
+    print(f"{args.messages:,} messages, ~{plaintext_size:.0f} bytes of JSON each")
+    print(f"{'suite':<20} {'encrypt':>12} {'decrypt':>12} {'record':>10}")
+    for suite in (ciphers.FERNET, ciphers.AES_GCM, ciphers.CHACHA20_POLY1305):
+        config.CIPHER_SUITE = suite
+
+        started = time.perf_counter()
+        records = [encrypt_message(message, ROOM_ID) for message in messages]
+        encrypt_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for record in records:
+            decrypt_message(record, use_cache=False)
+        decrypt_time = time.perf_counter() - started
+
+        record_size = sum(len(record) for record in records) / len(records)
+        print(f"{suite:<20} {encrypt_time / len(records) * 1e6:>9.1f} us {decrypt_time / len(records) * 1e6:>9.1f} us"
+              f" {record_size:>8.0f} B")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Compare message compression settings on stored record size and encrypt/decrypt time.
+
+Every codec is measured without a dictionary and with one trained on the
+first messages of the room, the way train_dictionary jobs build them.
+
+Usage:
+    python benchmarks/bench_compression.py --messages 20000 --suite fernet
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from utils import ciphers, compression
+from utils.helpers import encrypt_message, decrypt_message
+
+ROOM_ID = "12345"
+PHRASES = [
+    "ok", "thanks!", "lol", "see you at the standup tomorrow", "did anyone look at the build failure on main?",
+    "I'll push the fix after lunch, the tests are green locally", "can you review my PR when you get a chance?",
+    "sounds good", "which branch is that on?", "deploying to staging now"
+]
+
+
+def make_messages(count):
+    base = int(time.time() * 1000)
+    rng = random.Random(7)
+    return [{
+        'id': str(base + i),
+        'user_id': f'user{rng.randrange(8)}',
+        'client_ip': f'10.0.0.{rng.randrange(1, 255)}',
+        'message': rng.choice(PHRASES) + (f' #{i}' if rng.random() < 0.3 else ''),
+        'timestamp': base + i,
+        'date': '2026-10-18',
+        'time': '05:16 PM'
+    } for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message compression benchmark")
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages encrypted per setting")
+    parser.add_argument("--suite", default=ciphers.FERNET, help="Cipher suite the records are sealed with")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    samples = [json.dumps(message).encode() for message in messages[:config.COMPRESSION_DICT_SAMPLES]]
+    plaintext_size = sum(len(json.dumps(message)) for message in messages) / len(messages)
+    # Keep the benchmark's keys and dictionaries out of the real files
+    scratch = tempfile.mkdtemp()
+    ciphers.room_keys.path = os.path.join(scratch, 'room_keys.json')
+    compression.room_dictionaries.path = os.path.join(scratch, 'room_dictionaries.json')
+    config.CIPHER_SUITE = args.suite
+
+    codecs = [compression.NONE, compression.ZLIB] + ([compression.ZSTD] if compression.zstandard else [])
+    print(f"{args.messages:,} messages, ~{plaintext_size:.0f} bytes of JSON each, {args.suite}")
+    print(f"{'codec':<6} {'dictionary':>10} {'encrypt':>12} {'decrypt':>12} {'record':>10}")
+    for codec in codecs:
+        for trained in ((False,) if codec == compression.NONE else (False, True)):
+            config.MESSAGE_COMPRESSION = codec
+            compression.room_dictionaries.forget_room(ROOM_ID)
+            if trained:
+                codec_id = compression.CODECS[codec]
+                compression.room_dictionaries.add(
+                    ROOM_ID, codec_id, compression.train(samples, codec_id, config.COMPRESSION_DICT_SIZE))
+
+            started = time.perf_counter()
+            records = [encrypt_message(message, ROOM_ID) for message in messages]
+            encrypt_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for record in records:
+                decrypt_message(record, use_cache=False)
+            decrypt_time = time.perf_counter() - started
+
+            record_size = sum(len(record) for record in records) / len(records)
+            print(f"{codec:<6} {'trained' if trained else '-':>10} {encrypt_time / len(records) * 1e6:>9.1f} us"
+                  f" {decrypt_time / len(records) * 1e6:>9.1f} us {record_size:>8.0f} B")
+
+
+if __name__ == "__main__":
+    main()
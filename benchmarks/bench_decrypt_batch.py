@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compare serial decrypt_message calls with decrypt_messages on the crypto pool.
+
+Each batch size is decrypted serially and then through decrypt_messages
+with every pool kind. The decrypted-message cache is bypassed so every
+run decrypts cold tokens. Speedups need more than one CPU core.
+
+Usage:
+    python benchmarks/bench_decrypt_batch.py --workers 4 --sizes 64,512,4096,32768
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from utils import crypto_pool
+from utils.helpers import encrypt_messages, decrypt_message, decrypt_messages
+
+
+def make_tokens(count):
+    base = int(time.time() * 1000)
+    messages = [{
+        'id': str(base + i),
+        'user_id': 'sender',
+        'message': f'message number {i} with a little more text to be typical',
+        'timestamp': base + i
+    } for i in range(count)]
+    return encrypt_messages(messages)
+
+
+def best_of(repeats, operation):
+    """Return the fastest of several runs, in seconds"""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def use_pool(kind, workers):
+    # Pools are created lazily; drop the previous one when switching kinds
+    if crypto_pool._pool is not None:
+        crypto_pool._pool.shutdown()
+        crypto_pool._pool = None
+    config.CRYPTO_POOL = kind
+    config.CRYPTO_WORKERS = workers
+    config.CRYPTO_PARALLEL_MIN_BATCH = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch decryption benchmark")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Crypto pool workers")
+    parser.add_argument("--sizes", default="64,512,4096,32768", help="Comma-separated batch sizes")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print(f"Encrypting {max(sizes):,} messages...")
+    tokens = make_tokens(max(sizes))
+    kinds = ["thread", "process"]
+
+    print(f"\n{args.workers} worker(s), {os.cpu_count()} CPU(s)")
+    print(f"{'batch':>8} {'serial':>12}" + "".join(f" {kind:>12} {'speedup':>8}" for kind in kinds))
+    for size in sizes:
+        batch = tokens[:size]
+        serial = best_of(args.repeats, lambda: [decrypt_message(token, use_cache=False) for token in batch])
+        row = f"{size:>8} {serial * 1e3:>10.1f}ms"
+        for kind in kinds:
+            use_pool(kind, args.workers)
+            decrypt_messages(batch[:args.workers], use_cache=False)  # Start the workers
+            pooled = best_of(args.repeats, lambda: decrypt_messages(batch, use_cache=False))
+            row += f" {pooled * 1e3:>10.1f}ms {serial / pooled:>7.2f}x"
+        print(row)
+    use_pool("none", 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Compare marking messages read via a linear history scan and via the message-id index.
+
+The linear variant reproduces the old mark_read route, which decrypted the
+room history for every requested ID. It is far too slow to run for every
+ID, so it is timed on a sample and extrapolated.
+
+Usage:
+    python benchmarks/bench_mark_read.py --messages 100000 --ids 500
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.helpers import encrypt_message, decrypt_message
+from utils.storage import MemoryMessageStore
+
+ROOM_ID = "12345"
+
+
+def populate(store, count):
+    """Fill the benchmark room with encrypted messages and return their IDs"""
+    base = int(time.time() * 1000)
+    ids = []
+    for i in range(count):
+        message_id = str(base + i)
+        message = {
+            'id': message_id,
+            'user_id': 'sender',
+            'message': f'message number {i}',
+            'timestamp': base + i,
+            'read_by': ['sender']
+        }
+        store.append(ROOM_ID, message_id, base + i, encrypt_message(message))
+        ids.append(message_id)
+    return ids
+
+
+def mark_read_linear(records, message_ids, user_id):
+    """The old approach: scan and decrypt the history for every ID"""
+    for message_id in message_ids:
+        for i, encrypted_message in enumerate(records):
+            message = decrypt_message(encrypted_message)
+            if message.get('id') == message_id:
+                if user_id not in message['read_by']:
+                    message['read_by'].append(user_id)
+                    records[i] = encrypt_message(message)
+                break
+
+
+def mark_read_indexed(store, message_ids, user_id):
+    """Look every ID up in the store's index and update only that message"""
+    for message_id in message_ids:
+        stored = store.get(ROOM_ID, message_id)
+        if stored is None:
+            continue
+        message = decrypt_message(stored.record)
+        if user_id not in message['read_by']:
+            message['read_by'].append(user_id)
+            store.replace(ROOM_ID, message_id, encrypt_message(message))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mark_read benchmark")
+    parser.add_argument("--messages", type=int, default=100_000, help="Messages in the room")
+    parser.add_argument("--ids", type=int, default=500, help="Message IDs marked read per request")
+    parser.add_argument("--linear-sample", type=int, default=5,
+                        help="IDs actually timed for the linear scan before extrapolating")
+    args = parser.parse_args()
+
+    store = MemoryMessageStore()
+    print(f"Encrypting {args.messages:,} messages...")
+    ids = populate(store, args.messages)
+
+    rng = random.Random(42)
+    targets = rng.sample(ids, args.ids)
+
+    sample = targets[:args.linear_sample]
+    records = [stored.record for stored in store.range(ROOM_ID)]
+    started = time.perf_counter()
+    mark_read_linear(records, sample, 'reader-linear')
+    linear_per_id = (time.perf_counter() - started) / len(sample)
+
+    started = time.perf_counter()
+    mark_read_indexed(store, targets, 'reader-indexed')
+    indexed_total = time.perf_counter() - started
+
+    linear_total = linear_per_id * args.ids
+    print(f"\nMarking {args.ids} IDs read in a {args.messages:,}-message room")
+    print(f"  linear scan (extrapolated from {len(sample)} IDs) {linear_total:10.3f} s")
+    print(f"  id index                                {indexed_total:10.3f} s")
+    print(f"  speedup                                 {linear_total / indexed_total:10.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Benchmark append, range read, lookup and delete latency of the message stores.
+
+Usage:
+    python benchmarks/bench_message_store.py --messages 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import MemoryMessageStore, SQLiteMessageStore
+
+ROOM_ID = "12345"
+# A Fernet token for a short chat message is roughly this long
+RECORD = "g" * 280
+
+
+def populate(store, count):
+    """Fill the benchmark room with `count` messages"""
+    base = int(time.time() * 1000)
+    started = time.perf_counter()
+    for i in range(count):
+        store.append(ROOM_ID, str(base + i), base + i, RECORD)
+    return time.perf_counter() - started, base
+
+
+def measure(label, operation, iterations):
+    """Run an operation repeatedly and print its mean latency in microseconds"""
+    started = time.perf_counter()
+    for i in range(iterations):
+        operation(i)
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<32} {elapsed / iterations * 1e6:10.1f} us/op")
+
+
+def run(name, store, count, iterations, page_size):
+    print(f"\n{name}: {count:,} messages in one room")
+    fill_time, base = populate(store, count)
+    print(f"  {'populate':<32} {fill_time / count * 1e6:10.1f} us/op")
+
+    rng = random.Random(42)
+    next_id = base + count
+
+    def append(i):
+        store.append(ROOM_ID, str(next_id + i), next_id + i, RECORD)
+
+    def latest_page(i):
+        store.range(ROOM_ID, limit=page_size, newest_first=True)
+
+    def page_before_random_cursor(i):
+        cursor = store.get(ROOM_ID, str(base + rng.randrange(count)))
+        store.range(ROOM_ID, before_seq=cursor.seq, limit=page_size, newest_first=True)
+
+    def time_range(i):
+        since = base + rng.randrange(count - page_size)
+        store.range(ROOM_ID, since=since, until=since + page_size - 1)
+
+    def lookup(i):
+        store.get(ROOM_ID, str(base + rng.randrange(count)))
+
+    victims = rng.sample(range(count), iterations)
+
+    def delete(i):
+        store.delete(ROOM_ID, str(base + victims[i]))
+
+    measure("append", append, iterations)
+    measure(f"latest page ({page_size})", latest_page, iterations)
+    measure(f"page before cursor ({page_size})", page_before_random_cursor, iterations)
+    measure(f"timestamp range ({page_size})", time_range, iterations)
+    measure("get by id", lookup, iterations)
+    measure("delete by id", delete, iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message store benchmark")
+    parser.add_argument("--messages", type=int, default=1_000_000, help="Messages to preload into the room")
+    parser.add_argument("--iterations", type=int, default=1000, help="Operations timed per measurement")
+    parser.add_argument("--page-size", type=int, default=50, help="Messages per range read")
+    parser.add_argument("--backend", choices=["memory", "sqlite", "all"], default="all")
+    args = parser.parse_args()
+
+    if args.backend in ("memory", "all"):
+        run("memory", MemoryMessageStore(), args.messages, args.iterations, args.page_size)
+
+    if args.backend in ("sqlite", "all"):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteMessageStore(os.path.join(directory, "bench.db"))
+            run("sqlite (WAL)", store, args.messages, args.iterations, args.page_size)
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
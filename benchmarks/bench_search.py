@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Benchmark search latency of the per-room inverted index.
+
+Usage:
+    python benchmarks/bench_search.py --messages 300000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.search_index import SearchIndex, index_terms
+
+ROOM_ID = "12345"
+VOCABULARY_SIZE = 20000
+QUERIES = [
+    'meeting',
+    'deploy tomorrow',
+    '"release notes"',
+    'word17 word42',
+    '"can you check" logs',
+]
+
+
+def build_messages(count, rng):
+    """Generate chat-like messages over a Zipf-ish vocabulary plus some fixed phrases"""
+    vocabulary = [f"word{i}" for i in range(VOCABULARY_SIZE)]
+    weights = [1 / (i + 1) for i in range(VOCABULARY_SIZE)]
+    phrases = ["release notes", "can you check the logs", "deploy tomorrow morning", "meeting at noon"]
+    messages = []
+    for _ in range(count):
+        words = rng.choices(vocabulary, weights=weights, k=rng.randint(3, 20))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(phrases))
+        messages.append(" ".join(words))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search index benchmark")
+    parser.add_argument("--messages", type=int, default=300_000, help="Messages in the room")
+    parser.add_argument("--iterations", type=int, default=50, help="Repetitions per query")
+    parser.add_argument("--limit", type=int, default=20, help="Results per page")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    messages = build_messages(args.messages, rng)
+
+    index = SearchIndex()
+    started = time.perf_counter()
+    for seq, text in enumerate(messages, 1):
+        index.add(ROOM_ID, seq, index_terms(text))
+    elapsed = time.perf_counter() - started
+    print(f"Indexed {args.messages:,} messages in {elapsed:.1f} s ({elapsed / args.messages * 1e6:.1f} us/message)")
+
+    print(f"\n{'query':<28} {'matches':>9} {'latency':>12}")
+    for query in QUERIES:
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            total, _ = index.search(ROOM_ID, query, 0, args.limit)
+        latency = (time.perf_counter() - started) / args.iterations
+        print(f"{query:<28} {total:>9,} {latency * 1000:>9.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Compare one token per message with sealed segments on stored size and page reads.
+
+A room is filled once per segment size (0 = a token per message), then
+random pages of history are read cold through decrypt_messages.
+
+Usage:
+    python benchmarks/bench_segments.py --messages 20000 --sizes 0,64,256 --page 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from utils import segments
+from utils.storage import message_store, SegmentRef
+from utils.helpers import encrypt_message, decrypt_messages
+
+
+def fill_room(room_id, count):
+    base = int(time.time() * 1000)
+    for i in range(count):
+        record = encrypt_message({
+            'id': str(base + i),
+            'user_id': f'user{i % 7}',
+            'message': f'message number {i} with a little more text to be typical',
+            'timestamp': base + i
+        }, room_id)
+        message_store.append(room_id, str(base + i), base + i, record)
+        # Sealed inline here; the app hands this to a background job
+        if segments.note_append(room_id, record):
+            segments.seal_pending(room_id)
+
+
+def stored_bytes(room_id):
+    rows = message_store.range(room_id)
+    # A segment reference costs about as much as its three small fields
+    total = sum(24 if isinstance(stored.record, SegmentRef) else len(stored.record) for stored in rows)
+    segment_ids = [segment_id for segment_id, _ in message_store.segments(room_id)]
+    return total + sum(len(record) for record in message_store.get_segments(room_id, segment_ids).values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment storage benchmark")
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages per room")
+    parser.add_argument("--sizes", default="0,64,256", help="Comma-separated segment sizes (0 = no segments)")
+    parser.add_argument("--page", type=int, default=50, help="Messages per page read")
+    parser.add_argument("--reads", type=int, default=200, help="Random pages read per size")
+    args = parser.parse_args()
+
+    config.CRYPTO_POOL = "none"  # Measure the work itself, not pool scheduling
+    print(f"{args.messages:,} messages, pages of {args.page}")
+    print(f"{'segment':>8} {'bytes/msg':>10} {'page read':>12}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        config.MESSAGE_SEGMENT_SIZE = size
+        room_id = f"bench-{size}"
+        fill_room(room_id, args.messages)
+
+        last_seq = message_store.range(room_id, limit=1, newest_first=True)[0].seq
+        started = time.perf_counter()
+        for _ in range(args.reads):
+            before_seq = random.randint(args.page + 1, last_seq + 1)
+            page = message_store.range(room_id, before_seq=before_seq, limit=args.page, newest_first=True)
+            decrypt_messages([stored.record for stored in page], use_cache=False)
+        page_time = (time.perf_counter() - started) / args.reads
+
+        print(f"{size:>8} {stored_bytes(room_id) / args.messages:>10.0f} {page_time * 1e3:>10.2f}ms")
+        message_store.drop_room(room_id)
+        segments.forget_room(room_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -108,14 +108,25 @@ class ChatCLI:
             print(f"❌ Error sending message: {e}")
             sys.exit(1)
 
-    def get_messages(self, room_id: str, password: Optional[str] = None, user_id: Optional[str] = None) -> None:
-        """Get messages from a chat room"""
+    def _get_message_page(self, room_id: str, headers: dict, params: dict, limit: int,
+                          before: Optional[str] = None) -> dict:
+        """Fetch one page of messages, newest page first unless a cursor is given"""
+        page_params = dict(params, limit=limit)
+        if before:
+            page_params["before"] = before
+        
+        response = requests.get(f"{self.base_url}/chat/{room_id}/messages", headers=headers, params=page_params)
+        response.raise_for_status()
+        return response.json()
+
+    def get_messages(self, room_id: str, password: Optional[str] = None, user_id: Optional[str] = None,
+                     limit: int = 50, before: Optional[str] = None) -> None:
+        """Get a page of messages from a chat room"""
         try:
             headers = {}
             if password:
                 headers = self._get_auth_headers(room_id, password)
                 
-            url = f"{self.base_url}/chat/{room_id}/messages"
             params = {}
             if password:
                 params["password"] = password
@@ -124,13 +135,8 @@ class ChatCLI:
                
                 params["mark_as_read"] = "false"
             
-            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            if query_string:
-                url += f"?{query_string}"
-            
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            messages = response.json()
+            page = self._get_message_page(room_id, headers, params, limit, before)
+            messages = page.get("messages", [])
             
             print("\n📬 Messages:")
             if not messages:
@@ -176,6 +182,9 @@ class ChatCLI:
                 print(f"\n{status_icon} 👤 {user} ({timestamp}){read_status}:")
                 print(f"   {msg.get('message', '')}")
                 print(f"   ID: {msg.get('id', 'unknown')}")
+            
+            if page.get("next_cursor"):
+                print(f"\n⬆️ Older messages available, use --before {page['next_cursor']}")
                 
           
             if unread_count > 0 and user_id:
@@ -281,30 +290,28 @@ class ChatCLI:
           
             headers = self._get_auth_headers(room_id, password)
                 
-            url = f"{self.base_url}/chat/{room_id}/messages"
             params = {
                 "password": password,
                 "user_id": user_id,
                 "mark_as_read": "false"  
             }
             
-            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            if query_string:
-                url += f"?{query_string}"
-            
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            messages = response.json()
-            
           
             unread_message_ids = []
-            for msg in messages:
-                message_id = msg.get('id')
-                read_by = msg.get('read_by', [])
+            cursor = None
+            while True:
+                page = self._get_message_page(room_id, headers, params, 500, cursor)
+                for msg in page.get("messages", []):
+                    message_id = msg.get('id')
+                    read_by = msg.get('read_by', [])
+                    
+                   
+                    if message_id and user_id not in read_by and msg.get('user_id') != user_id:
+                        unread_message_ids.append(message_id)
                 
-               
-                if message_id and user_id not in read_by and msg.get('user_id') != user_id:
-                    unread_message_ids.append(message_id)
+                cursor = page.get("next_cursor")
+                if not cursor:
+                    break
             
           
             if unread_message_ids:
@@ -338,6 +345,8 @@ def main():
     get_parser.add_argument("room_id", help="Room ID")
     get_parser.add_argument("--password", help="Room password (if IP not verified)")
     get_parser.add_argument("--user-id", help="User ID for message display")
+    get_parser.add_argument("--limit", type=int, default=50, help="Number of messages to fetch (default 50)")
+    get_parser.add_argument("--before", help="Fetch messages older than this message ID or timestamp")
     
    
     verify_parser = subparsers.add_parser("verify", help="Verify a user's IP (Admin only)")
@@ -384,7 +393,7 @@ def main():
     elif args.command == "send":
         cli.send_message(args.room_id, args.message, args.password, args.user_id)
     elif args.command == "get":
-        cli.get_messages(args.room_id, args.password, args.user_id)
+        cli.get_messages(args.room_id, args.password, args.user_id, args.limit, args.before)
     elif args.command == "verify":
         cli.verify_ip(args.room_id, args.ip, args.password)
     elif args.command == "clear":
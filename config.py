@@ -6,14 +6,21 @@ from cryptography.fernet import Fernet
 # Application settings
 SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_hex(32))
 JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
+# ENCRYPTION_KEY seeds the persisted key ring (utils/key_ring.py) on first
+# start; once the ring is loaded, both names refer to its primary key
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY", Fernet.generate_key())
 fernet = Fernet(ENCRYPTION_KEY)
+# Cipher for new messages: "fernet", "aes-gcm" or "chacha20-poly1305". The
+# AEAD suites use a data key per room, wrapped by a key derived from the
+# primary key; records written by any suite stay readable.
+CIPHER_SUITE = os.getenv("CIPHER_SUITE", "fernet")
 
 # Security settings
 TOKEN_EXPIRY_MINUTES = 60
 MAX_API_REQUESTS_PER_MINUTE = 60
 MAX_ROOM_CREATION_PER_HOUR = 10
 MAX_FILE_SIZE_MB = 5
+MAX_MEDIA_SIZE_MB = 50  # Socket media (video and audio messages) may be larger than room files
 PASSWORD_MIN_LENGTH = 8
 ROOM_ID_LENGTH = 5
 ENABLE_XSS_PROTECTION = True
@@ -23,19 +30,93 @@ SECURE_COOKIES = True
 # Create uploads directory if it doesn't exist
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Room files are stored once per distinct content, keyed by SHA-256
+FILE_BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+FILE_GC_INTERVAL_SECONDS = 60  # How often unreferenced file blobs are deleted
+# Downscaled image variants (name -> longest edge in pixels) rendered on upload
+IMAGE_VARIANTS = {"thumb": 160, "preview": 1024}
+VARIANT_JPEG_QUALITY = 80
+THUMBNAIL_WORKERS = 2  # Processes in the image variant worker pool
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 'zip'}
 
+# Message storage settings
+DATA_FOLDER = os.getenv("DATA_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+MESSAGE_STORE_BACKEND = os.getenv("MESSAGE_STORE_BACKEND", "memory")  # "memory" or "sqlite"
+MESSAGE_DB_PATH = os.getenv("MESSAGE_DB_PATH", os.path.join(DATA_FOLDER, 'messages.db'))
+ROOM_KEYS_PATH = os.getenv("ROOM_KEYS_PATH", os.path.join(DATA_FOLDER, 'room_keys.json'))  # Wrapped room data keys
+ROOM_DICTIONARIES_PATH = os.getenv("ROOM_DICTIONARIES_PATH", os.path.join(DATA_FOLDER, 'room_dictionaries.json'))
+KEY_RING_PATH = os.getenv("KEY_RING_PATH", os.path.join(DATA_FOLDER, 'keyring.json'))  # Fernet keys, readable by owner only
+MEDIA_FOLDER = os.getenv("MEDIA_FOLDER", os.path.join(DATA_FOLDER, 'media'))  # Content-addressed socket media
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600  # Media blobs never change, so clients may cache them for a year
+MEDIA_CHUNK_SIZE = 256 * 1024  # Chunk size suggested to clients for media_chunk events
+UPLOAD_TTL_SECONDS = 3600  # Unfinished chunked uploads are dropped after this long without a chunk
+UPLOAD_READ_SIZE = 64 * 1024  # Bytes read from the request stream at a time by resumable HTTP uploads
+# Largest Socket.IO packet accepted; media is sent in chunks, so this only
+# has to fit one chunk (or a small inline data URL)
+SOCKET_MAX_BUFFER_SIZE = 1024 * 1024
+MESSAGE_PAGE_SIZE = 50  # Default page size for paginated message history
+MAX_MESSAGE_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20  # Default number of search results per page
+MAX_SEARCH_PAGE_SIZE = 100
+FILE_PAGE_SIZE = 50  # Default page size for paginated file listings
+MAX_FILE_PAGE_SIZE = 200
+# "plaintext" indexes words in memory; "blind" indexes keyed HMAC tokens of the
+# words instead and stores them next to each ciphertext, so no plaintext is
+# kept for search.
+SEARCH_INDEX_MODE = os.getenv("SEARCH_INDEX_MODE", "plaintext")
+SEARCH_INDEX_KEY = os.getenv("SEARCH_INDEX_KEY")  # Defaults to the key ring's index key
+# Upper bound on plaintext kept in the decrypted-message cache (0 disables it)
+DECRYPT_CACHE_MAX_BYTES = int(os.getenv("DECRYPT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Batches of at least CRYPTO_PARALLEL_MIN_BATCH messages are encrypted or
+# decrypted on a pool: "process" (worker processes), "thread" (eventlet's
+# tpool, or plain threads) or "none"
+CRYPTO_POOL = os.getenv("CRYPTO_POOL", "process")
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", os.cpu_count() or 1))
+CRYPTO_PARALLEL_MIN_BATCH = 512
+DECRYPT_BATCH_SIZE = 2048  # Messages read and decrypted together by bulk readers (exports, index rebuilds)
+# Every MESSAGE_SEGMENT_SIZE encrypted messages of a room are sealed into one
+# compressed, encrypted segment; newer messages stay individual tokens until
+# the next segment fills up (0 keeps one token per message)
+MESSAGE_SEGMENT_SIZE = int(os.getenv("MESSAGE_SEGMENT_SIZE", 0))
+SEGMENT_COMPRESSION_LEVEL = 6  # zlib level used for segments
+# Serialized messages are compressed before encryption: "none", "zlib" or
+# "zstd" (needs the zstandard package). Once a room has
+# COMPRESSION_DICT_MIN_MESSAGES messages, a dictionary is trained on them so
+# short messages compress too; messages that would not shrink are stored as is.
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "none")
+COMPRESSION_LEVEL = 6
+COMPRESSION_DICT_SIZE = 8 * 1024  # Upper bound on a room's dictionary, in bytes
+COMPRESSION_DICT_MIN_MESSAGES = 200
+COMPRESSION_DICT_SAMPLES = 1000  # Newest messages a dictionary is trained on
+# Typing indicators are broadcast as coalesced deltas at most this often per room
+TYPING_FLUSHES_PER_SECOND = 4
+TYPING_TIMEOUT_SECONDS = 5  # A user stops "typing" this long after their last typing event
+READ_RECEIPT_FLUSH_SECONDS = 0.5  # Window over which read receipts are batched per room
+READ_RANGES_MAX = 64  # Out-of-order read ranges kept per user; past this the oldest is counted as read
+# Background jobs (room deletion, clearing, re-encryption, exports)
+JOB_WORKERS = 2  # Worker threads running queued jobs
+JOB_BATCH_SIZE = 500  # Messages handled per job step; progress is journaled after each step
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", os.path.join(DATA_FOLDER, 'jobs.json'))
+JOB_HISTORY = 100  # Finished jobs kept for status queries
+EXPORT_FOLDER = os.path.join(DATA_FOLDER, 'exports')  # Files written by export jobs
+EXPORT_WRITE_SIZE = 64 * 1024  # Exported NDJSON is written out in blocks of about this size
+# Messages re-encrypted per second by the sweep that follows a key rotation
+KEY_ROTATION_OPS_PER_SECOND = int(os.getenv("KEY_ROTATION_OPS_PER_SECOND", 500))
+KEY_ROTATION_REPORTED_UNREADABLE = 100  # Unreadable messages a rotation job lists in its result
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")  # Required by server-wide admin endpoints; they are disabled without it
+
 # Data storage
-chat_rooms = {}
+chat_rooms = {}  # Backing dict of the in-memory message store (see utils/storage.py)
 room_passwords = {}
 room_verified_ips = {}
 user_profiles = {}
 online_users = {}
 message_reactions = {}
 typing_users = {}
-user_socket_map = {}
-room_files = {}  # To store file information per room
-message_read_status = {}  # To track which messages have been read by which users
+user_socket_map = {}  # Connected socket IDs per user (several tabs): {user_id: set of sids}
+room_files = {}  # To store file information per room (room_id -> RoomFiles)
+read_cursors = {}  # Read high-water marks: {room_id: {user_id: last read seq}} (see utils/read_receipts.py)
+read_exceptions = {}  # Messages read past the cursor: {room_id: {user_id: sorted [first seq, last seq] ranges}}
 
 # Server settings
 HOST = '0.0.0.0'
@@ -1,7 +1,17 @@
 from flask import Blueprint, request, jsonify, render_template
 import os
+import hmac
 import config
 from utils.middleware import token_required
+from utils.helpers import decrypted_cache
+from utils import read_receipts
+from utils.typing_indicator import typing_tracker
+from utils.blob_store import file_store
+from utils.jobs import job_queue, DONE
+from utils.admin_jobs import (start_clear_chat, start_delete_room, start_reencrypt, start_export, export_path,
+                              start_key_rotation)
+from utils.key_ring import key_ring
+from utils.file_responses import send_content_file
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -9,6 +19,45 @@ admin_bp = Blueprint('admin', __name__)
 def admin_panel():
     return render_template("admin.html")
 
+@admin_bp.route('/metrics', methods=['GET'])
+def admin_metrics():
+    """Expose internal counters for monitoring"""
+    denied = _server_admin_denied()
+    if denied:
+        return denied
+    return jsonify({
+        "success": True,
+        "decrypt_cache": decrypted_cache.stats() if decrypted_cache is not None else None,
+        "typing": typing_tracker.stats(),
+        "read_receipts": read_receipts.stats(),
+        "file_store": file_store.stats(),
+        "jobs": job_queue.stats()
+    })
+
+def _admin_denied(room_id, password):
+    """Return an error response unless the request may administer the room"""
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        return None
+    if config.room_passwords.get(room_id) != password:
+        return jsonify({"success": False, "error": "Unauthorized access!"}), 401
+    return None
+
+def _server_admin_denied():
+    """Return an error response unless the request carries ADMIN_API_KEY in X-Admin-Key"""
+    if not config.ADMIN_API_KEY:
+        return jsonify({"success": False, "error": "Server administration is disabled"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Admin-Key", ""), config.ADMIN_API_KEY):
+        return jsonify({"success": False, "error": "Unauthorized access!"}), 401
+    return None
+
+def _job_accepted(job, message):
+    return jsonify({
+        "success": True,
+        "message": message,
+        "job_id": job.job_id,
+        "status_url": f"/admin/jobs/{job.job_id}"
+    }), 202
+
 @admin_bp.route('/verify_ip', methods=['POST'])
 @token_required
 def admin_verify_ip():
@@ -48,12 +97,10 @@ def admin_clear_chat():
     elif config.room_passwords.get(room_id) != password:
         return jsonify({"success": False, "error": "Unauthorized access!"}), 401
 
-    if room_id in config.chat_rooms:
-        config.chat_rooms[room_id] = []
-        if room_id in config.message_reactions:
-            config.message_reactions[room_id] = {}
-            
-    return jsonify({"success": True, "message": "Chat cleared successfully!"})
+    # The history (and, if asked, the room's files) is removed by a
+    # background job; poll status_url for progress
+    job = start_clear_chat(room_id, files=bool(data.get("files")))
+    return _job_accepted(job, "Chat is being cleared")
 
 @admin_bp.route('/delete_room', methods=['POST'])
 @token_required
@@ -70,24 +117,94 @@ def admin_delete_room():
     elif config.room_passwords.get(room_id) != password:
         return jsonify({"success": False, "error": "Unauthorized access!"}), 401
 
-    config.chat_rooms.pop(room_id, None)
-    config.room_verified_ips.pop(room_id, None)
-    config.room_passwords.pop(room_id, None)
-    config.message_reactions.pop(room_id, None)
-    config.typing_users.pop(room_id, None)
+    # The room is closed right away; its history and files are removed by a
+    # background job
+    job = start_delete_room(room_id)
+    return _job_accepted(job, f"Room {room_id} is being deleted")
+
+@admin_bp.route('/reencrypt', methods=['POST'])
+@token_required
+def admin_reencrypt():
+    data = request.get_json() or {}
+    room_id = data.get("room_id")
+    if not room_id:
+        return jsonify({"success": False, "error": "Room ID is required!"}), 400
+    denied = _admin_denied(room_id, data.get("password"))
+    if denied:
+        return denied
+    
+    job = start_reencrypt(room_id)
+    return _job_accepted(job, f"Room {room_id} is being re-encrypted")
+
+@admin_bp.route('/export', methods=['POST'])
+@token_required
+def admin_export():
+    data = request.get_json() or {}
+    room_id = data.get("room_id")
+    if not room_id:
+        return jsonify({"success": False, "error": "Room ID is required!"}), 400
+    denied = _admin_denied(room_id, data.get("password"))
+    if denied:
+        return denied
+    
+    since, until = data.get("since"), data.get("until")
+    if any(bound is not None and not isinstance(bound, int) for bound in (since, until)):
+        return jsonify({"success": False, "error": "since and until must be timestamps in milliseconds"}), 400
+    
+    job = start_export(room_id, since, until, compress=bool(data.get("gzip")))
+    return _job_accepted(job, f"Room {room_id} is being exported")
+
+@admin_bp.route('/keys', methods=['GET'])
+def admin_keys():
+    denied = _server_admin_denied()
+    if denied:
+        return denied
+    return jsonify({"success": True, "primary_key_id": key_ring.primary_id(), "keys": key_ring.describe()})
+
+@admin_bp.route('/keys/rotate', methods=['POST'])
+def admin_rotate_keys():
+    denied = _server_admin_denied()
+    if denied:
+        return denied
+    
+    # New messages use the new key right away; stored ones are re-encrypted
+    # by a throttled sweep, which retires the old key when it finishes
+    job = start_key_rotation()
+    return _job_accepted(job, f"Rotated to key {job.params['key_id']}")
+
+def _job_denied(job):
+    """Return an error response unless the request may see the job: room jobs need the room's credentials"""
+    room_id = job.params.get('room_id')
+    if room_id is None:
+        return _server_admin_denied()
+    return _admin_denied(room_id, request.args.get("password"))
+
+@admin_bp.route('/jobs/<job_id>', methods=['GET'])
+@token_required
+def admin_job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    denied = _job_denied(job)
+    if denied:
+        return denied
+    return jsonify({"success": True, "job": job.public()})
+
+@admin_bp.route('/jobs/<job_id>/download', methods=['GET'])
+@token_required
+def admin_job_download(job_id):
+    job = job_queue.get(job_id)
+    if job is None or job.kind != 'export':
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    # Exports hold decrypted history, so the room credentials are checked again
+    denied = _admin_denied(job.params['room_id'], request.args.get("password"))
+    if denied:
+        return denied
     
-    if room_id in config.room_files:
-        room_dir = os.path.join(config.UPLOAD_FOLDER, room_id)
-        if os.path.exists(room_dir):
-            for file in os.listdir(room_dir):
-                try:
-                    os.remove(os.path.join(room_dir, file))
-                except:
-                    pass
-            try:
-                os.rmdir(room_dir)
-            except:
-                pass
-        config.room_files.pop(room_id, None)
+    path = export_path(job)
+    if job.status != DONE or not os.path.exists(path):
+        return jsonify({"success": False, "error": "Export is not ready"}), 409
     
-    return jsonify({"success": True, "message": f"Room {room_id} deleted!"}) 
\ No newline at end of file
+    name = os.path.basename(path).replace(job_id, f"room_{job.params['room_id']}")
+    return send_content_file(path, 'application/gzip' if job.params.get('gzip') else 'application/x-ndjson',
+                             etag=job_id, download_name=name) 
\ No newline at end of file
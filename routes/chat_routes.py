@@ -1,13 +1,80 @@
-from flask import Blueprint, request, jsonify, send_file, render_template, current_app
+from flask import Blueprint, request, jsonify, render_template, current_app, Response
 import os
 import time
-from utils.helpers import get_client_ip, allowed_file, encrypt_message, decrypt_message
+from utils.helpers import (get_client_ip, allowed_file, encrypt_message, decrypt_message, decrypt_messages,
+                           invalidate_decrypted_message)
 from utils.middleware import token_required
+from utils.storage import message_store
+from utils import read_receipts
+from utils.search_index import search_index, index_terms, is_blind
+from utils.blob_store import blob_store, file_store, INLINE_TYPES
+from utils.uploads import file_uploads, UploadError, UploadTooLarge, MAX_UPLOAD_BYTES
+from utils.file_responses import send_content_file
+from utils.thumbnails import schedule_variants
+from utils.room_files import room_files_for
+from utils.admin_jobs import start_clear_chat, maybe_train_dictionary, maybe_seal_segments
+from utils.export import export_chunks
+from utils import segments
+from werkzeug.utils import secure_filename
 import config
 from datetime import datetime
 
 chat_bp = Blueprint('chat', __name__)
 
+SEQ_CURSOR_PREFIX = 'seq:'
+
+def _cursor_bounds(room_id, cursor, direction):
+    """Translate a before/after cursor (next_cursor, message ID or timestamp) into range() bounds"""
+    # next_cursor names the seq the store orders by; message IDs are not
+    # unique, so they are only accepted as input
+    if cursor.startswith(SEQ_CURSOR_PREFIX):
+        try:
+            return {f"{direction}_seq": int(cursor[len(SEQ_CURSOR_PREFIX):])}
+        except ValueError:
+            return None
+    
+    stored = message_store.get(room_id, cursor)
+    if stored is not None:
+        return {f"{direction}_seq": stored.seq}
+    
+    try:
+        timestamp = int(cursor)
+    except (TypeError, ValueError):
+        return None
+    
+    if direction == 'before':
+        return {"until": timestamp - 1}
+    return {"since": timestamp + 1}
+
+def _fetch_page(room_id, before, after, limit):
+    """Read one page of stored messages in chronological order.
+
+    Returns (messages, next_cursor). Without `after` the page ends at the
+    newest message (or just before `before`) and the cursor points further
+    back in history; with `after` the page walks forward instead.
+    """
+    bounds = {}
+    for direction, cursor in (("before", before), ("after", after)):
+        if cursor is None:
+            continue
+        cursor_bounds = _cursor_bounds(room_id, cursor, direction)
+        if cursor_bounds is None:
+            return None, None
+        bounds.update(cursor_bounds)
+    
+    forward = after is not None
+    # Read one extra message to find out whether another page exists
+    page = message_store.range(room_id, limit=limit + 1, newest_first=not forward, **bounds)
+    has_more = len(page) > limit
+    page = page[:limit]
+    if not forward:
+        page.reverse()
+    
+    next_cursor = None
+    if has_more and page:
+        next_cursor = f"{SEQ_CURSOR_PREFIX}{page[-1].seq if forward else page[0].seq}"
+    return page, next_cursor
+
 @chat_bp.route('/<room_id>/messages', methods=['GET'])
 @token_required
 def get_messages(room_id):
@@ -15,6 +82,10 @@ def get_messages(room_id):
     password = request.args.get("password")
     user_id = request.args.get("user_id")
     mark_as_read = request.args.get("mark_as_read", "true").lower() in ["true", "1", "yes"]
+    before = request.args.get("before")
+    after = request.args.get("after")
+    limit = request.args.get("limit")
+    paginated = before is not None or after is not None or limit is not None
     
     # Check if authenticated via token
     if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
@@ -23,19 +94,44 @@ def get_messages(room_id):
     elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
     
-    if room_id not in config.chat_rooms:
+    if paginated:
+        try:
+            limit = int(limit) if limit is not None else config.MESSAGE_PAGE_SIZE
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        limit = min(limit, config.MAX_MESSAGE_PAGE_SIZE)
+    
+    if not message_store.has_room(room_id):
+        if paginated:
+            return jsonify({"messages": [], "next_cursor": None, "has_more": False})
         return jsonify([])
     
-    # Decrypt messages
-    decrypted_messages = []
-    updated_messages = []
-    
-    # Initialize read status tracking if needed
-    if room_id not in config.message_read_status:
-        config.message_read_status[room_id] = {}
+    next_cursor = None
+    if paginated:
+        stored_messages, next_cursor = _fetch_page(room_id, before, after, limit)
+        if stored_messages is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+    else:
+        stored_messages = message_store.range(room_id)
     
-    for i, encrypted_message in enumerate(config.chat_rooms[room_id]):
-        message = decrypt_message(encrypted_message)
+    # If requested, mark the returned messages as read by the current user.
+    # Read state is kept outside the ciphertext, so nothing is re-encrypted.
+    updated_messages = []
+    if user_id and mark_as_read:
+        updated_messages = read_receipts.mark_read(room_id, user_id, stored_messages, broadcast=True)
+    
+    # Decrypt messages as one batch, so cold history is decrypted in parallel
+    decrypted_messages = decrypt_messages([stored.record for stored in stored_messages])
+    
+    for i, (stored, message) in enumerate(zip(stored_messages, decrypted_messages)):
+        # Records no key can decrypt come back as stored; they keep their
+        # place in the page as an error entry instead of leaking ciphertext
+        if not isinstance(message, dict):
+            decrypted_messages[i] = {"id": stored.message_id, "timestamp": stored.timestamp,
+                                     "error": "undecryptable"}
+            continue
         
         # Add is_sent flag for UI
         if user_id:
@@ -44,27 +140,7 @@ def get_messages(room_id):
             # Add read status info
             message_id = message.get('id')
             if message_id:
-                # Ensure read_by list exists
-                if 'read_by' not in message:
-                    message['read_by'] = []
-                    
-                # If requested, mark message as read by current user
-                if mark_as_read and user_id and user_id not in message['read_by']:
-                    message['read_by'].append(user_id)
-                    updated_messages.append(message_id)
-                    
-                    # Update the message in the database
-                    config.chat_rooms[room_id][i] = encrypt_message(message)
-                    
-                    # Update read status tracking
-                    if message_id not in config.message_read_status[room_id]:
-                        config.message_read_status[room_id][message_id] = {
-                            'read_by': [user_id],
-                            'timestamp': message.get('timestamp', int(time.time() * 1000))
-                        }
-                    else:
-                        if user_id not in config.message_read_status[room_id][message_id]['read_by']:
-                            config.message_read_status[room_id][message_id]['read_by'].append(user_id)
+                message['read_by'] = read_receipts.read_by(room_id, stored.seq)
                 
                 # Add convenience properties for UI
                 if message.get('user_id') == user_id:
@@ -75,19 +151,49 @@ def get_messages(room_id):
                 else:
                     # For receiver: whether I have read this message
                     message['is_read'] = user_id in message.get('read_by', [])
-        
-        decrypted_messages.append(message)
-    
-    # Notify other users about read status change
-    if updated_messages and hasattr(current_app, 'socketio'):
-        current_app.socketio.emit('messages_read', {
-            'room_id': room_id,
-            'message_ids': updated_messages,
-            'read_by': user_id
-        }, room=room_id)
     
+    if paginated:
+        return jsonify({
+            "messages": decrypted_messages,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
+        })
     return jsonify(decrypted_messages)
 
+@chat_bp.route('/<room_id>/export', methods=['GET'])
+@token_required
+def export_messages(room_id):
+    client_ip = get_client_ip()
+    password = request.args.get("password")
+    compress = request.args.get("gzip", "false").lower() in ["true", "1", "yes"]
+    
+    # Check if authenticated via token
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        pass  # Allow access if authenticated via token
+    # Otherwise check IP or password
+    elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
+        return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
+    
+    try:
+        since = int(request.args["since"]) if "since" in request.args else None
+        until = int(request.args["until"]) if "until" in request.args else None
+    except ValueError:
+        return jsonify({"error": "since and until must be timestamps in milliseconds"}), 400
+    
+    if not message_store.has_room(room_id):
+        return jsonify({"error": "Room not found"}), 404
+    
+    # The history is streamed one decrypted batch at a time, so memory use
+    # does not grow with the size of the room
+    filename = f"room_{secure_filename(room_id)}.ndjson" + (".gz" if compress else "")
+    return Response(export_chunks(room_id, since, until, compress),
+                    mimetype='application/gzip' if compress else 'application/x-ndjson',
+                    headers={
+                        'Content-Disposition': f'attachment; filename="{filename}"',
+                        'Cache-Control': 'no-store',
+                        'X-Accel-Buffering': 'no'
+                    })
+
 @chat_bp.route('/<room_id>/clear', methods=['POST'])
 @token_required
 def clear_chat(room_id):
@@ -102,10 +208,14 @@ def clear_chat(room_id):
     elif config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Provide the correct password."}), 401
     
-    if room_id in config.chat_rooms:
-        config.chat_rooms[room_id] = []
-        config.message_reactions[room_id] = {}
-    return jsonify({"success": True, "message": "Chat cleared!"})
+    # Large histories are removed by a background job; poll status_url
+    job = start_clear_chat(room_id)
+    return jsonify({
+        "success": True,
+        "message": "Chat is being cleared",
+        "job_id": job.job_id,
+        "status_url": f"/admin/jobs/{job.job_id}"
+    }), 202
 
 @chat_bp.route('/<room_id>', methods=['POST'])
 @token_required
@@ -123,9 +233,9 @@ def send_message(room_id):
     elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
 
-    if room_id not in config.chat_rooms:
-        config.chat_rooms[room_id] = []
-    
+    if message is not None and not isinstance(message, str):
+        return jsonify({"error": "message must be a string"}), 400
+
     # Create message object
     timestamp = int(time.time() * 1000)
     message_id = str(timestamp)
@@ -137,22 +247,25 @@ def send_message(room_id):
         'message': message,
         'timestamp': timestamp,
         'date': now.strftime("%Y-%m-%d"),
-        'time': now.strftime("%I:%M %p"),
-        'read_by': [user_id]  # Sender has automatically seen the message
-    }
-    
-    # Initialize read status for this message
-    if room_id not in config.message_read_status:
-        config.message_read_status[room_id] = {}
-    
-    config.message_read_status[room_id][message_id] = {
-        'read_by': [user_id],  # Sender has automatically seen the message
-        'timestamp': timestamp
+        'time': now.strftime("%I:%M %p")
     }
     
     # Encrypt the message before storing
-    encrypted_message = encrypt_message(message_obj)
-    config.chat_rooms[room_id].append(encrypted_message)
+    encrypted_message = encrypt_message(message_obj, room_id)
+    # Search terms come from the plaintext before it is encrypted; blind
+    # tokens are stored next to the ciphertext
+    terms = index_terms(message)
+    seq = message_store.append(room_id, message_id, timestamp, encrypted_message,
+                               search_tokens=terms if is_blind() else None)
+    search_index.add(room_id, seq, terms)
+    # With MESSAGE_SEGMENT_SIZE set, full runs of messages are sealed into
+    # segments by a background job
+    maybe_seal_segments(room_id, encrypted_message)
+    # With MESSAGE_COMPRESSION set, busy rooms get a trained dictionary
+    maybe_train_dictionary(room_id)
+    
+    # Sender has automatically seen the message
+    read_receipts.mark_read(room_id, user_id, message_store.get_many(room_id, [message_id]))
     
     return jsonify({"success": True, "message": "Message sent securely!"})
 
@@ -164,16 +277,67 @@ def chat_web(room_id):
     if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return "<h3>Access Denied! Verify your IP or provide the correct password.</h3>", 401
 
-    messages = config.chat_rooms.get(room_id, [])
+    messages = [stored.record for stored in message_store.range(room_id)]
     return render_template("chat.html", room_id=room_id, messages=messages)
 
+def _room_access_denied(room_id, password):
+    """Return an error response unless the request may access the room's files"""
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        return None
+    if get_client_ip() not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
+        return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
+    return None
+
+def _add_room_file(room_id, original_name, content_type, user_id, blob_id, size):
+    """Add a reference to a stored file blob to the room and announce it.
+
+    The caller must already hold a file_store reference for blob_id.
+    """
+    files = room_files_for(room_id)
+    
+    # The stored filename names this room's reference; the bytes live once
+    # in the file store under their SHA-256. Uploads within the same second
+    # get a counter so neither the name nor the id is reused.
+    now = int(time.time())
+    filename = f"{now}_{secure_filename(original_name)}"
+    file_id = f"file_{now}"
+    counter = 1
+    while filename in files or files.has_id(file_id):
+        filename = f"{now}_{counter}_{secure_filename(original_name)}"
+        file_id = f"file_{now}_{counter}"
+        counter += 1
+    
+    # Add file info to room_files
+    file_info = {
+        'id': file_id,
+        'filename': original_name,
+        'stored_filename': filename,
+        'blob_id': blob_id,
+        'path': file_store.path(blob_id),
+        'size': size,
+        'type': content_type,
+        'uploaded_by': user_id,
+        'uploaded_at': int(time.time() * 1000)
+    }
+    variants = schedule_variants(file_store, blob_id, content_type)
+    if variants:
+        file_info['variants'] = {variant: f"/chat/{room_id}/files/{filename}/{variant}" for variant in variants}
+    
+    files.add(file_info)
+    
+    # Notify all users in the room about the new file
+    current_app.handle_file_upload(file_info, room_id)
+    return file_info
+
 @chat_bp.route('/<room_id>/upload', methods=['POST'])
 def upload_file(room_id):
-    client_ip = get_client_ip()
-    password = request.form.get("password")
+    denied = _room_access_denied(room_id, request.form.get("password"))
+    if denied:
+        return denied
     
-    if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
-        return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
+    # Reject oversized bodies before Werkzeug parses (and spools) them
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"File exceeds {config.MAX_FILE_SIZE_MB}MB limit"}), 413
     
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
@@ -185,36 +349,12 @@ def upload_file(room_id):
         return jsonify({"error": "No file selected"}), 400
         
     if file and allowed_file(file.filename):
-        # Create room directory if it doesn't exist
-        room_dir = os.path.join(config.UPLOAD_FOLDER, room_id)
-        os.makedirs(room_dir, exist_ok=True)
-        
-        # Generate a secure filename
-        filename = f"{int(time.time())}_{file.filename}"
-        filepath = os.path.join(room_dir, filename)
-        
-        # Save the file
-        file.save(filepath)
-        
-        # Add file info to room_files
-        file_info = {
-            'id': f"file_{int(time.time())}",
-            'filename': file.filename,
-            'stored_filename': filename,
-            'path': filepath,
-            'size': os.path.getsize(filepath),
-            'type': file.content_type,
-            'uploaded_by': user_id,
-            'uploaded_at': int(time.time() * 1000)
-        }
-        
-        if room_id not in config.room_files:
-            config.room_files[room_id] = []
-            
-        config.room_files[room_id].append(file_info)
-        
-        # Notify all users in the room about the new file
-        current_app.handle_file_upload(file_info, room_id)
+        tmp_path, blob_id, size = file_store.spool(file.stream)
+        if size > MAX_UPLOAD_BYTES:
+            os.unlink(tmp_path)
+            return jsonify({"error": f"File exceeds {config.MAX_FILE_SIZE_MB}MB limit"}), 413
+        file_store.add_file(tmp_path, blob_id, file.content_type)
+        file_info = _add_room_file(room_id, file.filename, file.content_type, user_id, blob_id, size)
         
         return jsonify({
             "success": True, 
@@ -224,6 +364,200 @@ def upload_file(room_id):
     
     return jsonify({"error": "File type not allowed"}), 400
 
+# Resumable uploads: POST creates an upload, PATCH appends bytes at the
+# offset given in the Upload-Offset header, HEAD reports the current
+# offset so an interrupted client knows where to continue, and the file
+# is added to the room once all declared bytes have arrived.
+
+def _upload_status(upload):
+    return {
+        "upload_id": upload.upload_id,
+        "offset": upload.received,
+        "size": upload.size,
+        "complete": False
+    }
+
+@chat_bp.route('/<room_id>/uploads', methods=['POST'])
+def create_upload(room_id):
+    data = request.get_json() or {}
+    denied = _room_access_denied(room_id, data.get("password"))
+    if denied:
+        return denied
+    
+    filename = data.get("filename")
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": "File type not allowed"}), 400
+    
+    # Re-uploading content this room already has needs no bytes at all.
+    # Other rooms' files are deliberately not matched by hash alone, as that
+    # would hand out their content to anyone who knows the hash.
+    sha256 = data.get("sha256")
+    existing = config.room_files[room_id].find_blob(sha256) if room_id in config.room_files else None
+    if sha256 and existing and file_store.add_ref(sha256):
+        file_info = _add_room_file(room_id, filename, data.get("type") or existing['type'],
+                                   data.get("user_id"), sha256, existing['size'])
+        return jsonify({
+            "success": True,
+            "offset": existing['size'],
+            "size": existing['size'],
+            "complete": True,
+            "message": "File uploaded successfully!",
+            "file": file_info
+        })
+    
+    try:
+        upload = file_uploads.begin(room_id, data.get("user_id"), data.get("type"), filename, data.get("size"))
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    response = jsonify({"success": True, **_upload_status(upload)})
+    response.status_code = 201
+    response.headers['Location'] = f"/chat/{room_id}/uploads/{upload.upload_id}"
+    return response
+
+@chat_bp.route('/<room_id>/uploads/<upload_id>', methods=['HEAD'])
+def upload_progress(room_id, upload_id):
+    denied = _room_access_denied(room_id, request.args.get("password"))
+    if denied:
+        return denied
+    
+    try:
+        upload = file_uploads.get(upload_id, None, room=room_id)
+    except UploadError:
+        return '', 404
+    return '', 200, {
+        'Upload-Offset': str(upload.received),
+        'Upload-Length': str(upload.size),
+        'Cache-Control': 'no-store'
+    }
+
+@chat_bp.route('/<room_id>/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(room_id, upload_id):
+    denied = _room_access_denied(room_id, request.args.get("password"))
+    if denied:
+        return denied
+    
+    try:
+        upload = file_uploads.get(upload_id, None, room=room_id)
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except UploadError:
+        return jsonify({"error": "Unknown upload"}), 404
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+    
+    if offset != upload.received:
+        return jsonify({"error": "Offset mismatch", **_upload_status(upload)}), 409
+    if request.content_length and offset + request.content_length > upload.size:
+        return jsonify({"error": "Chunk exceeds the declared upload size"}), 413
+    
+    # Stream the body to disk in bounded pieces; whatever arrived before a
+    # dropped connection is kept and reported by HEAD
+    try:
+        while True:
+            piece = request.stream.read(config.UPLOAD_READ_SIZE)
+            if not piece:
+                break
+            new_offset = file_uploads.write(upload_id, None, offset, piece)
+            if new_offset != offset + len(piece):
+                return jsonify({"error": "Offset mismatch", **_upload_status(upload)}), 409
+            offset = new_offset
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if upload.received < upload.size:
+        response = jsonify({"success": True, **_upload_status(upload)})
+        response.headers['Upload-Offset'] = str(upload.received)
+        return response
+    
+    # All bytes are in: move the file into the file store in one rename
+    def commit(upload):
+        blob_id = file_store.add_file(upload.path, upload.sha256.hexdigest(), upload.content_type)
+        return _add_room_file(room_id, upload.name, upload.content_type, upload.user_id, blob_id, upload.size)
+    
+    try:
+        upload, file_info = file_uploads.finish(upload_id, None, commit)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 409
+    
+    response = jsonify({
+        "success": True,
+        "upload_id": upload_id,
+        "offset": upload.size,
+        "size": upload.size,
+        "complete": True,
+        "message": "File uploaded successfully!",
+        "file": file_info
+    })
+    response.headers['Upload-Offset'] = str(upload.size)
+    return response
+
+@chat_bp.route('/<room_id>/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(room_id, upload_id):
+    denied = _room_access_denied(room_id, request.args.get("password"))
+    if denied:
+        return denied
+    
+    try:
+        file_uploads.get(upload_id, None, room=room_id)
+        file_uploads.abort(upload_id, None)
+    except UploadError:
+        return jsonify({"error": "Unknown upload"}), 404
+    return jsonify({"success": True, "message": "Upload cancelled"})
+
+def _room_has_media(room_id, blob_id):
+    """Check whether a message of the room references a socket media blob"""
+    return blob_store.exists(blob_id) and room_id in blob_store.rooms(blob_id)
+
+@chat_bp.route('/<room_id>/media/<blob_id>', methods=['GET'])
+def get_media(room_id, blob_id):
+    client_ip = get_client_ip()
+    password = request.args.get("password")
+    
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        pass
+    elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
+        return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
+    
+    # Blob IDs are content hashes, which could be known outside the room
+    if not _room_has_media(room_id, blob_id):
+        return jsonify({"error": "Media not found"}), 404
+    
+    # Blobs are content-addressed, so the ID is a strong ETag and the bytes never change
+    content_type = blob_store.content_type(blob_id)
+    inline = content_type.startswith(INLINE_TYPES)
+    return send_content_file(blob_store.path(blob_id),
+                             content_type if inline else 'application/octet-stream',
+                             etag=blob_id,
+                             download_name=blob_id,
+                             as_attachment=not inline,
+                             cache_control=f'private, max-age={config.MEDIA_CACHE_MAX_AGE}, immutable')
+
+@chat_bp.route('/<room_id>/media/<blob_id>/<variant>', methods=['GET'])
+def get_media_variant(room_id, blob_id, variant):
+    denied = _room_access_denied(room_id, request.args.get("password"))
+    if denied:
+        return denied
+    
+    if variant not in config.IMAGE_VARIANTS or not _room_has_media(room_id, blob_id):
+        return jsonify({"error": "Media not found"}), 404
+    return _send_variant(blob_store, blob_id, variant, f'private, max-age={config.MEDIA_CACHE_MAX_AGE}, immutable')
+
+def _send_variant(store, blob_id, variant, cache_control):
+    """Serve a rendered image variant, or the original while it is still being rendered"""
+    variant_id = store.variants(blob_id).get(variant)
+    if variant_id is None:
+        cache_control = 'no-store'
+        variant_id = blob_id
+    return send_content_file(store.path(variant_id), store.content_type(variant_id),
+                             etag=variant_id,
+                             download_name=f"{variant}-{variant_id}",
+                             as_attachment=False,
+                             cache_control=cache_control)
+
 @chat_bp.route('/<room_id>/files/<filename>', methods=['GET'])
 def download_file(room_id, filename):
     client_ip = get_client_ip()
@@ -232,19 +566,26 @@ def download_file(room_id, filename):
     if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
     
-    # Find the file in room_files
-    file_info = None
-    if room_id in config.room_files:
-        for file in config.room_files[room_id]:
-            if file['stored_filename'] == filename:
-                file_info = file
-                break
-    
+    file_info = config.room_files[room_id].get(filename) if room_id in config.room_files else None
     if not file_info:
         return jsonify({"error": "File not found"}), 404
     
-    # Return the file
-    return send_file(file_info['path'], as_attachment=True, download_name=file_info['filename'])
+    # The content hash is a strong ETag; the URL names a room entry rather
+    # than the content, so clients revalidate instead of caching blindly
+    return send_content_file(file_info['path'], file_info.get('type') or 'application/octet-stream',
+                             etag=file_info['blob_id'],
+                             download_name=file_info['filename'])
+
+@chat_bp.route('/<room_id>/files/<filename>/<variant>', methods=['GET'])
+def download_file_variant(room_id, filename, variant):
+    denied = _room_access_denied(room_id, request.args.get("password"))
+    if denied:
+        return denied
+    
+    file_info = config.room_files[room_id].get(filename) if room_id in config.room_files else None
+    if not file_info or variant not in file_info.get('variants', {}):
+        return jsonify({"error": "File not found"}), 404
+    return _send_variant(file_store, file_info['blob_id'], variant, 'no-cache')
 
 @chat_bp.route('/<room_id>/files', methods=['GET'])
 def list_files(room_id):
@@ -254,10 +595,37 @@ def list_files(room_id):
     if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
     
+    after = request.args.get("after")
+    limit = request.args.get("limit")
+    paginated = after is not None or limit is not None
+    
+    if paginated:
+        try:
+            limit = int(limit) if limit is not None else config.FILE_PAGE_SIZE
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        limit = min(limit, config.MAX_FILE_PAGE_SIZE)
+    
     if room_id not in config.room_files:
+        if paginated:
+            return jsonify({"files": [], "next_cursor": None, "has_more": False, "total": 0})
         return jsonify([])
     
-    return jsonify(config.room_files[room_id])
+    files = config.room_files[room_id]
+    if not paginated:
+        return jsonify(list(files))
+    
+    if after is not None and not files.valid_cursor(after):
+        return jsonify({"error": "Invalid cursor"}), 400
+    page, next_cursor = files.page(after, limit)
+    return jsonify({
+        "files": page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
+        "total": len(files)
+    })
 
 @chat_bp.route('/<room_id>/files/<filename>', methods=['DELETE'])
 def delete_file(room_id, filename):
@@ -267,25 +635,14 @@ def delete_file(room_id, filename):
     if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
     
-    # Find the file in room_files
-    file_info = None
-    file_index = -1
-    if room_id in config.room_files:
-        for i, file in enumerate(config.room_files[room_id]):
-            if file['stored_filename'] == filename:
-                file_info = file
-                file_index = i
-                break
-    
+    # Remove from room_files
+    file_info = config.room_files[room_id].remove(filename) if room_id in config.room_files else None
     if not file_info:
         return jsonify({"error": "File not found"}), 404
     
-    # Delete the file from storage
+    # Drop the room's reference; the blob is collected once no room uses it
     try:
-        os.remove(file_info['path'])
-        # Remove from room_files
-        if file_index != -1:
-            config.room_files[room_id].pop(file_index)
+        file_store.release(file_info['blob_id'])
         
         # Notify all users in the room about file deletion
         current_app.handle_file_deletion(filename, room_id)
@@ -306,20 +663,37 @@ def search_messages(room_id):
     if not query:
         return jsonify({"error": "Search query is required"}), 400
     
-    if room_id not in config.chat_rooms:
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", config.SEARCH_PAGE_SIZE)), 1), config.MAX_SEARCH_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    
+    if not message_store.has_room(room_id):
         return jsonify([])
     
-    # Search through messages
+    # Look the query up in the room's inverted index; only the hits on
+    # this page are read from the store and decrypted.
+    total, hits = search_index.search(room_id, query, offset, limit)
     results = []
-    for msg in config.chat_rooms[room_id]:
-        if 'message' in msg and query in msg['message'].lower():
-            results.append(msg)
+    for seq, score in hits:
+        stored = message_store.get_by_seq(room_id, seq)
+        if stored is None:
+            continue
+        message = decrypt_message(stored.record)
+        if not isinstance(message, dict):
+            # Undecryptable records come back as they are stored
+            continue
+        message['score'] = round(score, 4)
+        results.append(message)
     
     return jsonify({
         "success": True,
         "query": query,
         "results": results,
-        "result_count": len(results)
+        "result_count": total,
+        "offset": offset,
+        "limit": limit
     })
 
 @chat_bp.route('/<room_id>/messages/<message_id>', methods=['DELETE'])
@@ -331,20 +705,16 @@ def delete_message(room_id, message_id):
     if client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"error": "Access denied! Verify your IP or provide the correct password."}), 401
     
-    if room_id not in config.chat_rooms:
+    if not message_store.has_room(room_id):
         return jsonify({"error": "Room not found"}), 404
     
     # Find the message
-    message_index = -1
-    message = None
-    for i, msg in enumerate(config.chat_rooms[room_id]):
-        if 'id' in msg and msg['id'] == message_id:
-            message = msg
-            message_index = i
-            break
-    
-    if message_index == -1:
+    stored = message_store.get(room_id, message_id)
+    if stored is None:
         return jsonify({"error": "Message not found"}), 404
+    message = decrypt_message(stored.record)
+    if not isinstance(message, dict):
+        message = {}
     
     # Check if user is authorized to delete this message
     # Only the message sender or room admin (whoever has the password) can delete messages
@@ -355,7 +725,18 @@ def delete_message(room_id, message_id):
         return jsonify({"error": "Unauthorized to delete this message"}), 403
     
     # Remove the message
-    removed_message = config.chat_rooms[room_id].pop(message_index)
+    removed = message_store.delete(room_id, message_id)
+    removed_message = removed.record
+    invalidate_decrypted_message(removed_message)
+    if segments.is_sealed(removed_message):
+        # Re-seal its segment without it, so no ciphertext of it is left
+        segments.discard(room_id, [removed.seq])
+    # Its media is no longer served for this room unless another message holds it
+    if isinstance(message.get('media'), dict):
+        blob_store.remove_room(message['media'].get('blob_id'), room_id)
+    read_receipts.forget_message(room_id, removed.seq)
+    search_index.remove(room_id, removed.seq)
+    config.message_reactions.get(room_id, {}).pop(message_id, None)
     
     # Notify all users in the room about message deletion
     current_app.handle_message_deletion(message_id, user_id, is_admin and not is_sender, room_id)
@@ -363,7 +744,9 @@ def delete_message(room_id, message_id):
     return jsonify({
         "success": True, 
         "message": "Message deleted successfully!",
-        "deleted_message": removed_message
+        # Fernet tokens and socket messages are echoed back; AEAD records
+        # (bytes) and segment references have no JSON form
+        "deleted_message": removed_message if isinstance(removed_message, (str, dict)) else None
     })
 
 @chat_bp.route('/<room_id>/messages/mark_read', methods=['POST'])
@@ -388,44 +771,61 @@ def mark_messages_as_read(room_id):
     elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
         return jsonify({"success": False, "error": "Access denied! Verify your IP or provide the correct password."}), 401
     
-    # Initialize room if needed
-    if room_id not in config.message_read_status:
-        config.message_read_status[room_id] = {}
-    
-    # Mark messages as read
-    updated_messages = []
-    
-    for message_id in message_ids:
-        # If message exists in read status
-        if message_id in config.message_read_status[room_id]:
-            # Add user to read_by list if not already there
-            if user_id not in config.message_read_status[room_id][message_id]['read_by']:
-                config.message_read_status[room_id][message_id]['read_by'].append(user_id)
-                updated_messages.append(message_id)
-        
-        # Also update the message in chat_rooms if it exists
-        if room_id in config.chat_rooms:
-            for i, encrypted_message in enumerate(config.chat_rooms[room_id]):
-                message = decrypt_message(encrypted_message)
-                if message.get('id') == message_id:
-                    if 'read_by' not in message:
-                        message['read_by'] = []
-                    if user_id not in message['read_by']:
-                        message['read_by'].append(user_id)
-                        # Re-encrypt and update
-                        config.chat_rooms[room_id][i] = encrypt_message(message)
-                    break
-    
-    # Notify other users about read status change
-    if hasattr(current_app, 'socketio'):
-        current_app.socketio.emit('messages_read', {
-            'room_id': room_id,
-            'message_ids': updated_messages,
-            'read_by': user_id
-        }, room=room_id)
+    # Mark messages as read, ignoring IDs that are not stored in this room.
+    # Other users are notified by the next batched messages_read event.
+    updated_messages = read_receipts.mark_read(room_id, user_id, message_store.get_many(room_id, message_ids),
+                                               broadcast=True)
     
     return jsonify({
         "success": True,
         "updated_messages": updated_messages,
         "message": f"{len(updated_messages)} messages marked as read"
-    }) 
\ No newline at end of file
+    })
+
+@chat_bp.route('/<room_id>/unread', methods=['GET'])
+@token_required
+def get_unread_counts(room_id):
+    client_ip = get_client_ip()
+    password = request.args.get("password")
+    user_id = request.args.get("user_id")
+    
+    # Check if authenticated via token
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        pass  # Allow access if authenticated via token
+    # Otherwise check IP or password
+    elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
+        return jsonify({"success": False, "error": "Access denied! Verify your IP or provide the correct password."}), 401
+    
+    if user_id:
+        return jsonify({
+            "success": True,
+            "user_id": user_id,
+            "unread_count": read_receipts.unread_count(room_id, user_id)
+        })
+    
+    return jsonify({"success": True, "unread_counts": read_receipts.unread_counts(room_id)})
+
+@chat_bp.route('/<room_id>/messages/<message_id>/read_by', methods=['GET'])
+@token_required
+def get_message_readers(room_id, message_id):
+    client_ip = get_client_ip()
+    password = request.args.get("password")
+    
+    # Check if authenticated via token
+    if hasattr(request, 'is_authenticated') and request.is_authenticated and request.authenticated_room == room_id:
+        pass  # Allow access if authenticated via token
+    # Otherwise check IP or password
+    elif client_ip not in config.room_verified_ips.get(room_id, []) and config.room_passwords.get(room_id) != password:
+        return jsonify({"success": False, "error": "Access denied! Verify your IP or provide the correct password."}), 401
+    
+    stored = message_store.get(room_id, message_id)
+    if stored is None:
+        return jsonify({"success": False, "error": "Message not found"}), 404
+    
+    readers = read_receipts.read_by(room_id, stored.seq)
+    return jsonify({
+        "success": True,
+        "message_id": message_id,
+        "read_by": readers,
+        "read_count": len(readers)
+    })
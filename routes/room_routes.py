@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 from utils.helpers import get_client_ip, validate_room_id
 from utils.middleware import rate_limit
+from utils.storage import message_store
+from utils.room_files import room_files_for
 import config
 import traceback
 
@@ -45,17 +47,15 @@ def create_room():
         if room_id not in config.room_verified_ips:
             config.room_verified_ips[room_id] = []
             
-        if room_id not in config.chat_rooms:
-            config.chat_rooms[room_id] = []
+        message_store.create_room(room_id)
             
         if room_id not in config.message_reactions:
             config.message_reactions[room_id] = {}
             
         if room_id not in config.typing_users:
-            config.typing_users[room_id] = []
+            config.typing_users[room_id] = set()
             
-        if room_id not in config.room_files:
-            config.room_files[room_id] = []
+        room_files_for(room_id)
         
         # Add creator's IP to verified IPs
         client_ip = get_client_ip()
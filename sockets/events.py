@@ -1,44 +1,91 @@
-from flask_socketio import emit, join_room, leave_room
+from flask_socketio import emit, join_room, leave_room, rooms as joined_rooms
 from flask import request
 import time
 from utils.helpers import format_date_time
+from utils.storage import message_store
+from utils import read_receipts
+from utils.search_index import search_index, index_terms, is_blind
+from utils.presence import presence
+from utils.typing_indicator import typing_tracker
+from utils.blob_store import blob_store, parse_data_url
+from utils.uploads import media_uploads, UploadError
+from utils.thumbnails import schedule_variants
+from utils.room_files import room_files_for
 import config
 
 def register_socket_events(socketio):
+    def run_every(interval, flush):
+        """Call flush() in a background task every interval seconds"""
+        def loop():
+            while True:
+                socketio.sleep(interval)
+                try:
+                    flush()
+                except Exception as e:
+                    print(f"Error in background flush: {str(e)}")
+        socketio.start_background_task(loop)
+
+    def flush_typing():
+        """Broadcast buffered typing changes as one delta per room"""
+        for room, started, stopped in typing_tracker.flush():
+            socketio.emit('typing_update', {
+                'room': room,
+                'started': started,
+                'stopped': stopped
+            }, room=room)
+
+    def flush_read_receipts():
+        """Broadcast the receipts queued for each room as one messages_read event"""
+        for room, receipts in read_receipts.flush_broadcasts():
+            socketio.emit('messages_read', {
+                'room_id': room,
+                'receipts': receipts
+            }, room=room)
+
+    run_every(1.0 / config.TYPING_FLUSHES_PER_SECOND, flush_typing)
+    run_every(config.READ_RECEIPT_FLUSH_SECONDS, flush_read_receipts)
+
     @socketio.on('join')
     def on_join(data):
         room = data['room']
         user_id = data['user_id']
         
-        config.user_socket_map[user_id] = request.sid
-        
-        if room not in config.chat_rooms:
-            config.chat_rooms[room] = []
-        if room not in config.online_users:
-            config.online_users[room] = set()
+        message_store.create_room(room)
         if room not in config.message_reactions:
             config.message_reactions[room] = {}
         if room not in config.typing_users:
             config.typing_users[room] = set()
-        if room not in config.room_files:
-            config.room_files[room] = []
+        files = room_files_for(room)
         
         join_room(room)
-        config.online_users[room].add(user_id)
+        first_tab = presence.join(request.sid, user_id, room)
         
         emit('online_count', {
             'room': room,
             'count': len(config.online_users[room])
         }, room=room, broadcast=True)
         
-        emit('status', {
-            'msg': f'👋 {user_id} has joined the room'
-        }, room=room, broadcast=True)
+        # Opening another tab does not announce the user again
+        if first_tab:
+            emit('status', {
+                'msg': f'👋 {user_id} has joined the room'
+            }, room=room, broadcast=True)
         
-        # Send list of files in the room
+        # Send the first page of the room's files; the rest is fetched
+        # with files_page
+        page, next_cursor = files.page(limit=config.FILE_PAGE_SIZE)
         emit('files_list', {
             'room': room,
-            'files': config.room_files[room]
+            'files': page,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None,
+            'total': len(files)
+        }, room=request.sid)
+        
+        # Later typing changes arrive as typing_update deltas
+        emit('typing_status', {
+            'room': room,
+            'typing_users': list(config.typing_users[room])
         }, room=request.sid)
 
     @socketio.on('leave')
@@ -46,10 +93,10 @@ def register_socket_events(socketio):
         room = data['room']
         user_id = data['user_id']
         
-        if room in config.online_users:
-            config.online_users[room].discard(user_id)
-            if user_id in config.typing_users.get(room, set()):
-                config.typing_users[room].discard(user_id)
+        leave_room(room)
+        # The user stays in the room while another of their tabs is still in it
+        if presence.leave(request.sid, user_id, room):
+            typing_tracker.remove(room, user_id)
             
             emit('online_count', {
                 'room': room,
@@ -60,103 +107,191 @@ def register_socket_events(socketio):
                 'msg': f'👋 {user_id} has left the room'
             }, room=room, broadcast=True)
 
+    @socketio.on('files_page')
+    def handle_files_page(data):
+        """Return the next page of a joined room's files, after the cursor from files_list"""
+        room = data.get('room')
+        if room not in joined_rooms() or room not in config.room_files:
+            return {"status": "error", "message": "Join the room first"}
+        try:
+            limit = min(max(int(data.get('limit') or config.FILE_PAGE_SIZE), 1), config.MAX_FILE_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return {"status": "error", "message": "limit must be an integer"}
+        
+        files = config.room_files[room]
+        page, next_cursor = files.page(data.get('after'), limit)
+        return {
+            "status": "success",
+            "files": page,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+            "total": len(files)
+        }
+
     @socketio.on('disconnect')
     def handle_disconnect():
-        user_id = None
-        for uid, sid in config.user_socket_map.items():
-            if sid == request.sid:
-                user_id = uid
-                break
-        
-        if user_id:
-            for room in list(config.online_users.keys()):
-                if user_id in config.online_users[room]:
-                    config.online_users[room].discard(user_id)
-                    if user_id in config.typing_users.get(room, set()):
-                        config.typing_users[room].discard(user_id)
-                    
-                    emit('online_count', {
-                        'room': room,
-                        'count': len(config.online_users[room])
-                    }, room=room, broadcast=True)
-                    
-                    emit('status', {
-                        'msg': f'👋 {user_id} has disconnected'
-                    }, room=room, broadcast=True)
+        # Only the rooms this socket's user went offline in are visited
+        user_id, rooms = presence.disconnect(request.sid)
+        
+        for room in rooms:
+            typing_tracker.remove(room, user_id)
             
-            del config.user_socket_map[user_id]
+            emit('online_count', {
+                'room': room,
+                'count': len(config.online_users[room])
+            }, room=room, broadcast=True)
+            
+            emit('status', {
+                'msg': f'👋 {user_id} has disconnected'
+            }, room=room, broadcast=True)
 
-    @socketio.on('message')
-    def handle_message(data):
-        room = data['room']
-        user_id = data['user_id']
-        message = data['message']
-        media = data.get('media', None)
-        
-        if room not in config.chat_rooms:
-            config.chat_rooms[room] = []
-        
+    def post_message(room, user_id, message, media_info=None):
+        """Store a message (with an optional blob store media reference) and broadcast it"""
         # Get user info
         username = config.user_profiles.get(user_id, {}).get('username', user_id)
         
         formatted_date, formatted_time = format_date_time()
         
-        message_id = f"msg_{int(time.time() * 1000)}"
+        timestamp = int(time.time() * 1000)
+        message_id = f"msg_{timestamp}"
         
         message_data = {
             "id": message_id,
             "user_id": user_id,
             "username": username,
             "message": message,
-            "timestamp": int(time.time() * 1000),
+            "timestamp": timestamp,
             "date": formatted_date,
             "time": formatted_time
         }
+        if media_info:
+            message_data["media"] = media_info
+        
+        # Search terms come from the plaintext before it is encrypted; blind
+        # tokens are stored next to the ciphertext
+        terms = index_terms(message)
+        seq = message_store.append(room, message_id, timestamp, message_data,
+                                   search_tokens=terms if is_blind() else None)
+        search_index.add(room, seq, terms)
+        
+        # Sender has automatically seen the message
+        read_receipts.mark_read(room, user_id, message_store.get_many(room, [message_id]))
+        
+        if media_info:
+            print(f"Sending media message to room {room}: {media_info['type']}")
+        
+        emit('message', message_data, room=room, broadcast=True)
+        return message_id
+
+    def media_reference(room, blob_id, size, content_type, name):
+        # The media route only serves blobs referenced from the requested room
+        blob_store.add_room(blob_id, room)
+        media_info = {
+            "blob_id": blob_id,
+            "size": size,
+            "type": content_type,
+            "name": name,
+            "url": f"/chat/{room}/media/{blob_id}"
+        }
+        # Images get downscaled variants, rendered in the background
+        variants = schedule_variants(blob_store, blob_id, content_type)
+        if variants:
+            media_info["variants"] = {variant: f"/chat/{room}/media/{blob_id}/{variant}" for variant in variants}
+        return media_info
+
+    @socketio.on('message')
+    def handle_message(data):
+        room = data['room']
+        user_id = data['user_id']
+        message = data['message']
+        media = data.get('media', None)
+        
+        if message is not None and not isinstance(message, str):
+            return {"status": "error", "message": "message must be a string"}
         
-        # Add media data if present
-        has_media = False
+        # Small inline media (a data URL) is still accepted; larger files
+        # go through media_begin/media_chunk/media_end. Either way the bytes
+        # are written once to the blob store and the message references them.
+        media_info = None
         if media:
             try:
-                print(f"Received media message from {user_id}: {media['type']}, size: {len(media['data'])}")
-                message_data["media"] = {
-                    "type": media["type"],
-                    "data": media["data"],
-                    "name": media["name"]
-                }
-                has_media = True
+                data_type, content = parse_data_url(media["data"])
+                content_type = media.get("type") or data_type
+                blob_id, size = blob_store.put(content, content_type)
+                print(f"Received media message from {user_id}: {content_type}, size: {size}")
+                media_info = media_reference(room, blob_id, size, content_type, media.get("name"))
             except Exception as e:
                 print(f"Error processing media: {str(e)}")
                 return {"status": "error", "message": f"Failed to process media: {str(e)}"}
         
-        config.chat_rooms[room].append(message_data)
-        
-        # Verify media data is in the message before sending
-        if has_media:
-            print(f"Sending media message to room {room}: {message_data['media']['type']}")
-        
-        emit('message', message_data, room=room, broadcast=True)
+        message_id = post_message(room, user_id, message, media_info)
         
         # Send acknowledgment back to the sender
         return {"status": "success", "message_id": message_id}
 
+    @socketio.on('media_begin')
+    def handle_media_begin(data):
+        """Start a chunked media upload, or resume one after a reconnect by passing its upload_id"""
+        try:
+            upload = media_uploads.begin(data['room'], data['user_id'], data.get('type'), data.get('name'),
+                                         data.get('size'), upload_id=data.get('upload_id'))
+        except (KeyError, UploadError) as e:
+            return {"status": "error", "message": str(e)}
+        
+        # offset tells a resuming client where to continue
+        return {
+            "status": "success",
+            "upload_id": upload.upload_id,
+            "offset": upload.received,
+            "chunk_size": config.MEDIA_CHUNK_SIZE
+        }
+
+    @socketio.on('media_chunk')
+    def handle_media_chunk(data):
+        """Append one binary chunk; the ack carries the offset of the next expected byte"""
+        try:
+            offset = media_uploads.write(data['upload_id'], data['user_id'], data.get('offset'), data.get('data'))
+        except (KeyError, UploadError) as e:
+            return {"status": "error", "message": str(e)}
+        return {"status": "success", "offset": offset}
+
+    def commit_media(upload):
+        return blob_store.put_file(upload.path, upload.sha256.hexdigest(), upload.content_type)
+
+    @socketio.on('media_end')
+    def handle_media_end(data):
+        """Commit a finished upload to the blob store and post it as a message"""
+        # Checked before committing, so the upload can still be finished with a valid caption
+        message = data.get('message', '')
+        if message is not None and not isinstance(message, str):
+            return {"status": "error", "message": "message must be a string"}
+        
+        try:
+            upload, blob_id = media_uploads.finish(data['upload_id'], data['user_id'], commit_media)
+        except (KeyError, UploadError) as e:
+            return {"status": "error", "message": str(e)}
+        
+        print(f"Received media upload from {upload.user_id}: {upload.content_type}, size: {upload.size}")
+        media_info = media_reference(upload.room, blob_id, upload.size, upload.content_type, upload.name)
+        message_id = post_message(upload.room, upload.user_id, message, media_info)
+        return {"status": "success", "message_id": message_id, "blob_id": blob_id}
+
+    @socketio.on('media_abort')
+    def handle_media_abort(data):
+        try:
+            media_uploads.abort(data['upload_id'], data['user_id'])
+        except (KeyError, UploadError) as e:
+            return {"status": "error", "message": str(e)}
+        return {"status": "success"}
+
     @socketio.on('typing')
     def handle_typing(data):
         room = data['room']
         user_id = data['user_id']
-        is_typing = data['is_typing']
-        
-        if room not in config.typing_users:
-            config.typing_users[room] = set()
-        
-        if is_typing:
-            config.typing_users[room].add(user_id)
-        else:
-            config.typing_users[room].discard(user_id)
+        is_typing = data.get('is_typing', True)
         
-        emit('typing_status', {
-            'room': room,
-            'typing_users': list(config.typing_users[room])
-        }, room=room)
+        # Only buffered here; the flusher broadcasts the changes
+        typing_tracker.update(room, user_id, is_typing)
 
     @socketio.on('reaction')
     def handle_reaction(data):
@@ -165,6 +300,10 @@ def register_socket_events(socketio):
         user_id = data['user_id']
         reaction = data['reaction']
         
+        # Ignore reactions to messages that do not exist (or were deleted)
+        if message_store.get(room, message_id) is None:
+            return {"status": "error", "message": "Message not found"}
+        
         if room not in config.message_reactions:
             config.message_reactions[room] = {}
         
@@ -199,14 +338,6 @@ def register_socket_events(socketio):
             "is_admin_delete": is_admin_delete
         }, room=room)
 
-    # Function to emit messages_read event (called from chat_routes.py)
-    def emit_messages_read(room_id, message_ids, user_id):
-        socketio.emit('messages_read', {
-            "room_id": room_id,
-            "message_ids": message_ids,
-            "read_by": user_id
-        }, room=room_id)
-
     @socketio.on('mark_read')
     def handle_mark_read(data):
         room = data['room']
@@ -216,42 +347,10 @@ def register_socket_events(socketio):
         if not room or not user_id or not message_ids or not isinstance(message_ids, list):
             return {"status": "error", "message": "Invalid input"}
         
-        # Initialize room if needed
-        if room not in config.message_read_status:
-            config.message_read_status[room] = {}
-        
-        updated_messages = []
-        
-        for message_id in message_ids:
-            # Update read status tracking
-            if message_id not in config.message_read_status[room]:
-                config.message_read_status[room][message_id] = {
-                    'read_by': [user_id],
-                    'timestamp': int(time.time() * 1000)
-                }
-                updated_messages.append(message_id)
-            elif user_id not in config.message_read_status[room][message_id]['read_by']:
-                config.message_read_status[room][message_id]['read_by'].append(user_id)
-                updated_messages.append(message_id)
-            
-            # Update the actual message in chat_rooms if it exists
-            if room in config.chat_rooms:
-                for i, message in enumerate(config.chat_rooms[room]):
-                    if isinstance(message, dict) and message.get('id') == message_id:
-                        if 'read_by' not in message:
-                            message['read_by'] = []
-                        if user_id not in message['read_by']:
-                            message['read_by'].append(user_id)
-                        # No need to encrypt since we're updating the message object directly
-                        break
-        
-        # Notify everyone that messages have been read
-        if updated_messages:
-            emit('messages_read', {
-                'room_id': room,
-                'message_ids': updated_messages,
-                'read_by': user_id
-            }, room=room, broadcast=True)
+        # Read state is tracked outside the stored messages, which stay untouched.
+        # The room is notified by the next batched messages_read event.
+        updated_messages = read_receipts.mark_read(room, user_id, message_store.get_many(room, message_ids),
+                                                   broadcast=True)
         
         return {"status": "success", "updated_messages": updated_messages}
 
@@ -259,6 +358,5 @@ def register_socket_events(socketio):
     return {
         'emit_file_uploaded': emit_file_uploaded,
         'emit_file_deleted': emit_file_deleted,
-        'emit_message_deleted': emit_message_deleted,
-        'emit_messages_read': emit_messages_read
+        'emit_message_deleted': emit_message_deleted
     } 
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import itertools
+import importlib.util
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config reads these at import time, so they are set before anything loads it
+os.environ.setdefault("DATA_FOLDER", tempfile.mkdtemp(prefix="secure-chat-tests-"))
+os.environ.setdefault("ENCRYPTION_KEY", "kR3mT5VLqkH1VwFQ0b5w3dNq3rOtoqv2yqXlr2m0cI4=")
+sys.path.insert(0, ROOT)
+
+_room_ids = itertools.count(10000)
+
+
+def _load_app():
+    # app.py sits next to the app/ package, so it is loaded by path
+    spec = importlib.util.spec_from_file_location("chat_app", os.path.join(ROOT, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+@pytest.fixture(scope="session")
+def app():
+    return _load_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def room(client):
+    """A fresh room, returned as (room_id, password)"""
+    room_id = str(next(_room_ids))
+    client.post('/room/create', json={'room_id': room_id, 'password': 'password123'})
+    return room_id, 'password123'
@@ -0,0 +1,70 @@
+import io
+import json
+import pytest
+import config
+from utils import admin_jobs
+from utils.blob_store import RefCountedBlobStore
+from utils.jobs import Job, JobQueue
+
+
+def _add(store, data):
+    tmp_path, blob_id, _ = store.spool(io.BytesIO(data))
+    return store.add_file(tmp_path, blob_id, 'text/plain')
+
+
+def test_refcounts_survive_a_restart(tmp_path):
+    store = RefCountedBlobStore(str(tmp_path), 3600)
+    shared = _add(store, b'shared')
+    _add(store, b'shared')
+    unused = _add(store, b'unused')
+    store.release(unused)
+
+    restarted = RefCountedBlobStore(str(tmp_path), 3600)
+    assert restarted.refcount(shared) == 2
+    # Garbage left by the previous run is still collected
+    assert restarted.collect() == 1
+    assert restarted.exists(shared) and not restarted.exists(unused)
+
+
+class Crash(Exception):
+    pass
+
+
+def test_resumed_purge_never_releases_a_file_twice(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'JOB_BATCH_SIZE', 1)
+    store = RefCountedBlobStore(str(tmp_path / 'blobs'), 3600)
+    first, second = _add(store, b'first'), _add(store, b'second')
+    _add(store, b'first')  # Another room still holds the first file
+
+    # The job stops on the second release, as if the process died there
+    queue = JobQueue(str(tmp_path / 'jobs.json'), 1)
+    job = Job('clear_chat', {"blob_ids": [first, second]})
+    job._queue = queue
+    queue._jobs[job.job_id] = job
+
+    release = store.release
+
+    def release_then_crash(blob_id):
+        if blob_id == second:
+            raise Crash()
+        release(blob_id)
+
+    monkeypatch.setattr(admin_jobs, 'file_store', store)
+    monkeypatch.setattr(store, 'release', release_then_crash)
+    with pytest.raises(Crash):
+        admin_jobs._release_files(job, job.params['blob_ids'])
+
+    # After the restart the counts come from disk and the job from the journal
+    restarted = RefCountedBlobStore(str(tmp_path / 'blobs'), 3600)
+    monkeypatch.setattr(admin_jobs, 'file_store', restarted)
+    resumed_queue = JobQueue(str(tmp_path / 'jobs.json'), 1)
+    with open(resumed_queue.journal_path) as f:
+        resumed = Job.from_dict(json.load(f)[0])
+    resumed._queue = resumed_queue
+    resumed_queue._jobs[resumed.job_id] = resumed
+    admin_jobs._release_files(resumed, resumed.params['blob_ids'])
+
+    assert restarted.refcount(first) == 1
+    restarted.collect()
+    assert restarted.exists(first)
+
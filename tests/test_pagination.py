@@ -0,0 +1,83 @@
+from utils.storage import message_store
+from utils.helpers import encrypt_message
+from utils.room_files import RoomFiles
+
+
+def _walk(client, room_id, password, direction, limit=4):
+    """Follow next_cursor through a room's history, returning the message texts in the order read"""
+    seen, cursor = [], None
+    while True:
+        url = f'/chat/{room_id}/messages?password={password}&limit={limit}'
+        if cursor:
+            url += f'&{direction}={cursor}'
+        elif direction == 'after':
+            url += '&after=0'
+        page = client.get(url).json
+        texts = [message['message'] for message in page['messages']]
+        seen += texts if direction == 'after' else texts[::-1]
+        cursor = page['next_cursor']
+        if not cursor:
+            return seen
+
+
+def test_message_cursors_survive_duplicate_ids(client, room):
+    room_id, password = room
+    # Messages sent within the same millisecond share their ID
+    for i in range(23):
+        message_id = str(1000 + i // 3)
+        message_store.append(room_id, message_id, 1000 + i // 3,
+                             encrypt_message({'id': message_id, 'message': f'm{i}'}, room_id))
+
+    expected = [f'm{i}' for i in range(23)]
+    assert _walk(client, room_id, password, 'after') == expected
+    assert _walk(client, room_id, password, 'before') == expected[::-1]
+
+
+def test_message_id_is_still_accepted_as_a_cursor(client, room):
+    room_id, password = room
+    for i in range(5):
+        message_store.append(room_id, f'id{i}', 1000 + i, encrypt_message({'id': f'id{i}', 'message': f'm{i}'}, room_id))
+
+    page = client.get(f'/chat/{room_id}/messages?password={password}&limit=2&before=id3').json
+    assert [message['message'] for message in page['messages']] == ['m1', 'm2']
+    assert page['next_cursor'].startswith('seq:')
+
+    response = client.get(f'/chat/{room_id}/messages?password={password}&limit=2&before=seq:x')
+    assert response.status_code == 400
+
+
+def _files(count):
+    files = RoomFiles()
+    for i in range(count):
+        files.add({'id': f'file_{i}', 'stored_filename': f'{i}_a.txt', 'blob_id': None})
+    return files
+
+
+def test_file_cursor_survives_deleting_its_file():
+    files = _files(10)
+    page, cursor = files.page(None, 3)
+    assert [entry['id'] for entry in page] == ['file_0', 'file_1', 'file_2']
+
+    # Remove the file the cursor names, and enough others to compact the list
+    for i in (2, 0, 1, 3, 4, 5, 6):
+        files.remove(f'{i}_a.txt')
+
+    page, cursor = files.page(cursor, 2)
+    assert [entry['id'] for entry in page] == ['file_7', 'file_8']
+    page, cursor = files.page(cursor, 2)
+    assert [entry['id'] for entry in page] == ['file_9']
+    assert cursor is None
+
+
+def test_files_route_pages_past_a_deleted_file(client, room):
+    room_id, password = room
+    from utils.room_files import room_files_for
+    files = room_files_for(room_id)
+    for i in range(4):
+        files.add({'id': f'file_{i}', 'stored_filename': f'{i}_a.txt', 'blob_id': None})
+
+    first = client.get(f'/chat/{room_id}/files?password={password}&limit=2').json
+    files.remove('1_a.txt')
+    second = client.get(f'/chat/{room_id}/files?password={password}&limit=2&after={first["next_cursor"]}')
+    assert second.status_code == 200
+    assert [entry['id'] for entry in second.json['files']] == ['file_2', 'file_3']
@@ -0,0 +1,60 @@
+import pytest
+import config
+from utils import read_receipts
+from utils.storage import MemoryMessageStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = MemoryMessageStore()
+    monkeypatch.setattr(read_receipts, 'message_store', store)
+    monkeypatch.setattr(config, 'read_cursors', {})
+    monkeypatch.setattr(config, 'read_exceptions', {})
+    for i in range(1000):
+        store.append('room', f'm{i}', i, 'x')
+    return store
+
+
+def test_newest_first_pages_collapse_into_one_range(store):
+    before = None
+    for _ in range(10):
+        page = store.range('room', before_seq=before, limit=50, newest_first=True)
+        read_receipts.mark_read('room', 'reader', page)
+        before = page[-1].seq
+
+    assert config.read_exceptions['room']['reader'] == [[501, 1000]]
+    assert read_receipts.unread_count('room', 'reader') == 500
+    assert read_receipts.has_read('room', 'reader', 750)
+    assert not read_receipts.has_read('room', 'reader', 500)
+
+
+def test_cursor_takes_over_ranges_once_the_gap_is_read(store):
+    read_receipts.mark_read('room', 'reader', store.range('room', after_seq=10, before_seq=21))
+    assert config.read_cursors['room']['reader'] == 0
+
+    read_receipts.mark_read('room', 'reader', store.range('room', before_seq=11))
+    assert config.read_cursors['room']['reader'] == 20
+    assert 'reader' not in config.read_exceptions['room']
+
+
+def test_ranges_merge_across_deleted_messages(store):
+    read_receipts.mark_read('room', 'reader', store.range('room', after_seq=100, before_seq=105))
+    store.delete('room', 'm104')  # seq 105
+    read_receipts.mark_read('room', 'reader', store.range('room', after_seq=105, before_seq=110))
+    assert config.read_exceptions['room']['reader'] == [[101, 109]]
+
+
+def test_marking_read_messages_again_reports_nothing_new(store):
+    page = store.range('room', after_seq=500, limit=5)
+    assert read_receipts.mark_read('room', 'reader', page) == [stored.message_id for stored in page]
+    assert read_receipts.mark_read('room', 'reader', page) == []
+
+
+def test_ranges_are_capped(store, monkeypatch):
+    monkeypatch.setattr(config, 'READ_RANGES_MAX', 3)
+    for seq in (100, 200, 300, 400, 500):
+        read_receipts.mark_read('room', 'reader', store.range('room', after_seq=seq - 1, before_seq=seq + 1))
+
+    assert len(config.read_exceptions['room']['reader']) == 3
+    # The oldest ranges were folded into the cursor
+    assert config.read_cursors['room']['reader'] == 200
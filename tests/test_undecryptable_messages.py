@@ -0,0 +1,35 @@
+import pytest
+from utils.storage import message_store
+
+
+@pytest.fixture
+def damaged_room(client, room):
+    """A room with three messages, the first two of which no key can decrypt"""
+    room_id, password = room
+    for i in range(3):
+        client.post(f'/chat/{room_id}', json={'password': password, 'user_id': 'bob', 'message': f'm{i}'})
+    stored = message_store.range(room_id)
+    message_store.swap_record(room_id, stored[0].seq, stored[0].record, 'gAAAAAunknownkey')
+    message_store.swap_record(room_id, stored[1].seq, stored[1].record, b'\x01\x00\x00\x00\x63broken')
+    return room_id, password, stored
+
+
+@pytest.mark.parametrize('query', ['', '&user_id=bob', '&user_id=amy'])
+def test_history_lists_undecryptable_messages_as_errors(client, damaged_room, query):
+    room_id, password, stored = damaged_room
+    response = client.get(f'/chat/{room_id}/messages?password={password}{query}')
+
+    assert response.status_code == 200
+    messages = response.json
+    assert messages[0] == {"id": stored[0].message_id, "timestamp": stored[0].timestamp, "error": "undecryptable"}
+    assert messages[1]["error"] == "undecryptable"
+    assert messages[2]["message"] == 'm2'
+
+
+def test_paged_history_keeps_undecryptable_messages_in_place(client, damaged_room):
+    room_id, password, _ = damaged_room
+    response = client.get(f'/chat/{room_id}/messages?password={password}&user_id=amy&limit=2')
+
+    assert response.status_code == 200
+    assert [message.get('error') for message in response.json['messages']] == ['undecryptable', None]
+    assert response.json['has_more']
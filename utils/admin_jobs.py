@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import tempfile
+from collections import Counter
+import config
+from utils.jobs import job_queue
+from utils.storage import message_store
+from utils.helpers import encrypt_messages, decrypt_messages, invalidate_decrypted_message
+from utils.ciphers import room_keys, is_encrypted, decryption_keys
+from utils.crypto_pool import run_batched, rotate_records
+from utils.key_ring import key_ring
+from utils.compression import CODECS, room_dictionaries, train
+from utils import read_receipts
+from utils.search_index import search_index
+from utils.typing_indicator import typing_tracker
+from utils.blob_store import blob_store, file_store
+from utils.room_files import RoomFiles
+from utils.export import export_chunks
+from utils import segments
+
+
+def _last_seq(room_id):
+    newest = message_store.range(room_id, limit=1, newest_first=True)
+    return newest[0].seq if newest else 0
+
+
+def _purge_messages(job, room_id, through_seq):
+    """Delete a room's messages up to through_seq in batches, dropping them from the cache"""
+    while True:
+        batch = message_store.range(room_id, before_seq=through_seq + 1, limit=config.JOB_BATCH_SIZE)
+        if not batch:
+            return
+        media = Counter()
+        for stored in batch:
+            invalidate_decrypted_message(stored.record)
+            if isinstance(stored.record, dict) and isinstance(stored.record.get('media'), dict):
+                media[stored.record['media'].get('blob_id')] += 1
+        message_store.delete_through(room_id, batch[-1].seq)
+        segments.discard_through(room_id, batch[-1].seq)
+        # Socket media of the purged messages is no longer served for this room
+        for blob_id, count in media.items():
+            blob_store.remove_room(blob_id, room_id, count)
+        job.checkpoint(job.done + len(batch))
+
+
+def _release_files(job, blob_ids):
+    """Drop the file store references of removed room files, continuing after the last batch released.
+
+    Each batch is checkpointed before it is released, so a resumed job never
+    releases a file twice; a crash in between leaves that batch referenced,
+    which only keeps its blobs on disk.
+    """
+    released = job.state.get('files_released', 0)
+    for start in range(released, len(blob_ids), config.JOB_BATCH_SIZE):
+        batch = blob_ids[start:start + config.JOB_BATCH_SIZE]
+        job.checkpoint(job.done + len(batch), files_released=start + len(batch))
+        for blob_id in batch:
+            file_store.release(blob_id)
+
+
+def _submit_purge(kind, room_id, files):
+    blob_ids = [file_info['blob_id'] for file_info in files]
+    through_seq = _last_seq(room_id)
+    total = message_store.count(room_id) + len(blob_ids)
+    return job_queue.submit(kind, {"room_id": room_id, "through_seq": through_seq, "blob_ids": blob_ids},
+                            total=total)
+
+
+def start_delete_room(room_id):
+    """Make a room unreachable right away and queue the removal of its history and files"""
+    config.room_verified_ips.pop(room_id, None)
+    config.room_passwords.pop(room_id, None)
+    config.message_reactions.pop(room_id, None)
+    typing_tracker.drop_room(room_id)
+    read_receipts.forget_room(room_id)
+    search_index.drop_room(room_id)
+
+    # Files are shared by content across rooms: only this room's references
+    # are dropped, and the collector deletes blobs nobody uses any more
+    files = config.room_files.pop(room_id, None) or ()
+    return _submit_purge('delete_room', room_id, files)
+
+
+def start_clear_chat(room_id, files=False):
+    """Reset a room's read state and reactions and queue the removal of its history (and files)"""
+    read_receipts.forget_room(room_id)
+    search_index.drop_room(room_id)
+    if room_id in config.message_reactions:
+        config.message_reactions[room_id] = {}
+
+    removed = ()
+    if files and room_id in config.room_files:
+        removed, config.room_files[room_id] = config.room_files[room_id], RoomFiles()
+    return _submit_purge('clear_chat', room_id, removed)
+
+
+@job_queue.register('clear_chat')
+def clear_chat(job):
+    room_id = job.params['room_id']
+    _purge_messages(job, room_id, job.params['through_seq'])
+    _release_files(job, job.params['blob_ids'])
+    # Dictionaries hold samples of the cleared history; they go unless a
+    # message sent meanwhile was compressed with them
+    if not message_store.count(room_id):
+        room_dictionaries.forget_room(room_id)
+    # Messages being purged may have been indexed again by a search in the
+    # meantime; the index is rebuilt from what is left on next use
+    search_index.drop_room(room_id)
+    return {"room_id": room_id}
+
+
+@job_queue.register('delete_room')
+def delete_room(job):
+    room_id = job.params['room_id']
+    _purge_messages(job, room_id, job.params['through_seq'])
+    _release_files(job, job.params['blob_ids'])
+    # Keep the room if it was created again while the job ran; otherwise its
+    # data keys go too, so no copy of its history can be decrypted any more
+    if room_id not in config.room_passwords and not message_store.count(room_id):
+        message_store.drop_room(room_id)
+        segments.forget_room(room_id)
+        room_keys.forget_room(room_id)
+        room_dictionaries.forget_room(room_id)
+    search_index.drop_room(room_id)
+    return {"room_id": room_id}
+
+
+def start_reencrypt(room_id):
+    """Queue re-encryption of a room's stored messages with the current cipher suite and key"""
+    return job_queue.submit('reencrypt', {"room_id": room_id, "through_seq": _last_seq(room_id)},
+                            total=message_store.count(room_id))
+
+
+@job_queue.register('reencrypt')
+def reencrypt(job):
+    room_id = job.params['room_id']
+    after_seq = job.state.get('after_seq')
+    reencrypted = job.state.get('reencrypted', 0)
+    while True:
+        batch = message_store.range(room_id, after_seq=after_seq, before_seq=job.params['through_seq'] + 1,
+                                    limit=config.JOB_BATCH_SIZE)
+        if not batch:
+            break
+        # Socket messages are stored as plain dicts and are left alone
+        encrypted = [stored for stored in batch if is_encrypted(stored.record)]
+        messages = decrypt_messages([stored.record for stored in encrypted], use_cache=False)
+        readable = [(stored, message) for stored, message in zip(encrypted, messages)
+                    if message is not stored.record]  # Not readable with the current key
+        tokens = encrypt_messages([message for _, message in readable], room_id)
+        for (stored, _), token in zip(readable, tokens):
+            if message_store.swap_record(room_id, stored.seq, stored.record, token):
+                invalidate_decrypted_message(stored.record)
+                reencrypted += 1
+        after_seq = batch[-1].seq
+        job.checkpoint(job.done + len(batch), after_seq=after_seq, reencrypted=reencrypted)
+    # Sealed messages are re-encrypted a segment at a time
+    resealed, _ = segments.reseal(room_id)
+    return {"room_id": room_id, "reencrypted": reencrypted, "segments": resealed}
+
+
+def start_key_rotation():
+    """Make a new primary key and queue the sweep that moves stored messages onto it"""
+    key_id = key_ring.rotate()
+    # Also covers keys of an earlier sweep that has not finished yet
+    retiring = key_ring.rotating_ids()
+    rooms = message_store.rooms()
+    return job_queue.submit('rotate_keys', {"key_id": key_id, "retire": retiring},
+                            total=sum(message_store.count(room_id) for room_id in rooms))
+
+
+@job_queue.register('rotate_keys')
+def rotate_keys(job):
+    # Room data keys and compression dictionaries only need re-wrapping;
+    # AEAD records themselves are untouched
+    if not job.state.get('rewrapped'):
+        room_keys.rewrap()
+        room_dictionaries.reencrypt()
+        job.checkpoint(job.done, rewrapped=True)
+
+    # Rooms are walked in sorted order so the sweep can resume after the
+    # last room it finished; rooms created since then already use the new key
+    current_room = job.state.get('room_id')
+    after_seq = job.state.get('after_seq')
+    rotated = job.state.get('rotated', 0)
+    # Records no current key decrypts were unreadable before the rotation;
+    # retiring the old keys loses nothing, so they are only reported
+    unreadable = job.state.get('unreadable', [])
+    ops_per_second = max(config.KEY_ROTATION_OPS_PER_SECOND, 1)
+    batch_size = min(config.JOB_BATCH_SIZE, ops_per_second)
+    for room_id in sorted(message_store.rooms()):
+        if current_room is not None and room_id < current_room:
+            continue
+        if room_id != current_room:
+            current_room, after_seq = room_id, None
+        while True:
+            started = time.monotonic()
+            batch = message_store.range(room_id, after_seq=after_seq, limit=batch_size)
+            if not batch:
+                break
+            # Only Fernet tokens depend on the key ring; socket messages are plain dicts
+            tokens = [stored for stored in batch if isinstance(stored.record, str)]
+            records = run_batched(rotate_records, [stored.record for stored in tokens],
+                                  decryption_keys([]))
+            for stored, record in zip(tokens, records):
+                if record is None:
+                    if len(unreadable) < config.KEY_ROTATION_REPORTED_UNREADABLE:
+                        unreadable.append({"room_id": room_id, "seq": stored.seq})
+                elif message_store.swap_record(room_id, stored.seq, stored.record, record):
+                    invalidate_decrypted_message(stored.record)
+                    rotated += 1
+            after_seq = batch[-1].seq
+            job.checkpoint(job.done + len(batch), room_id=room_id, after_seq=after_seq, rotated=rotated,
+                           unreadable=unreadable)
+            # Hold the sweep to its budget so it does not compete with live traffic
+            time.sleep(max(0.0, len(batch) / ops_per_second - (time.monotonic() - started)))
+        # Segments are re-sealed once the room's rows are done; each counts as one operation
+        started = time.monotonic()
+        resealed, unreadable_segments = segments.reseal(room_id, fernet_only=True)
+        time.sleep(max(0.0, (resealed + unreadable_segments) / ops_per_second - (time.monotonic() - started)))
+
+    # Every stored token any current key can read now uses the new primary key
+    key_ring.retire(job.params['retire'])
+    return {"key_id": job.params['key_id'], "rotated": rotated, "unreadable": unreadable,
+            "retired": job.params['retire']}
+
+
+_sealing = set()  # Rooms with a segment sealing job queued
+
+
+def maybe_seal_segments(room_id, record):
+    """Count a newly stored record and queue sealing once a full segment of messages is waiting"""
+    if not segments.note_append(room_id, record) or room_id in _sealing:
+        return None
+    _sealing.add(room_id)
+    return job_queue.submit('seal_segments', {"room_id": room_id})
+
+
+@job_queue.register('seal_segments')
+def seal_segments(job):
+    # Sealing rereads the store, so a resumed job simply starts over
+    room_id = job.params['room_id']
+    try:
+        sealed = segments.seal_pending(room_id)
+    finally:
+        _sealing.discard(room_id)
+    return {"room_id": room_id, "segments": sealed}
+
+
+_training = set()  # Rooms with a dictionary training job queued
+
+
+def maybe_train_dictionary(room_id):
+    """Queue training of a room's compression dictionary once it has enough messages"""
+    codec = CODECS.get(config.MESSAGE_COMPRESSION)
+    if codec is None or room_id in _training:
+        return None
+    current = room_dictionaries.current(room_id)
+    if current is not None and current[1] == codec:
+        return None
+    if message_store.count(room_id) < config.COMPRESSION_DICT_MIN_MESSAGES:
+        return None
+    _training.add(room_id)
+    return job_queue.submit('train_dictionary', {"room_id": room_id, "codec": config.MESSAGE_COMPRESSION})
+
+
+@job_queue.register('train_dictionary')
+def train_dictionary(job):
+    room_id = job.params['room_id']
+    try:
+        if not message_store.has_room(room_id):
+            return {"room_id": room_id, "dictionary_id": None}
+        newest = message_store.range(room_id, limit=config.COMPRESSION_DICT_SAMPLES, newest_first=True)
+        messages = decrypt_messages([stored.record for stored in reversed(newest)], use_cache=False)
+        # Serialized as encrypt_message does, so the samples match what gets compressed
+        samples = [json.dumps(message).encode() for message in messages if isinstance(message, dict)]
+        codec = CODECS[job.params['codec']]
+        dictionary = train(samples, codec, config.COMPRESSION_DICT_SIZE)
+        dict_id = room_dictionaries.add(room_id, codec, dictionary)
+    finally:
+        _training.discard(room_id)
+    return {"room_id": room_id, "dictionary_id": dict_id, "bytes": len(dictionary), "samples": len(samples)}
+
+
+def export_path(job):
+    """Where an export job writes its file"""
+    extension = '.ndjson.gz' if job.params.get('gzip') else '.ndjson'
+    return os.path.join(config.EXPORT_FOLDER, job.job_id + extension)
+
+
+def start_export(room_id, since=None, until=None, compress=False):
+    """Queue an NDJSON export of a room, optionally limited to a time range"""
+    # Progress counts bytes written; the final size is not known up front
+    return job_queue.submit('export', {"room_id": room_id, "since": since, "until": until, "gzip": compress})
+
+
+def _delete_export(job):
+    try:
+        os.unlink(export_path(job))
+    except FileNotFoundError:
+        pass
+
+
+@job_queue.register('export', cleanup=_delete_export)
+def export_room(job):
+    # An interrupted export starts over; the file only appears once complete
+    params = job.params
+    os.makedirs(config.EXPORT_FOLDER, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=config.EXPORT_FOLDER, prefix='.tmp-')
+    written = 0
+    counts = {"undecryptable": 0}
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in export_chunks(params['room_id'], params.get('since'), params.get('until'),
+                                       compress=params.get('gzip'), counts=counts):
+                out.write(chunk)
+                written += len(chunk)
+                job.progress(written)
+        os.replace(tmp_path, export_path(job))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return {
+        "room_id": params['room_id'],
+        "bytes": written,
+        "undecryptable": counts["undecryptable"],
+        "download_url": f"/admin/jobs/{job.job_id}/download"
+    }
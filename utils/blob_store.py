@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import base64
+import hashlib
+import tempfile
+import threading
+import time
+import config
+
+BLOB_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?(?:;[\w=.+-]+)*;base64,", re.ASCII)
+
+# Only these types are served inline; anything else is sent as a download
+INLINE_TYPES = ('image/', 'video/', 'audio/')
+
+
+def parse_data_url(data_url):
+    """Split a base64 data URL into (mime type, bytes); raises ValueError if malformed"""
+    match = DATA_URL_RE.match(data_url or "")
+    if not match:
+        raise ValueError("Media data must be a base64 data URL")
+    return match.group(1) or 'application/octet-stream', base64.b64decode(data_url[match.end():], validate=True)
+
+
+class BlobStore:
+    """Content-addressed blobs on disk, named by the SHA-256 of their bytes.
+
+    Blobs live under root/<first two hex digits>/<blob id>, next to a small
+    JSON sidecar with their MIME type. Storing the same bytes twice writes
+    them once. A second sidecar counts, per room, the messages referencing
+    the blob, so a room can only serve its own media.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._rooms_lock = threading.Lock()
+
+    def path(self, blob_id):
+        if not BLOB_ID_RE.match(blob_id or ""):
+            return None
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    def exists(self, blob_id):
+        path = self.path(blob_id)
+        return path is not None and os.path.exists(path)
+
+    def put(self, data, content_type):
+        """Store bytes and return (blob_id, size)"""
+        blob_id = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_id)
+        if not os.path.exists(path):
+            self._write(path, data)
+            self._write_meta(path, content_type)
+        return blob_id, len(data)
+
+    def put_file(self, tmp_path, blob_id, content_type):
+        """Move a finished file whose SHA-256 is blob_id into the store and return the ID"""
+        path = self.path(blob_id)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self._write_meta(path, content_type)
+        return blob_id
+
+    def spool(self, stream, chunk_size=64 * 1024):
+        """Copy a stream into a temporary file in the store, returning (tmp_path, blob_id, size)"""
+        tmp_dir = os.path.join(self.root, '.uploads')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='.tmp-')
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    tmp.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, sha256.hexdigest(), size
+
+    def variants(self, blob_id):
+        """Return {variant name: blob_id} for the rendered variants of a blob"""
+        try:
+            with open(self.path(blob_id) + '.variants') as f:
+                return json.load(f)
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def add_variants(self, blob_id, rendered, names):
+        """Store rendered variants ({name: (tmp_path, blob_id, type)}) and record them on the original.
+
+        Variants that were not rendered (the original is already small
+        enough) point at the original itself.
+        """
+        variants = {}
+        for name in names:
+            if name in rendered:
+                tmp_path, variant_id, content_type = rendered[name]
+                self._store_variant(tmp_path, variant_id, content_type)
+                variants[name] = variant_id
+            else:
+                variants[name] = blob_id
+        self._write(self.path(blob_id) + '.variants', json.dumps(variants).encode())
+        return variants
+
+    def _store_variant(self, tmp_path, variant_id, content_type):
+        self.put_file(tmp_path, variant_id, content_type)
+
+    def rooms(self, blob_id):
+        """Return {room_id: number of the room's messages referencing the blob}"""
+        try:
+            with open(self.path(blob_id) + '.rooms') as f:
+                rooms = json.load(f)
+        except (OSError, ValueError, TypeError):
+            return {}
+        return rooms if isinstance(rooms, dict) else {}
+
+    def add_room(self, blob_id, room_id):
+        """Record that one more message of room_id references the blob"""
+        with self._rooms_lock:
+            rooms = self.rooms(blob_id)
+            rooms[room_id] = rooms.get(room_id, 0) + 1
+            self._write(self.path(blob_id) + '.rooms', json.dumps(rooms).encode())
+
+    def remove_room(self, blob_id, room_id, count=1):
+        """Drop the references of count removed messages; the room stops serving the blob at zero"""
+        with self._rooms_lock:
+            rooms = self.rooms(blob_id)
+            if room_id not in rooms:
+                return
+            rooms[room_id] -= count
+            if rooms[room_id] <= 0:
+                del rooms[room_id]
+            self._write(self.path(blob_id) + '.rooms', json.dumps(rooms).encode())
+
+    def _write_meta(self, path, content_type):
+        self._write(path + '.meta', json.dumps({"type": content_type}).encode())
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename it into place, so readers
+        # never see a partially written blob
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def content_type(self, blob_id):
+        try:
+            with open(self.path(blob_id) + '.meta') as meta:
+                return json.load(meta).get("type") or 'application/octet-stream'
+        except (OSError, ValueError):
+            return 'application/octet-stream'
+
+
+class RefCountedBlobStore(BlobStore):
+    """A blob store whose blobs are shared by reference and collected when unused.
+
+    Every room file entry holds one reference to its blob. Releasing the
+    last reference only marks the blob as garbage; a background collector
+    deletes it later, unless it was referenced again in the meantime.
+    Counts are kept in a .refs sidecar next to each blob and read back on
+    start, so blobs keep their references (and garbage is still collected)
+    across restarts.
+    """
+
+    def __init__(self, root, gc_interval):
+        super().__init__(root)
+        self.gc_interval = gc_interval
+        self._refs = {}  # blob_id -> reference count
+        self._garbage = set()
+        self._lock = threading.Lock()
+        self._collector = None
+        self.collected = 0
+        self._load()
+        if self._garbage:
+            self._start_collector()
+
+    def _load(self):
+        """Read the reference counts of the stored blobs from their .refs sidecars"""
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if prefix.startswith('.') or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                blob_id, extension = os.path.splitext(name)
+                if extension != '.refs' or not BLOB_ID_RE.match(blob_id):
+                    continue
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        count = int(f.read())
+                except (OSError, ValueError) as e:
+                    print(f"Error reading references of file blob {blob_id}: {str(e)}")
+                    continue
+                if count > 0:
+                    self._refs[blob_id] = count
+                else:
+                    self._garbage.add(blob_id)
+
+    def _save_refs(self, blob_id):
+        self._write(self.path(blob_id) + '.refs', str(self._refs.get(blob_id, 0)).encode())
+
+    def add_file(self, tmp_path, blob_id, content_type):
+        """Move a finished file into the store and take a reference to it"""
+        with self._lock:
+            self.put_file(tmp_path, blob_id, content_type)
+            self._acquire(blob_id)
+        return blob_id
+
+    def add_ref(self, blob_id):
+        """Take another reference to a stored blob; returns False if it does not exist"""
+        with self._lock:
+            if not self.exists(blob_id):
+                return False
+            self._acquire(blob_id)
+            return True
+
+    def add_variants(self, blob_id, rendered, names):
+        # Variants hold a reference each, dropped when the original is collected
+        with self._lock:
+            if not self.exists(blob_id):
+                for tmp_path, _, _ in rendered.values():
+                    os.unlink(tmp_path)
+                return {}
+            return super().add_variants(blob_id, rendered, names)
+
+    def _store_variant(self, tmp_path, variant_id, content_type):
+        self.put_file(tmp_path, variant_id, content_type)
+        self._acquire(variant_id)
+
+    def _acquire(self, blob_id):
+        self._refs[blob_id] = self._refs.get(blob_id, 0) + 1
+        self._garbage.discard(blob_id)
+        self._save_refs(blob_id)
+
+    def release(self, blob_id):
+        """Drop a reference; the blob is collected once nothing refers to it"""
+        with self._lock:
+            self._release(blob_id)
+        self._start_collector()
+
+    def _release(self, blob_id):
+        count = self._refs.get(blob_id, 0) - 1
+        if count > 0:
+            self._refs[blob_id] = count
+        else:
+            self._refs.pop(blob_id, None)
+            self._garbage.add(blob_id)
+        self._save_refs(blob_id)
+
+    def refcount(self, blob_id):
+        return self._refs.get(blob_id, 0)
+
+    def collect(self):
+        """Delete unreferenced blobs and return how many were removed"""
+        with self._lock:
+            garbage, self._garbage = self._garbage, set()
+            removed = 0
+            for blob_id in garbage:
+                if self._refs.get(blob_id):
+                    continue
+                for variant_id in set(self.variants(blob_id).values()) - {blob_id}:
+                    self._release(variant_id)
+                path = self.path(blob_id)
+                for name in (path, path + '.meta', path + '.variants', path + '.refs'):
+                    try:
+                        os.unlink(name)
+                    except OSError:
+                        pass
+                removed += 1
+            self.collected += removed
+            return removed
+
+    def _start_collector(self):
+        with self._lock:
+            if self._collector is not None:
+                return
+            self._collector = threading.Thread(target=self._collect_forever, daemon=True)
+        self._collector.start()
+
+    def _collect_forever(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect()
+            except Exception as e:
+                print(f"Error collecting file blobs: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "blobs": len(self._refs),
+                "references": sum(self._refs.values()),
+                "garbage": len(self._garbage),
+                "collected": self.collected
+            }
+
+
+# Shared store for media sent through the socket
+blob_store = BlobStore(config.MEDIA_FOLDER)
+# Shared, deduplicated store for room files
+file_store = RefCountedBlobStore(config.FILE_BLOB_FOLDER, config.FILE_GC_INTERVAL_SECONDS)
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping cost (dict slot, OrderedDict link, parsed
+# object headers) added on top of the key and plaintext sizes.
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def copy_message(message):
+    """Copy a cached message deeply enough that callers can annotate it freely"""
+    if not isinstance(message, dict):
+        return message
+    return {
+        key: value.copy() if isinstance(value, (dict, list)) else value
+        for key, value in message.items()
+    }
+
+
+class DecryptedMessageCache:
+    """Size-bounded LRU of decrypted messages keyed by their ciphertext token"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # token -> (message, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        """Return a copy of the cached message for a token, or None"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+        return copy_message(entry[0])
+
+    def put(self, token, message, plaintext_size):
+        """Cache a decrypted message, evicting the least recently used entries"""
+        size = len(token) + plaintext_size + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(token, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[token] = (copy_message(message), size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, token):
+        """Drop a token, e.g. after its message was re-encrypted or deleted"""
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return hit/miss counters and current residency"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
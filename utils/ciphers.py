@@ -0,0 +1,322 @@
+import os
+import json
+import base64
+import struct
+import tempfile
+import threading
+from collections import namedtuple
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap, InvalidUnwrap
+import config
+from utils.key_ring import key_ring, file_signature
+from utils.compression import CODECS, compress, decompress, room_dictionaries
+
+FERNET = 'fernet'
+AES_GCM = 'aes-gcm'
+CHACHA20_POLY1305 = 'chacha20-poly1305'
+
+# Records of the AEAD suites are raw bytes starting with a version tag and
+# the ID of the room data key; Fernet records stay base64 text, so both
+# formats can be told apart and read side by side.
+VERSIONS = {AES_GCM: 1, CHACHA20_POLY1305: 2}
+_AEAD_CLASSES = {1: AESGCM, 2: ChaCha20Poly1305}
+HEADER = struct.Struct('>BI')  # version, data key ID
+NONCE_SIZE = 12
+
+# Records whose plaintext was compressed say so outside the ciphertext,
+# together with the codec and the ID of the room dictionary used (0 for
+# none): AEAD records set COMPRESSED in the version byte and append
+# COMPRESSION_HEADER to the (authenticated) header, Fernet tokens get a
+# "z<codec>:<dictionary ID>:" prefix. Fernet tokens always start with
+# "g", so both forms stay unambiguous.
+COMPRESSED = 0x80
+COMPRESSION_HEADER = struct.Struct('>BI')  # codec, dictionary ID
+COMPRESSED_PREFIX = 'z'
+
+if config.CIPHER_SUITE not in (FERNET, *VERSIONS):
+    raise ValueError(f"Unknown cipher suite: {config.CIPHER_SUITE}")
+
+# Key material for one batch: the key ring's Fernet keys (primary first),
+# {data key ID: key} for the AEAD records, the version and key ID new
+# records are sealed with (None for Fernet), the codec ID new records are
+# compressed with (None for no compression) with the ID of the room
+# dictionary to use, and {dictionary ID: dictionary}. Plain values, so
+# batches can be sent to pool workers.
+Keys = namedtuple('Keys', ['fernet', 'data', 'version', 'key_id', 'codec', 'dict_id', 'dictionaries'],
+                  defaults=(None, 0, {}))
+
+_ciphers = {}  # Cipher objects per key, reused across batches (also inside pool workers)
+
+
+def _cipher(cls, key):
+    cipher = _ciphers.get((cls, key))
+    if cipher is None:
+        cipher = _ciphers[(cls, key)] = cls(key)
+    return cipher
+
+
+def _fernet(keys):
+    cipher = _ciphers.get((MultiFernet, keys))
+    if cipher is None:
+        cipher = _ciphers[(MultiFernet, keys)] = MultiFernet([Fernet(key) for key in keys])
+    return cipher
+
+
+def forget_ciphers():
+    """Drop the cached cipher objects, so keys that were retired do not stay in memory"""
+    _ciphers.clear()
+
+
+key_ring.on_change(forget_ciphers)
+
+
+def is_encrypted(record):
+    """Check whether a stored record is ciphertext (Fernet text or an AEAD record)"""
+    return isinstance(record, (str, bytes))
+
+
+def record_key_id(record):
+    """Return the data key ID of an AEAD record, or None for Fernet tokens"""
+    if isinstance(record, bytes) and len(record) >= HEADER.size:
+        return HEADER.unpack_from(record)[1]
+    return None
+
+
+def record_compression(record):
+    """Return (codec, dictionary ID) of a compressed record, or None"""
+    if isinstance(record, str):
+        if not record.startswith(COMPRESSED_PREFIX):
+            return None
+        try:
+            codec, dict_id, _ = record[len(COMPRESSED_PREFIX):].split(':', 2)
+            return int(codec), int(dict_id)
+        except ValueError:
+            return None
+    if isinstance(record, bytes) and len(record) >= HEADER.size + COMPRESSION_HEADER.size and record[0] & COMPRESSED:
+        return COMPRESSION_HEADER.unpack_from(record, HEADER.size)
+    return None
+
+
+def encrypt_record(plaintext, keys):
+    """Compress (if enabled) and encrypt serialized message bytes with the suite and key chosen in keys"""
+    compression = None
+    if keys.codec is not None:
+        body = compress(plaintext, keys.codec, keys.dictionaries.get(keys.dict_id))
+        # Messages that do not shrink are stored uncompressed, without the flag
+        if len(body) < len(plaintext):
+            plaintext, compression = body, (keys.codec, keys.dict_id)
+
+    if keys.version is None:
+        token = _fernet(keys.fernet).encrypt(plaintext).decode()
+        return f"{COMPRESSED_PREFIX}{compression[0]}:{compression[1]}:{token}" if compression else token
+    if compression:
+        header = HEADER.pack(keys.version | COMPRESSED, keys.key_id) + COMPRESSION_HEADER.pack(*compression)
+    else:
+        header = HEADER.pack(keys.version, keys.key_id)
+    nonce = os.urandom(NONCE_SIZE)
+    aead = _cipher(_AEAD_CLASSES[keys.version], keys.data[keys.key_id])
+    return header + nonce + aead.encrypt(nonce, plaintext, header)
+
+
+def decrypt_record(record, keys):
+    """Decrypt a Fernet or AEAD record to its serialized bytes; raises if it cannot be read"""
+    compression = record_compression(record)
+    if isinstance(record, str):
+        token = record.rsplit(':', 1)[-1] if compression else record
+        plaintext = _fernet(keys.fernet).decrypt(token.encode())
+    else:
+        version, key_id = HEADER.unpack_from(record)
+        header_size = HEADER.size + (COMPRESSION_HEADER.size if compression else 0)
+        version &= ~COMPRESSED
+        key = keys.data.get(key_id)
+        if key is None or version not in _AEAD_CLASSES:
+            raise InvalidTag(f"No data key {key_id} for version {version}")
+        nonce = record[header_size:header_size + NONCE_SIZE]
+        ciphertext = record[header_size + NONCE_SIZE:]
+        plaintext = _cipher(_AEAD_CLASSES[version], key).decrypt(nonce, ciphertext, record[:header_size])
+
+    if compression is None:
+        return plaintext
+    codec, dict_id = compression
+    dictionary = keys.dictionaries.get(dict_id)
+    if dict_id and dictionary is None:
+        raise ValueError(f"No compression dictionary {dict_id}")
+    return decompress(plaintext, codec, dictionary)
+
+
+def rotate_record(record, keys):
+    """Re-encrypt a Fernet token with the primary key; AEAD records are returned as they are"""
+    if isinstance(record, str):
+        prefix, _, token = record.rpartition(':')
+        rotated = _fernet(keys.fernet).rotate(token.encode()).decode()
+        return f"{prefix}:{rotated}" if prefix else rotated
+    return record
+
+
+def derive_master_key(secret):
+    """Derive the key-wrapping master key from a configured secret"""
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"room-data-key-wrap").derive(secret)
+
+
+class RoomKeyStore:
+    """Per-room data keys for the AEAD suites, persisted wrapped by a master key.
+
+    Only the wrapped keys (RFC 3394 AES key wrap) are written to disk, so
+    rotating the key ring means re-wrapping a few keys rather than
+    re-encrypting every message. Master keys are derived from key ring
+    keys, and each entry records which one wrapped it. Key IDs are global,
+    which lets a record be decrypted without knowing its room. The file is
+    read again whenever another process replaced it, so a worker never
+    writes back keys wrapped by a ring key that has been rotated out.
+    """
+
+    def __init__(self, path, ring):
+        self.path = path
+        self._ring = ring
+        self._keys = {}  # key_id -> data key
+        self._wrapped = {}  # key_id -> {"room_id", "wrapped", "wrapped_by"} as saved
+        self._rooms = {}  # room_id -> key_id of its current key
+        self._next_id = 1  # Key IDs are never reused, even after a room's keys are destroyed
+        self._signature = None  # file_signature() of the version in memory
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        signature = file_signature(self.path)
+        if self._loaded and signature == self._signature:
+            return
+        self._loaded = True
+        if signature is None:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading room keys: {str(e)}")
+            return
+        self._signature = signature
+        wrapped, keys = {}, {}
+        for key_id, entry in saved.get("keys", {}).items():
+            key_id = int(key_id)
+            wrapped[key_id] = entry
+            if key_id in self._keys and self._wrapped.get(key_id) == entry:
+                keys[key_id] = self._keys[key_id]
+                continue
+            # Entries saved before the key ring existed were wrapped by its first key
+            secret = self._ring.key(entry.get("wrapped_by", 1))
+            try:
+                if secret is None:
+                    raise ValueError(f"key ring key {entry.get('wrapped_by', 1)} is retired")
+                keys[key_id] = aes_key_unwrap(derive_master_key(secret), base64.b64decode(entry["wrapped"]))
+            except (InvalidUnwrap, ValueError, KeyError) as e:
+                print(f"Error unwrapping data key {key_id}: {str(e)}")
+        self._wrapped, self._keys = wrapped, keys
+        self._rooms = {room_id: int(key_id) for room_id, key_id in saved.get("rooms", {}).items()}
+        self._next_id = max(saved.get("next_key_id", 1), max(self._wrapped, default=0) + 1)
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump({"keys": self._wrapped, "rooms": self._rooms, "next_key_id": self._next_id}, tmp)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._signature = file_signature(self.path)
+
+    def room_key(self, room_id):
+        """Return (key_id, key) of a room's current data key, creating it on first use"""
+        with self._lock:
+            self._load()
+            key_id = self._rooms.get(room_id)
+            if key_id is not None and key_id in self._keys:
+                return key_id, self._keys[key_id]
+
+            key_id = self._next_id
+            self._next_id += 1
+            key = AESGCM.generate_key(bit_length=256)
+            self._keys[key_id] = key
+            self._wrapped[key_id] = self._wrap(room_id, key)
+            self._rooms[room_id] = key_id
+            self._save()
+            return key_id, key
+
+    def _wrap(self, room_id, key):
+        return {
+            "room_id": room_id,
+            "wrapped": base64.b64encode(aes_key_wrap(derive_master_key(self._ring.primary_key()), key)).decode(),
+            "wrapped_by": self._ring.primary_id()
+        }
+
+    def rewrap(self):
+        """Wrap every data key with the key ring's current primary key"""
+        with self._lock:
+            self._load()
+            for key_id, key in self._keys.items():
+                self._wrapped[key_id] = self._wrap(self._wrapped[key_id].get("room_id"), key)
+            self._save()
+
+    def keys(self, key_ids):
+        """Return {key_id: key} for the given IDs that are known"""
+        with self._lock:
+            self._load()
+            return {key_id: self._keys[key_id] for key_id in key_ids if key_id in self._keys}
+
+    def forget_room(self, room_id):
+        """Destroy a room's data keys; whatever they encrypted becomes unreadable"""
+        with self._lock:
+            self._load()
+            key_ids = [key_id for key_id, entry in self._wrapped.items() if entry.get("room_id") == room_id]
+            if not key_ids and room_id not in self._rooms:
+                return
+            self._rooms.pop(room_id, None)
+            for key_id in key_ids:
+                del self._wrapped[key_id]
+                self._keys.pop(key_id, None)
+            self._save()
+
+
+# Shared data keys of the AEAD suites (unused while CIPHER_SUITE is "fernet")
+room_keys = RoomKeyStore(config.ROOM_KEYS_PATH, key_ring)
+
+
+def _compression_keys(room_id):
+    """(codec, dictionary ID, dictionaries) for new messages of a room"""
+    codec = CODECS.get(config.MESSAGE_COMPRESSION)
+    if codec is None:
+        return None, 0, {}
+    current = room_dictionaries.current(room_id) if room_id else None
+    if current is None or current[1] != codec:
+        return codec, 0, {}
+    dict_id, _, dictionary = current
+    return codec, dict_id, {dict_id: dictionary}
+
+
+def encryption_keys(room_id=None):
+    """Key material for encrypting new messages of a room with the configured suite and compression"""
+    compression = _compression_keys(room_id)
+    if config.CIPHER_SUITE == FERNET:
+        return Keys(key_ring.fernet_keys(), {}, None, None, *compression)
+    key_id, key = room_keys.room_key(room_id or "")
+    return Keys(key_ring.fernet_keys(), {key_id: key}, VERSIONS[config.CIPHER_SUITE], key_id, *compression)
+
+
+def decryption_keys(records):
+    """Key material for decrypting the given records, whatever suite and compression wrote them"""
+    key_ids = {record_key_id(record) for record in records if isinstance(record, bytes)}
+    dict_ids = set()
+    for record in records:
+        compression = record_compression(record)
+        if compression and compression[1]:
+            dict_ids.add(compression[1])
+    return Keys(key_ring.fernet_keys(), room_keys.keys(key_ids) if key_ids else {}, None, None,
+                dictionaries=room_dictionaries.dictionaries(dict_ids) if dict_ids else {})
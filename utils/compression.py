@@ -0,0 +1,214 @@
+import os
+import json
+import zlib
+import tempfile
+import threading
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+import config
+from utils.key_ring import key_ring, file_signature
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NONE = 'none'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+# Codec IDs as written into compressed records
+CODECS = {ZLIB: 1, ZSTD: 2}
+
+if config.MESSAGE_COMPRESSION not in (NONE, *CODECS):
+    raise ValueError(f"Unknown message compression: {config.MESSAGE_COMPRESSION}")
+if config.MESSAGE_COMPRESSION == ZSTD and zstandard is None:
+    raise ValueError("MESSAGE_COMPRESSION is \"zstd\" but the zstandard package is not installed")
+
+_DECOMPRESS_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# zstd (de)compressors per dictionary, reused across messages. They must
+# not be used by two threads at once, so each thread (and pool worker)
+# keeps its own.
+_zstd_local = threading.local()
+
+
+def _zstd(cls, zdict):
+    cache = getattr(_zstd_local, 'cache', None)
+    if cache is None:
+        cache = _zstd_local.cache = {}
+    instance = cache.get((cls, zdict))
+    if instance is None:
+        if cls is zstandard.ZstdCompressor:
+            options = {"level": config.COMPRESSION_LEVEL, "write_dict_id": False}
+        else:
+            options = {}
+        if zdict:
+            # Trained dictionaries are recognised by their magic number;
+            # anything else is used as raw content
+            options["dict_data"] = zstandard.ZstdCompressionDict(zdict)
+        instance = cache[(cls, zdict)] = cls(**options)
+    return instance
+
+
+def compress(plaintext, codec, zdict=None):
+    """Compress serialized message bytes with the given codec ID and optional dictionary"""
+    if codec == CODECS[ZLIB]:
+        # Raw deflate: a zlib header and checksum would cost more than short messages save
+        if zdict:
+            compressor = zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+        return compressor.compress(plaintext) + compressor.flush()
+    return _zstd(zstandard.ZstdCompressor, zdict).compress(plaintext)
+
+
+def decompress(body, codec, zdict=None):
+    """Undo compress(); raises ValueError if the data cannot be decompressed"""
+    try:
+        if codec == CODECS[ZLIB]:
+            decompressor = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+            return decompressor.decompress(body) + decompressor.flush()
+        if codec == CODECS[ZSTD] and zstandard is not None:
+            return _zstd(zstandard.ZstdDecompressor, zdict).decompress(body)
+    except _DECOMPRESS_ERRORS as e:
+        raise ValueError(f"Cannot decompress message: {str(e)}")
+    raise ValueError(f"Unsupported compression codec {codec}")
+
+
+def train(samples, codec, size):
+    """Build a dictionary of at most size bytes from serialized messages of a room"""
+    if codec == CODECS[ZSTD]:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError as e:
+            # Too few or too uniform samples; raw content still helps
+            print(f"Falling back to a raw content dictionary: {str(e)}")
+    # zlib looks matches up from the end of its dictionary, so the newest
+    # samples go last
+    return b"".join(samples)[-size:]
+
+
+class RoomDictionaryStore:
+    """Compression dictionaries trained per room, persisted encrypted with the key ring.
+
+    Dictionaries are built from message plaintext, so only their Fernet
+    tokens are written to disk. Every dictionary a record was compressed
+    with is kept until the room is deleted; new messages use the newest.
+    Like the room keys, the file is read again when another process
+    replaced it.
+    """
+
+    def __init__(self, path, ring):
+        self.path = path
+        self._ring = ring
+        self._dictionaries = {}  # dict_id -> dictionary bytes
+        self._saved = {}  # dict_id -> {"room_id", "codec", "record"} as saved
+        self._rooms = {}  # room_id -> dict_id of its newest dictionary
+        self._next_id = 1
+        self._signature = None  # file_signature() of the version in memory
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def _fernet(self):
+        return MultiFernet([Fernet(key) for key in self._ring.fernet_keys()])
+
+    def _load(self):
+        signature = file_signature(self.path)
+        if self._loaded and signature == self._signature:
+            return
+        self._loaded = True
+        if signature is None:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading compression dictionaries: {str(e)}")
+            return
+        self._signature = signature
+        fernet = self._fernet()
+        entries, dictionaries = {}, {}
+        for dict_id, entry in saved.get("dictionaries", {}).items():
+            dict_id = int(dict_id)
+            entries[dict_id] = entry
+            if dict_id in self._dictionaries:
+                # Dictionaries never change, only the key they are encrypted with
+                dictionaries[dict_id] = self._dictionaries[dict_id]
+                continue
+            try:
+                dictionaries[dict_id] = fernet.decrypt(entry["record"].encode())
+            except (InvalidToken, KeyError) as e:
+                print(f"Error decrypting compression dictionary {dict_id}: {str(e)}")
+        self._saved, self._dictionaries = entries, dictionaries
+        self._rooms = {room_id: int(dict_id) for room_id, dict_id in saved.get("rooms", {}).items()}
+        self._next_id = max(saved.get("next_id", 1), max(self._saved, default=0) + 1)
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump({"dictionaries": self._saved, "rooms": self._rooms, "next_id": self._next_id}, tmp)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._signature = file_signature(self.path)
+
+    def current(self, room_id):
+        """Return (dict_id, codec, dictionary) of a room's newest dictionary, or None"""
+        with self._lock:
+            self._load()
+            dict_id = self._rooms.get(room_id)
+            if dict_id is None or dict_id not in self._dictionaries:
+                return None
+            return dict_id, self._saved[dict_id]["codec"], self._dictionaries[dict_id]
+
+    def dictionaries(self, dict_ids):
+        """Return {dict_id: dictionary} for the given IDs that are known"""
+        with self._lock:
+            self._load()
+            return {dict_id: self._dictionaries[dict_id] for dict_id in dict_ids if dict_id in self._dictionaries}
+
+    def add(self, room_id, codec, dictionary):
+        """Store a new dictionary for a room and make it the one new messages use"""
+        with self._lock:
+            self._load()
+            dict_id = self._next_id
+            self._next_id += 1
+            self._dictionaries[dict_id] = dictionary
+            self._saved[dict_id] = {
+                "room_id": room_id,
+                "codec": codec,
+                "record": Fernet(self._ring.primary_key()).encrypt(dictionary).decode()
+            }
+            self._rooms[room_id] = dict_id
+            self._save()
+            return dict_id
+
+    def reencrypt(self):
+        """Encrypt every dictionary with the key ring's current primary key"""
+        with self._lock:
+            self._load()
+            fernet = Fernet(self._ring.primary_key())
+            for dict_id, dictionary in self._dictionaries.items():
+                self._saved[dict_id]["record"] = fernet.encrypt(dictionary).decode()
+            self._save()
+
+    def forget_room(self, room_id):
+        """Destroy a room's dictionaries; records compressed with them become unreadable"""
+        with self._lock:
+            self._load()
+            dict_ids = [dict_id for dict_id, entry in self._saved.items() if entry.get("room_id") == room_id]
+            if not dict_ids and room_id not in self._rooms:
+                return
+            self._rooms.pop(room_id, None)
+            for dict_id in dict_ids:
+                del self._saved[dict_id]
+                self._dictionaries.pop(dict_id, None)
+            self._save()
+
+
+# Shared per-room dictionaries (unused while MESSAGE_COMPRESSION is "none")
+room_dictionaries = RoomDictionaryStore(config.ROOM_DICTIONARIES_PATH, key_ring)
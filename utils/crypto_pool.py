@@ -0,0 +1,123 @@
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+import config
+from utils.ciphers import encrypt_record, decrypt_record, rotate_record
+from utils.key_ring import key_ring
+
+try:
+    import eventlet
+    import greenlet
+    from eventlet import tpool
+    from eventlet.greenthread import GreenThread
+except ImportError:
+    eventlet = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def decrypt_records(records, keys):
+    """Decrypt stored records, returning the plaintext bytes (or None if unreadable) for each, in order"""
+    plaintexts = []
+    for record in records:
+        try:
+            plaintexts.append(decrypt_record(record, keys))
+        except (InvalidToken, InvalidTag, TypeError, ValueError):
+            plaintexts.append(None)
+    return plaintexts
+
+
+def encrypt_payloads(payloads, keys):
+    """Encrypt serialized messages, returning their records in order"""
+    return [encrypt_record(payload, keys) for payload in payloads]
+
+
+def rotate_records(records, keys):
+    """Re-encrypt Fernet tokens with the primary key, returning the new record (or None if unreadable) for each"""
+    rotated = []
+    for record in records:
+        try:
+            rotated.append(rotate_record(record, keys))
+        except (InvalidToken, TypeError, ValueError):
+            rotated.append(None)
+    return rotated
+
+
+def _green():
+    """True when called from an eventlet green thread, whose hub must not block.
+
+    Flask-SocketIO serves requests and socket events from green threads
+    whenever eventlet is installed, with or without monkey-patching; job
+    workers are real threads and may block.
+    """
+    return eventlet is not None and isinstance(greenlet.getcurrent(), GreenThread)
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if config.CRYPTO_POOL == 'process':
+                _pool = ProcessPoolExecutor(max_workers=config.CRYPTO_WORKERS)
+            else:
+                _pool = ThreadPoolExecutor(max_workers=config.CRYPTO_WORKERS, thread_name_prefix='crypto')
+        return _pool
+
+
+def _retire_workers():
+    """Replace worker processes when the key ring changes; their cipher caches hold the old keys"""
+    global _pool
+    with _pool_lock:
+        if not isinstance(_pool, ProcessPoolExecutor):
+            return
+        pool, _pool = _pool, None
+    # Work already handed to the old workers still finishes
+    pool.shutdown(wait=False)
+
+
+key_ring.on_change(_retire_workers)
+
+
+def _map_chunks(function, chunks, keys):
+    return list(_executor().map(partial(function, keys=keys), chunks))
+
+
+def _inline(function, items, keys):
+    if _green():
+        # Keep the CPU-bound work off the event loop
+        return tpool.execute(function, items, keys)
+    return function(items, keys)
+
+
+def run_batched(function, items, keys):
+    """Apply decrypt_records, encrypt_payloads or rotate_records to items with the given keys, keeping their order.
+
+    Batches of at least CRYPTO_PARALLEL_MIN_BATCH items are split into one
+    chunk per worker and run on the crypto pool: worker processes, or with
+    CRYPTO_POOL = "thread" eventlet's tpool (plain threads off green
+    threads). Smaller batches run inline, where the pool overhead would
+    cost more than it saves. On a green thread, inline work and the wait
+    for worker processes both go through tpool, so the hub keeps serving
+    other clients. The keys travel with each chunk; worker processes only
+    cache ciphers built from them and are replaced when the key ring changes.
+    """
+    workers = config.CRYPTO_WORKERS
+    if config.CRYPTO_POOL == 'none' or workers < 2 or len(items) < config.CRYPTO_PARALLEL_MIN_BATCH:
+        return _inline(function, items, keys)
+
+    chunk_size = -(-len(items) // workers)
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    try:
+        if _green() and config.CRYPTO_POOL == 'thread':
+            results = eventlet.GreenPool(workers).imap(partial(tpool.execute, function, keys=keys), chunks)
+        elif _green():
+            results = tpool.execute(_map_chunks, function, chunks, keys)
+        else:
+            results = _map_chunks(function, chunks, keys)
+        return [item for chunk in results for item in chunk]
+    except Exception as e:
+        print(f"Crypto pool error, falling back to inline: {str(e)}")
+        return _inline(function, items, keys)
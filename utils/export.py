@@ -0,0 +1,63 @@
+import json
+import zlib
+import config
+from utils.helpers import decrypt_messages
+from utils.storage import message_store
+
+
+def iter_messages(room_id, since=None, until=None, batch_size=None):
+    """Yield (seq, decrypted message) of a room in order, reading and decrypting one batch at a time"""
+    batch_size = batch_size or config.DECRYPT_BATCH_SIZE
+    after_seq = None
+    while True:
+        batch = message_store.range(room_id, after_seq=after_seq, since=since, until=until, limit=batch_size)
+        if not batch:
+            return
+        messages = decrypt_messages([stored.record for stored in batch], use_cache=False)
+        yield from zip((stored.seq for stored in batch), messages)
+        after_seq = batch[-1].seq
+
+
+def ndjson_lines(entries, counts=None):
+    """Encode (seq, message) pairs as newline-delimited JSON, one line per message.
+
+    Records that could not be decrypted come back from decrypt_messages as
+    stored (bytes, segment references); they are written as an error line
+    instead and counted in counts["undecryptable"].
+    """
+    for seq, message in entries:
+        if not isinstance(message, dict):
+            message = {"seq": seq, "error": "undecryptable"}
+            if counts is not None:
+                counts["undecryptable"] = counts.get("undecryptable", 0) + 1
+        yield (json.dumps(message, ensure_ascii=False) + "\n").encode()
+
+
+def buffered(chunks, size=None):
+    """Join small chunks into pieces of about size bytes, so the server writes few large blocks"""
+    size = size or config.EXPORT_WRITE_SIZE
+    buffer, buffered_bytes = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered_bytes += len(chunk)
+        if buffered_bytes >= size:
+            yield b"".join(buffer)
+            buffer, buffered_bytes = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of chunks into one gzip member as it is produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(room_id, since=None, until=None, compress=False, counts=None):
+    """Yield a room's history as NDJSON bytes (gzip-compressed if asked), in bounded memory"""
+    chunks = buffered(ndjson_lines(iter_messages(room_id, since, until), counts))
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,123 @@
+import os
+import secrets
+from urllib.parse import quote
+from flask import request, Response
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import wrap_file
+
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+READ_SIZE = 64 * 1024
+
+
+def _content_disposition(download_name, as_attachment):
+    kind = 'attachment' if as_attachment else 'inline'
+    ascii_name = download_name.encode('ascii', 'ignore').decode().replace('"', '') or 'download'
+    return f"{kind}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+
+
+def _read_range(path, start, length):
+    """Yield length bytes of a file starting at start"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(READ_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _whole_file_body(path, size):
+    """Return a WSGI body for a whole file, letting the server use sendfile where it can.
+
+    Only whole files go through wsgi.file_wrapper: not every server stops
+    a wrapped file at Content-Length (wsgiref sends it to the end), so
+    ranges are always streamed in bounded reads.
+    """
+    if 'wsgi.file_wrapper' in request.environ:
+        return wrap_file(request.environ, open(path, 'rb'), READ_SIZE)
+    return _read_range(path, 0, size)
+
+
+def _byte_ranges(size):
+    """Return the requested (start, end exclusive) ranges, [] for none, or None if unsatisfiable"""
+    header = request.headers.get('Range')
+    if not header:
+        return []
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+        # Malformed or abusive Range headers are ignored, as RFC 9110 allows
+        return []
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            start = max(size + start, 0)
+            stop = size
+        stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges or None
+
+
+def send_content_file(path, content_type, etag, download_name, as_attachment=True, cache_control='no-cache'):
+    """Serve a file with a strong ETag, conditional GETs and byte ranges.
+
+    etag must change whenever the content does (a content hash). Handles
+    If-None-Match (304), Range with If-Range (206, multipart/byteranges
+    for several ranges) and unsatisfiable ranges (416).
+    """
+    size = os.path.getsize(path)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': cache_control,
+        'Content-Disposition': _content_disposition(download_name, as_attachment),
+        'X-Content-Type-Options': 'nosniff'
+    }
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    ranges = _byte_ranges(size)
+    if_range = request.headers.get('If-Range')
+    if ranges and if_range and if_range.strip() != f'"{etag}"':
+        # The client's partial copy is stale: send the whole file
+        ranges = []
+
+    if ranges is None:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    if not ranges:
+        headers['Content-Length'] = str(size)
+        return Response(_whole_file_body(path, size), status=200, headers=headers,
+                        mimetype=content_type, direct_passthrough=True)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(_read_range(path, start, stop - start), status=206, headers=headers,
+                        mimetype=content_type, direct_passthrough=True)
+
+    boundary = secrets.token_hex(16)
+    parts = []
+    for start, stop in ranges:
+        part_header = (f'\r\n--{boundary}\r\n'
+                       f'Content-Type: {content_type}\r\n'
+                       f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode()
+        parts.append((part_header, start, stop))
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+
+    def multipart_body():
+        for part_header, start, stop in parts:
+            yield part_header
+            yield from _read_range(path, start, stop - start)
+        yield closing
+
+    length = sum(len(part_header) + stop - start for part_header, start, stop in parts) + len(closing)
+    headers['Content-Length'] = str(length)
+    return Response(multipart_body(), status=206, headers=headers,
+                    content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
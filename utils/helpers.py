@@ -4,6 +4,19 @@ from flask import request
 import socket
 import config
 import json
+import re
+import hmac
+import hashlib
+import unicodedata
+from utils.cache import DecryptedMessageCache, copy_message
+from utils.storage import message_store
+from utils.ciphers import encryption_keys, decryption_keys, encrypt_record, decrypt_record, is_encrypted
+from utils.crypto_pool import run_batched, decrypt_records, encrypt_payloads
+from utils.key_ring import key_ring
+from utils.segments import is_sealed, read_sealed
+
+# LRU of decrypted messages in front of decrypt_message (disabled when the cap is 0)
+decrypted_cache = DecryptedMessageCache(config.DECRYPT_CACHE_MAX_BYTES) if config.DECRYPT_CACHE_MAX_BYTES > 0 else None
 
 def allowed_file(filename):
     """Check if a filename has an allowed extension"""
@@ -29,40 +42,141 @@ def get_client_ip():
     """Get the client's IP address"""
     return request.headers.get("X-Forwarded-For", request.remote_addr)
 
-def encrypt_message(message):
-    """Encrypt a message using Fernet symmetric encryption"""
+def encrypt_message(message, room_id=None):
+    """Encrypt a message with the configured cipher suite (CIPHER_SUITE).
+
+    Fernet records are text tokens; the AEAD suites return version-tagged
+    bytes sealed with the room's data key.
+    """
     try:
-        if isinstance(message, dict):
-            # Convert dictionary to string for encryption
-            message_str = json.dumps(message)
-            encrypted = config.fernet.encrypt(message_str.encode())
-            return encrypted.decode()
-        else:
-            # Encrypt string messages
-            encrypted = config.fernet.encrypt(str(message).encode())
-            return encrypted.decode()
+        # Dictionaries are stored as JSON, anything else as its string form
+        return encrypt_record(_serialize(message), encryption_keys(room_id))
     except Exception as e:
         print(f"Encryption error: {e}")
         # Return original message if encryption fails
         return message
 
-def decrypt_message(encrypted_message):
-    """Decrypt a message using Fernet symmetric encryption"""
+def decrypt_message(encrypted_message, use_cache=True):
+    """Decrypt a stored record, whichever cipher suite wrote it.
+
+    Bulk readers that touch each message once (exports, re-encryption)
+    pass use_cache=False so they do not evict the hot set from the cache.
+    """
+    if isinstance(encrypted_message, dict):
+        # Messages stored unencrypted (socket messages) are copied so callers
+        # can annotate the result without touching the stored record
+        return copy_message(encrypted_message)
+    if is_sealed(encrypted_message):
+        return decrypt_messages([encrypted_message], use_cache)[0]
+    
+    cacheable = use_cache and decrypted_cache is not None and is_encrypted(encrypted_message)
+    if cacheable:
+        cached = decrypted_cache.get(encrypted_message)
+        if cached is not None:
+            return cached
+    
     try:
-        decrypted = config.fernet.decrypt(encrypted_message.encode())
-        decrypted_str = decrypted.decode()
+        decrypted = decrypt_record(encrypted_message, decryption_keys([encrypted_message]))
+        message = _parse_plaintext(decrypted)
         
-        # Try to parse as JSON in case it was a dictionary
-        try:
-            return json.loads(decrypted_str)
-        except:
-            # Return as string if not valid JSON
-            return decrypted_str
+        if cacheable:
+            decrypted_cache.put(encrypted_message, message, len(decrypted))
+        return message
     except Exception as e:
         print(f"Decryption error: {e}")
         # Return original message if decryption fails
         return encrypted_message
 
+def _parse_plaintext(decrypted):
+    decrypted_str = decrypted.decode()
+    
+    # Try to parse as JSON in case it was a dictionary
+    try:
+        return json.loads(decrypted_str)
+    except:
+        # Return as string if not valid JSON
+        return decrypted_str
+
+def _serialize(message):
+    return (json.dumps(message) if isinstance(message, dict) else str(message)).encode()
+
+def decrypt_messages(encrypted_messages, use_cache=True):
+    """Decrypt a batch of stored records, returning the messages in the same order.
+    
+    Cache hits and unencrypted records are answered directly; the remaining
+    records are decrypted together, on the crypto pool when there are many.
+    Messages sealed into segments cost one decryption per segment.
+    """
+    messages = [None] * len(encrypted_messages)
+    pending = []
+    pending_sealed = []
+    for i, encrypted_message in enumerate(encrypted_messages):
+        sealed = is_sealed(encrypted_message)
+        if not sealed and not is_encrypted(encrypted_message):
+            messages[i] = decrypt_message(encrypted_message)
+            continue
+        if use_cache and decrypted_cache is not None:
+            cached = decrypted_cache.get(encrypted_message)
+            if cached is not None:
+                messages[i] = cached
+                continue
+        (pending_sealed if sealed else pending).append(i)
+    
+    decrypted_records = []
+    if pending:
+        records = [encrypted_messages[i] for i in pending]
+        decrypted_records = run_batched(decrypt_records, records, decryption_keys(records))
+    if pending_sealed:
+        plaintexts = read_sealed([encrypted_messages[i] for i in pending_sealed])
+        decrypted_records += [plaintexts[encrypted_messages[i]] for i in pending_sealed]
+        pending += pending_sealed
+    
+    for i, decrypted in zip(pending, decrypted_records):
+        record = encrypted_messages[i]
+        if decrypted is None:
+            print("Decryption error: invalid token")
+            messages[i] = record
+            continue
+        messages[i] = _parse_plaintext(decrypted)
+        if use_cache and decrypted_cache is not None:
+            decrypted_cache.put(record, messages[i], len(decrypted))
+    return messages
+
+def encrypt_messages(messages, room_id=None):
+    """Encrypt a batch of messages of one room, returning their records in the same order"""
+    return run_batched(encrypt_payloads, [_serialize(message) for message in messages], encryption_keys(room_id))
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize_words(text):
+    """Split text into normalized (NFKC, lowercase) words"""
+    return WORD_RE.findall(unicodedata.normalize('NFKC', text or "").lower())
+
+def _blind_index_key():
+    if config.SEARCH_INDEX_KEY:
+        return config.SEARCH_INDEX_KEY.encode()
+    return key_ring.index_key
+
+def blind_index_tokens(text):
+    """Return keyed HMAC tokens of the normalized words of a text, in order"""
+    key = _blind_index_key()
+    return [
+        hmac.new(key, word.encode(), hashlib.sha256).hexdigest()[:32]
+        for word in tokenize_words(text)
+    ]
+
+def invalidate_decrypted_message(encrypted_message):
+    """Drop a ciphertext from the decrypted-message cache"""
+    if decrypted_cache is not None and (is_encrypted(encrypted_message) or is_sealed(encrypted_message)):
+        decrypted_cache.invalidate(encrypted_message)
+
+def invalidate_room_messages(room_id):
+    """Drop every ciphertext of a room from the decrypted-message cache"""
+    if decrypted_cache is None or not message_store.has_room(room_id):
+        return
+    for stored in message_store.iter_messages(room_id):
+        invalidate_decrypted_message(stored.record)
+
 def get_local_ip():
     """Get the local IP address of the server"""
     hostname = socket.gethostname()
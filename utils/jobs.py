@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import queue
+import secrets
+import tempfile
+import threading
+import config
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """One queued piece of background work, with the progress recorded in the journal.
+
+    Handlers report progress with checkpoint(). The state passed there is
+    what a handler resumes from when the job is restarted after a crash, so
+    every step between two checkpoints has to be safe to run twice.
+    """
+
+    def __init__(self, kind, params, job_id=None):
+        self.job_id = job_id or secrets.token_hex(16)
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.done = 0
+        self.total = None
+        self.state = {}
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.created_at = self.updated_at = time.time()
+        self._queue = None
+
+    def checkpoint(self, done, total=None, **state):
+        """Record progress and the state to resume from, then yield to other work"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        self.state.update(state)
+        self._queue._update(self)
+        # Let requests and sockets run between batches
+        time.sleep(0)
+
+    def progress(self, done):
+        """Record progress for the status endpoint without journaling it.
+
+        For jobs that start over when interrupted, which have nothing to
+        resume from and would otherwise rewrite the journal on every step.
+        """
+        self.done = done
+        self.updated_at = time.time()
+        time.sleep(0)
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["kind"], data.get("params") or {}, job_id=data["job_id"])
+        for field in ("status", "done", "total", "state", "result", "error", "attempts",
+                      "created_at", "updated_at"):
+            if field in data:
+                setattr(job, field, data[field])
+        return job
+
+    def public(self):
+        """The job as shown by the status endpoint, without its parameters and resume state"""
+        percent = None
+        if self.status == DONE:
+            percent = 100
+        elif self.total:
+            percent = min(100, int(self.done * 100 / self.total))
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total, "percent": percent},
+            "result": self.result,
+            "error": self.error,
+            "created_at": int(self.created_at * 1000),
+            "updated_at": int(self.updated_at * 1000)
+        }
+
+
+class JobQueue:
+    """An in-process job queue run by a small pool of worker threads.
+
+    Every job is written to a JSON journal when it is queued, checkpointed
+    and finished. On start, jobs the journal still lists as queued or
+    running are queued again and resume from their last checkpoint.
+    """
+
+    def __init__(self, journal_path, workers):
+        self.journal_path = journal_path
+        self.workers = workers
+        self._handlers = {}
+        self._cleanups = {}
+        self._jobs = {}  # job_id -> Job, in submission order
+        self._queue = queue.Queue()
+        self._lock = threading.RLock()
+        self._threads = []
+
+    def register(self, kind, cleanup=None):
+        """Decorator registering the handler of a job kind; its return value becomes the job result.
+
+        cleanup(job), if given, is called when a finished job is dropped
+        from the history, e.g. to delete files it produced.
+        """
+        def decorator(handler):
+            self._handlers[kind] = handler
+            if cleanup is not None:
+                self._cleanups[kind] = cleanup
+            return handler
+        return decorator
+
+    def submit(self, kind, params, total=None):
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(kind, params)
+        job.total = total
+        job._queue = self
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._save()
+        self._start_workers()
+        self._queue.put(job.job_id)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def resume(self):
+        """Load the journal and queue again every job that had not finished"""
+        try:
+            with open(self.journal_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Error reading job journal: {str(e)}")
+            return 0
+
+        resumed = []
+        with self._lock:
+            for data in saved:
+                job = Job.from_dict(data)
+                job._queue = self
+                if job.status in (QUEUED, RUNNING):
+                    job.status = QUEUED
+                    resumed.append(job.job_id)
+                self._jobs[job.job_id] = job
+            self._save()
+        if resumed:
+            self._start_workers()
+            for job_id in resumed:
+                self._queue.put(job_id)
+        return len(resumed)
+
+    def _update(self, job):
+        with self._lock:
+            job.updated_at = time.time()
+            self._save()
+
+    def _save(self):
+        # Finished jobs beyond the history limit are dropped, oldest first
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - config.JOB_HISTORY)]:
+            job = self._jobs.pop(job_id)
+            cleanup = self._cleanups.get(job.kind)
+            if cleanup is not None:
+                try:
+                    cleanup(job)
+                except Exception as e:
+                    print(f"Error cleaning up {job.kind} job {job_id}: {str(e)}")
+
+        directory = os.path.dirname(self.journal_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump([job.to_dict() for job in self._jobs.values()], tmp)
+            os.replace(tmp_path, self.journal_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get(self._queue.get())
+            if job is None:
+                continue
+            with self._lock:
+                job.status = RUNNING
+                job.attempts += 1
+                self._update(job)
+            try:
+                result = self._handlers[job.kind](job)
+            except Exception as e:
+                print(f"Error running {job.kind} job {job.job_id}: {str(e)}")
+                with self._lock:
+                    job.status = FAILED
+                    job.error = str(e)
+                    self._update(job)
+            else:
+                with self._lock:
+                    job.status = DONE
+                    job.result = result
+                    self._update(job)
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+
+# Shared queue for heavy admin operations (see utils/admin_jobs.py)
+job_queue = JobQueue(config.JOB_JOURNAL_PATH, config.JOB_WORKERS)
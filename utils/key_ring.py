@@ -0,0 +1,210 @@
+import os
+import json
+import hmac
+import base64
+import hashlib
+import tempfile
+import threading
+import time
+from cryptography.fernet import Fernet, MultiFernet
+import config
+
+PRIMARY = 'primary'  # Encrypts new tokens
+ROTATING = 'rotating'  # Still decrypts while the sweeper re-encrypts its tokens
+RETIRED = 'retired'  # Key material destroyed
+
+
+def _to_bytes(key):
+    return key.encode() if isinstance(key, str) else key
+
+
+def file_signature(path):
+    """Identify the current version of a file that is replaced atomically, or None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # os.replace() gives every saved version a new inode
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class KeyRing:
+    """Fernet keys persisted to disk, so every worker and restart reads the same history.
+
+    The ring is seeded from ENCRYPTION_KEY (or a fresh key) the first time
+    and read back afterwards. rotate() makes a new primary key and keeps
+    the previous ones for decryption until retire() destroys them, which
+    the re-encryption sweep does once no token needs them any more.
+
+    Every read checks whether the file was replaced since it was loaded,
+    so the workers of a multi-process deployment switch to a rotated key
+    on their next message rather than at their next restart. Callbacks
+    registered with on_change() run whenever a new version is loaded, so
+    caches of key material can drop retired keys.
+    """
+
+    def __init__(self, path, seed_key=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._keys = []  # [{"id", "key", "status", "created_at"}], oldest first
+        self._index_key = None
+        self._signature = None  # file_signature() of the version in memory
+        self._listeners = []
+        self._load(seed_key)
+
+    def on_change(self, callback):
+        """Call callback() whenever the keys change, in this process or another"""
+        self._listeners.append(callback)
+
+    def _load(self, seed_key):
+        saved = self._read()
+        if saved is None:
+            key = _to_bytes(seed_key) if seed_key else Fernet.generate_key()
+            self._keys = [{"id": 1, "key": key.decode(), "status": PRIMARY, "created_at": int(time.time())}]
+            # Derived the same way as before the ring existed, so blind-index
+            # tokens stored under ENCRYPTION_KEY keep matching
+            self._index_key = hmac.new(key, b"blind-index", hashlib.sha256).digest()
+            # Workers starting together race to create the ring; every one
+            # but the winner uses the winner's ring
+            if not self._save(create=True):
+                saved = self._read()
+        if saved is not None:
+            self._use(saved)
+            if seed_key and _to_bytes(seed_key).decode() not in [entry.get("key") for entry in self._keys]:
+                print("ENCRYPTION_KEY is not an active key of the key ring (it may have been rotated out); "
+                      "the ring's primary key is used instead")
+        self._publish()
+
+    def _read(self):
+        """Return the saved ring, or None if there is none yet"""
+        self._signature = file_signature(self.path)
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _use(self, saved):
+        keys, index_key = saved["keys"], base64.b64decode(saved["index_key"])
+        self._keys, self._index_key = keys, index_key
+
+    def _refresh(self):
+        """Reload the ring if another process replaced the file since it was loaded"""
+        signature = file_signature(self.path)
+        if signature is None or signature == self._signature:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self._use(saved)
+            self._signature = signature
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reloading the key ring: {str(e)}")
+            return
+        self._publish()
+
+    def _save(self, create=False):
+        """Write the ring to disk; with create=True only if no ring exists yet, returning whether it was written"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # mkstemp creates the file readable by its owner only
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump({"keys": self._keys, "index_key": base64.b64encode(self._index_key).decode()}, tmp)
+            if create:
+                # link() fails if the file exists, unlike replace()
+                try:
+                    os.link(tmp_path, self.path)
+                except FileExistsError:
+                    return False
+                finally:
+                    os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._signature = file_signature(self.path)
+        return True
+
+    def _publish(self):
+        # Kept in sync for code that reads the key from config directly
+        config.ENCRYPTION_KEY = self.primary_key()
+        config.fernet = MultiFernet([Fernet(key) for key in self.fernet_keys()])
+        for callback in self._listeners:
+            callback()
+
+    def primary_key(self):
+        with self._lock:
+            self._refresh()
+            return next(entry["key"].encode() for entry in self._keys if entry["status"] == PRIMARY)
+
+    def primary_id(self):
+        with self._lock:
+            self._refresh()
+            return next(entry["id"] for entry in self._keys if entry["status"] == PRIMARY)
+
+    def fernet_keys(self):
+        """Return the keys that can decrypt, primary first"""
+        with self._lock:
+            self._refresh()
+            usable = [entry for entry in self._keys if entry["status"] != RETIRED]
+            usable.sort(key=lambda entry: entry["status"] != PRIMARY)
+            return tuple(entry["key"].encode() for entry in usable)
+
+    def key(self, key_id):
+        """Return the key with the given ID, or None if it is unknown or retired"""
+        with self._lock:
+            self._refresh()
+            for entry in self._keys:
+                if entry["id"] == key_id and entry["status"] != RETIRED:
+                    return entry["key"].encode()
+            return None
+
+    @property
+    def index_key(self):
+        """Key of the blind search index; it survives rotation so stored tokens keep matching"""
+        return self._index_key
+
+    def rotate(self):
+        """Make a new primary key and return its ID; the previous primary keeps decrypting"""
+        with self._lock:
+            self._refresh()
+            for entry in self._keys:
+                if entry["status"] == PRIMARY:
+                    entry["status"] = ROTATING
+            key_id = max(entry["id"] for entry in self._keys) + 1
+            self._keys.append({"id": key_id, "key": Fernet.generate_key().decode(), "status": PRIMARY,
+                               "created_at": int(time.time())})
+            self._save()
+            self._publish()
+            return key_id
+
+    def rotating_ids(self):
+        with self._lock:
+            self._refresh()
+            return [entry["id"] for entry in self._keys if entry["status"] == ROTATING]
+
+    def retire(self, key_ids):
+        """Destroy rotated-out keys; tokens still encrypted with them become unreadable"""
+        with self._lock:
+            self._refresh()
+            for entry in self._keys:
+                if entry["id"] in key_ids and entry["status"] == ROTATING:
+                    entry["status"] = RETIRED
+                    entry["key"] = None
+                    entry["retired_at"] = int(time.time())
+            self._save()
+            self._publish()
+
+    def describe(self):
+        """Key IDs and states, without key material"""
+        with self._lock:
+            self._refresh()
+            return [{field: value for field, value in entry.items() if field != "key"} for entry in self._keys]
+
+
+# Shared key ring; seeds itself from ENCRYPTION_KEY on first start
+key_ring = KeyRing(config.KEY_RING_PATH, os.getenv("ENCRYPTION_KEY"))
@@ -0,0 +1,95 @@
+import threading
+import config
+
+
+class Presence:
+    """Socket presence with reverse indexes between sids, users and rooms.
+
+    online_users (room -> set of user IDs) stays the forward map the rest of
+    the app reads, and user_sids (user -> set of sids) is maintained in the
+    dict passed in. Alongside them this keeps sid -> user and
+    user -> {room: sids}, so joining, leaving and disconnecting only touch
+    the rooms of the user involved. A user can be connected from several
+    tabs; they stay online in a room until their last socket in it is gone.
+    """
+
+    def __init__(self, online_users, user_sids):
+        self.online_users = online_users
+        self.user_sids = user_sids
+        self.sid_user = {}
+        self.user_rooms = {}
+        self._lock = threading.Lock()
+
+    def _unbind(self, sid):
+        """Remove a sid from every index, returning (user_id, rooms the user went offline in)"""
+        user_id = self.sid_user.pop(sid, None)
+        if user_id is None:
+            return None, []
+
+        sids = self.user_sids.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.user_sids[user_id]
+
+        left = []
+        rooms = self.user_rooms.get(user_id, {})
+        for room, room_sids in list(rooms.items()):
+            room_sids.discard(sid)
+            if not room_sids:
+                del rooms[room]
+                self.online_users.get(room, set()).discard(user_id)
+                left.append(room)
+        if not rooms:
+            self.user_rooms.pop(user_id, None)
+        return user_id, left
+
+    def join(self, sid, user_id, room):
+        """Register a socket in a room, returning True if the user was not online there yet"""
+        with self._lock:
+            if self.sid_user.get(sid, user_id) != user_id:
+                # The socket now identifies as somebody else
+                self._unbind(sid)
+            self.sid_user[sid] = user_id
+            self.user_sids.setdefault(user_id, set()).add(sid)
+
+            room_sids = self.user_rooms.setdefault(user_id, {}).setdefault(room, set())
+            first = not room_sids
+            room_sids.add(sid)
+            self.online_users.setdefault(room, set()).add(user_id)
+            return first
+
+    def leave(self, sid, user_id, room):
+        """Remove a socket from a room, returning True if the user has no sockets left there"""
+        with self._lock:
+            rooms = self.user_rooms.get(user_id, {})
+            room_sids = rooms.get(room)
+            if room_sids is None:
+                return False
+            room_sids.discard(sid)
+            if room_sids:
+                return False
+            del rooms[room]
+            if not rooms:
+                self.user_rooms.pop(user_id, None)
+            self.online_users.get(room, set()).discard(user_id)
+            return True
+
+    def disconnect(self, sid):
+        """Forget a socket, returning (user_id, rooms the user went offline in)"""
+        with self._lock:
+            return self._unbind(sid)
+
+    def user_for(self, sid):
+        return self.sid_user.get(sid)
+
+    def sids_for(self, user_id):
+        """Return the connected socket IDs of a user"""
+        return set(self.user_sids.get(user_id, ()))
+
+    def rooms_for(self, user_id):
+        return list(self.user_rooms.get(user_id, ()))
+
+
+# Shared presence of the sockets handled in sockets/events.py
+presence = Presence(config.online_users, config.user_socket_map)
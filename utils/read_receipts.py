@@ -0,0 +1,188 @@
+import bisect
+import threading
+import config
+from utils.storage import message_store
+
+# Read state is a per-(room, user) high-water mark: every message with
+# seq <= config.read_cursors[room][user] has been read by that user.
+# Messages read out of order (e.g. pages loaded newest first) are kept as
+# sorted, disjoint [first seq, last seq] ranges in config.read_exceptions:
+# every stored message inside a range has been read. Ranges with no stored
+# message between them are merged, and the cursor swallows the lowest range
+# once nothing unread is left below it. At most READ_RANGES_MAX ranges are
+# kept per user; past that the lowest one is folded into the cursor, which
+# counts the gap below it as read. Stored ciphertext never changes when
+# somebody reads a message.
+#
+# Receipts meant for other room members are not broadcast one call at a
+# time: mark_read(..., broadcast=True) queues them and flush_broadcasts()
+# turns everything queued for a room into one messages_read event.
+
+_pending = {}  # room_id -> {user_id: {seq: message_id}} read since the last flush
+_pending_lock = threading.Lock()
+broadcast_stats = {"calls": 0, "events": 0}
+
+
+
+def _in_ranges(ranges, seq):
+    i = bisect.bisect_right(ranges, [seq, float('inf')]) - 1
+    return i >= 0 and ranges[i][1] >= seq
+
+
+def _nothing_between(room_id, low, high):
+    """Check that no stored message has low < seq < high"""
+    return high <= low + 1 or not message_store.range(room_id, after_seq=low, before_seq=high, limit=1)
+
+
+def _runs(room_id, seqs):
+    """Group sorted seqs into [first, last] runs with no stored message between neighbours"""
+    runs = []
+    for seq in seqs:
+        if runs and _nothing_between(room_id, runs[-1][1], seq):
+            runs[-1][1] = seq
+        else:
+            runs.append([seq, seq])
+    return runs
+
+
+def _merge(room_id, cursor, ranges, runs):
+    """Merge new runs into a user's ranges and move the cursor, returning (cursor, ranges).
+
+    Only gaps next to a new run are looked up in the store; the gaps
+    between untouched ranges were checked when those were added.
+    """
+    # [first, last, touched], in seq order
+    merged = sorted([[first, last, False] for first, last in ranges] + [[first, last, True] for first, last in runs])
+    ranges = []
+    for first, last, new in merged:
+        if ranges and (new or ranges[-1][2]) and (
+                first <= ranges[-1][1] or _nothing_between(room_id, ranges[-1][1], first)):
+            ranges[-1][1] = max(ranges[-1][1], last)
+            ranges[-1][2] = True
+        else:
+            ranges.append([first, last, new])
+
+    # The cursor only moves when the lowest range changed
+    if ranges and ranges[0][2] and _nothing_between(room_id, cursor, ranges[0][0]):
+        cursor = ranges.pop(0)[1]
+    while len(ranges) > config.READ_RANGES_MAX:
+        cursor = ranges.pop(0)[1]
+    return cursor, [[first, last] for first, last, _ in ranges]
+
+
+def mark_read(room_id, user_id, messages, broadcast=False):
+    """Record that a user has read stored messages, returning the IDs that were newly read"""
+    cursor = config.read_cursors.get(room_id, {}).get(user_id, 0)
+    ranges = config.read_exceptions.get(room_id, {}).get(user_id, [])
+
+    new_seqs = {stored.seq for stored in messages if stored.seq > cursor and not _in_ranges(ranges, stored.seq)}
+    if not new_seqs:
+        return []
+    newly_read = []
+    for stored in messages:
+        if stored.seq in new_seqs:
+            new_seqs.discard(stored.seq)
+            newly_read.append(stored)
+
+    # A user reading the next message after the cursor (e.g. a sender marking
+    # their own message) needs no lookup at all
+    seqs = sorted(stored.seq for stored in newly_read)
+    if not ranges and seqs == list(range(cursor + 1, cursor + 1 + len(seqs))):
+        cursor = seqs[-1]
+    else:
+        cursor, ranges = _merge(room_id, cursor, ranges, _runs(room_id, seqs))
+    config.read_cursors.setdefault(room_id, {})[user_id] = cursor
+    if ranges:
+        config.read_exceptions.setdefault(room_id, {})[user_id] = ranges
+    else:
+        config.read_exceptions.get(room_id, {}).pop(user_id, None)
+
+    if broadcast:
+        with _pending_lock:
+            queued = _pending.setdefault(room_id, {}).setdefault(user_id, {})
+            for stored in newly_read:
+                queued[stored.seq] = stored.message_id
+            broadcast_stats["calls"] += 1
+    return [stored.message_id for stored in newly_read]
+
+
+def flush_broadcasts():
+    """Return [(room_id, receipts)] for everything queued since the last flush.
+
+    Each receipt is {"user_id", "up_to", "message_ids"}: up_to is the newest
+    newly read message that the user has read everything up to, and
+    message_ids lists the ones read past that point.
+    """
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+
+    batches = []
+    for room_id, users in pending.items():
+        receipts = []
+        for user_id, queued in users.items():
+            cursor = config.read_cursors.get(room_id, {}).get(user_id, 0)
+            covered = [seq for seq in queued if seq <= cursor]
+            receipts.append({
+                "user_id": user_id,
+                "up_to": queued[max(covered)] if covered else None,
+                "message_ids": [queued[seq] for seq in sorted(queued) if seq > cursor]
+            })
+        batches.append((room_id, receipts))
+
+    with _pending_lock:
+        broadcast_stats["events"] += len(batches)
+    return batches
+
+
+def stats():
+    """Return how many per-call messages_read events the batching saved"""
+    with _pending_lock:
+        return {
+            "mark_read_calls": broadcast_stats["calls"],
+            "events_sent": broadcast_stats["events"],
+            "events_saved": broadcast_stats["calls"] - broadcast_stats["events"]
+        }
+
+
+def has_read(room_id, user_id, seq):
+    """Check whether a user has read the message with the given seq"""
+    if config.read_cursors.get(room_id, {}).get(user_id, 0) >= seq:
+        return True
+    return _in_ranges(config.read_exceptions.get(room_id, {}).get(user_id, []), seq)
+
+
+def read_by(room_id, seq):
+    """Return the users who have read a message, in O(users in the room)"""
+    return [user_id for user_id in config.read_cursors.get(room_id, {}) if has_read(room_id, user_id, seq)]
+
+
+def unread_count(room_id, user_id):
+    """Return how many stored messages a user has not read yet"""
+    cursor = config.read_cursors.get(room_id, {}).get(user_id, 0)
+    read = sum(message_store.count(room_id, after_seq=first - 1) - message_store.count(room_id, after_seq=last)
+               for first, last in config.read_exceptions.get(room_id, {}).get(user_id, ()))
+    return max(message_store.count(room_id, after_seq=cursor) - read, 0)
+
+
+def unread_counts(room_id):
+    """Return the unread count of every user with read state in a room"""
+    return {user_id: unread_count(room_id, user_id) for user_id in config.read_cursors.get(room_id, {})}
+
+
+def forget_message(room_id, seq):
+    """Drop a deleted message from the receipts waiting to be broadcast.
+
+    Read ranges only count stored messages, so they need no change.
+    """
+    with _pending_lock:
+        for queued in _pending.get(room_id, {}).values():
+            queued.pop(seq, None)
+
+
+def forget_room(room_id):
+    """Drop all read state of a room"""
+    config.read_cursors.pop(room_id, None)
+    config.read_exceptions.pop(room_id, None)
+    with _pending_lock:
+        _pending.pop(room_id, None)
@@ -0,0 +1,136 @@
+import bisect
+import threading
+from itertools import islice
+import config
+
+POSITION_CURSOR_PREFIX = 'pos:'
+
+
+class RoomFiles:
+    """The files of one room, in upload order, indexed by stored filename, id and blob.
+
+    Entries are kept in an append-only list so pages can be served in
+    upload order; removed entries leave a hole that is compacted away once
+    holes make up half of the list. Every entry also gets an upload number
+    that never changes, which page cursors use, so a cursor stays valid
+    after its file is removed.
+    """
+
+    def __init__(self):
+        self._entries = []  # file_info dicts, None for removed entries
+        self._numbers = []  # upload number of each entry in _entries, increasing
+        self._next_number = 1
+        self._positions = {}  # stored_filename -> index in _entries
+        self._by_id = {}  # file id -> stored_filename
+        self._by_blob = {}  # blob_id -> stored filenames of the entries holding it
+        self._removed = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __iter__(self):
+        return iter([entry for entry in self._entries if entry is not None])
+
+    def __contains__(self, stored_filename):
+        return stored_filename in self._positions
+
+    def has_id(self, file_id):
+        return file_id in self._by_id
+
+    def add(self, file_info):
+        with self._lock:
+            self._positions[file_info['stored_filename']] = len(self._entries)
+            self._entries.append(file_info)
+            self._numbers.append(self._next_number)
+            self._next_number += 1
+            self._by_id[file_info['id']] = file_info['stored_filename']
+            blob_id = file_info.get('blob_id')
+            if blob_id:
+                self._by_blob.setdefault(blob_id, set()).add(file_info['stored_filename'])
+
+    def get(self, stored_filename):
+        with self._lock:
+            position = self._positions.get(stored_filename)
+            return None if position is None else self._entries[position]
+
+    def get_by_id(self, file_id):
+        stored_filename = self._by_id.get(file_id)
+        return None if stored_filename is None else self.get(stored_filename)
+
+    def find_blob(self, blob_id):
+        """Return an entry holding blob_id, or None"""
+        stored_filenames = self._by_blob.get(blob_id)
+        return self.get(next(iter(stored_filenames))) if stored_filenames else None
+
+    def remove(self, stored_filename):
+        """Remove an entry and return it, or None if there is no such file"""
+        with self._lock:
+            position = self._positions.pop(stored_filename, None)
+            if position is None:
+                return None
+            file_info = self._entries[position]
+            self._entries[position] = None
+            self._by_id.pop(file_info['id'], None)
+            holders = self._by_blob.get(file_info.get('blob_id'))
+            if holders is not None:
+                holders.discard(stored_filename)
+                if not holders:
+                    del self._by_blob[file_info['blob_id']]
+            self._removed += 1
+            if self._removed * 2 > len(self._entries):
+                self._compact()
+            return file_info
+
+    def _compact(self):
+        live = [i for i, entry in enumerate(self._entries) if entry is not None]
+        self._entries = [self._entries[i] for i in live]
+        self._numbers = [self._numbers[i] for i in live]
+        self._positions = {entry['stored_filename']: i for i, entry in enumerate(self._entries)}
+        self._removed = 0
+
+    def _start(self, after):
+        """List index a page after the given cursor starts at, or None if the cursor is unknown"""
+        if after.startswith(POSITION_CURSOR_PREFIX):
+            try:
+                number = int(after[len(POSITION_CURSOR_PREFIX):])
+            except ValueError:
+                return None
+            return bisect.bisect_right(self._numbers, number)
+        stored_filename = after if after in self._positions else self._by_id.get(after)
+        if stored_filename is None:
+            return None
+        return self._positions[stored_filename] + 1
+
+    def valid_cursor(self, after):
+        with self._lock:
+            return self._start(after) is not None
+
+    def page(self, after=None, limit=None):
+        """Return (files, next_cursor) in upload order, starting after next_cursor, a stored filename or a file id"""
+        with self._lock:
+            start = 0
+            if after is not None:
+                start = self._start(after)
+                if start is None:
+                    return [], None
+
+            files = []
+            position = start
+            while position < len(self._entries) and (limit is None or len(files) < limit):
+                entry = self._entries[position]
+                if entry is not None:
+                    files.append(entry)
+                position += 1
+
+            has_more = any(entry is not None for entry in islice(self._entries, position, None))
+            next_cursor = f"{POSITION_CURSOR_PREFIX}{self._numbers[position - 1]}" if files and has_more else None
+            return files, next_cursor
+
+
+def room_files_for(room_id):
+    """Return the file index of a room, creating an empty one if needed"""
+    files = config.room_files.get(room_id)
+    if files is None:
+        files = config.room_files.setdefault(room_id, RoomFiles())
+    return files
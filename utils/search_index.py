@@ -0,0 +1,214 @@
+import re
+import math
+import heapq
+import threading
+import config
+from utils.helpers import decrypt_messages, tokenize_words, blind_index_tokens
+from utils.storage import message_store
+
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+# BM25 ranking parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def is_blind():
+    return config.SEARCH_INDEX_MODE == 'blind'
+
+
+def index_terms(text):
+    """Return the terms a message is indexed under, in word order.
+
+    In blind mode these are keyed HMAC tokens, which are also stored next
+    to the ciphertext; otherwise they are the normalized words themselves.
+    """
+    return blind_index_tokens(text) if is_blind() else tokenize_words(text)
+
+
+def parse_query(query):
+    """Split a query into phrases of index terms; quoted text is one phrase, every other word its own"""
+    phrases = []
+    for quoted, word in QUERY_RE.findall(query):
+        terms = index_terms(quoted if quoted else word)
+        if terms:
+            phrases.append(terms)
+    return phrases
+
+
+class RoomSearchIndex:
+    """Positional inverted index over the messages of one room"""
+
+    def __init__(self):
+        self.postings = {}  # term -> {seq: [positions]}
+        self.doc_terms = {}  # seq -> distinct terms, used to unindex a message
+        self.doc_lengths = {}  # seq -> token count
+        self.total_length = 0
+
+    def add(self, seq, tokens):
+        if seq in self.doc_lengths or not tokens:
+            return
+        for position, term in enumerate(tokens):
+            self.postings.setdefault(term, {}).setdefault(seq, []).append(position)
+        self.doc_terms[seq] = list(set(tokens))
+        self.doc_lengths[seq] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, seq):
+        terms = self.doc_terms.pop(seq, None)
+        if terms is None:
+            return
+        for term in terms:
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.pop(seq, None)
+                if not docs:
+                    del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(seq)
+
+    def _matches_phrase(self, seq, phrase):
+        starts = self.postings[phrase[0]][seq]
+        for offset, term in enumerate(phrase[1:], 1):
+            positions = set(self.postings[term][seq])
+            starts = [start for start in starts if start + offset in positions]
+            if not starts:
+                return False
+        return True
+
+    def search(self, phrases, top_n):
+        """Return (total matches, [(score, seq)] for the best top_n) for a parsed query"""
+        terms = {term for phrase in phrases for term in phrase}
+        if not terms or any(term not in self.postings for term in terms):
+            return 0, []
+
+        # Intersect posting lists, starting from the rarest term
+        ordered = sorted(terms, key=lambda term: len(self.postings[term]))
+        candidates = set(self.postings[ordered[0]])
+        for term in ordered[1:]:
+            candidates.intersection_update(self.postings[term])
+            if not candidates:
+                return 0, []
+
+        multi_word = [phrase for phrase in phrases if len(phrase) > 1]
+        if multi_word:
+            candidates = [seq for seq in candidates
+                          if all(self._matches_phrase(seq, phrase) for phrase in multi_word)]
+
+        doc_count = len(self.doc_lengths)
+        average_length = self.total_length / doc_count
+        idf = {}
+        for term in terms:
+            matching = len(self.postings[term])
+            idf[term] = math.log(1 + (doc_count - matching + 0.5) / (matching + 0.5))
+
+        def score(seq):
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[seq] / average_length)
+            total = 0.0
+            for term in terms:
+                frequency = len(self.postings[term][seq])
+                total += idf[term] * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+            return total
+
+        # Ties go to the newest message
+        ranked = heapq.nlargest(top_n, ((score(seq), seq) for seq in candidates))
+        return len(candidates), ranked
+
+
+def _build(room_id):
+    """Index a room's stored history"""
+    # Blind tokens are read back from the store; plaintext terms have to be
+    # recovered by decrypting the history
+    room = RoomSearchIndex()
+    if is_blind():
+        for seq, tokens in message_store.iter_search_tokens(room_id):
+            room.add(seq, tokens)
+        return room
+    after_seq = None
+    while True:
+        batch = message_store.range(room_id, after_seq=after_seq, limit=config.DECRYPT_BATCH_SIZE)
+        if not batch:
+            return room
+        messages = decrypt_messages([stored.record for stored in batch], use_cache=False)
+        for stored, message in zip(batch, messages):
+            if isinstance(message, dict):
+                room.add(stored.seq, index_terms(message.get('message')))
+        after_seq = batch[-1].seq
+
+
+class SearchIndex:
+    """Per-room inverted indexes, maintained as messages are sent and deleted.
+
+    A room is indexed from the store on its first search (e.g. after a
+    restart). The build runs outside the shared lock, so sends to every
+    room carry on meanwhile; changes to the room being built are queued
+    and applied to the new index before it is swapped in.
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._building = {}  # room_id -> [(method, args)] queued while the room is being built
+        self._build_locks = {}  # room_id -> lock held by the one search building the room
+        self._lock = threading.RLock()
+
+    def _room(self, room_id):
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None:
+                return room
+            build_lock = self._build_locks.setdefault(room_id, threading.Lock())
+        with build_lock:
+            with self._lock:
+                room = self._rooms.get(room_id)
+                if room is not None:
+                    return room
+                self._building[room_id] = []
+            try:
+                room = _build(room_id)
+            except Exception:
+                with self._lock:
+                    self._building.pop(room_id, None)
+                    self._build_locks.pop(room_id, None)
+                raise
+            with self._lock:
+                queued = self._building.pop(room_id, None)
+                self._build_locks.pop(room_id, None)
+                for method, args in queued or ():
+                    getattr(room, method)(*args)
+                # A room dropped during the build only serves this search
+                if queued is not None:
+                    self._rooms[room_id] = room
+            return room
+
+    def _apply(self, room_id, method, *args):
+        with self._lock:
+            if room_id in self._rooms:
+                getattr(self._rooms[room_id], method)(*args)
+            elif room_id in self._building:
+                self._building[room_id].append((method, args))
+            # Rooms not indexed yet read the change from the store when built
+
+    def add(self, room_id, seq, terms):
+        """Index a message that was just stored, using terms from index_terms()"""
+        self._apply(room_id, 'add', seq, terms)
+
+    def remove(self, room_id, seq):
+        self._apply(room_id, 'remove', seq)
+
+    def drop_room(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._building.pop(room_id, None)
+
+    def search(self, room_id, query, offset=0, limit=20):
+        """Return (total matches, [(seq, score)]) for one page of ranked results"""
+        phrases = parse_query(query)
+        if not phrases:
+            return 0, []
+        room = self._room(room_id)
+        with self._lock:
+            total, ranked = room.search(phrases, offset + limit)
+        return total, [(seq, score) for score, seq in ranked[offset:offset + limit]]
+
+
+# Shared index used by the routes and socket handlers
+search_index = SearchIndex()
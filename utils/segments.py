@@ -0,0 +1,182 @@
+import json
+import zlib
+import threading
+import config
+from utils.storage import message_store, SegmentRef
+from utils.ciphers import encryption_keys, decryption_keys, encrypt_record, is_encrypted
+from utils.crypto_pool import run_batched, decrypt_records
+
+_lock = threading.RLock()  # Serializes sealing and segment rewrites
+_unsealed = {}  # room_id -> encrypted messages stored after the room's last segment, counted lazily
+_count_lock = threading.Lock()  # Guards _unsealed; held only for counter updates on the send path
+
+
+def is_sealed(record):
+    """Check whether a stored record points into a sealed segment"""
+    return isinstance(record, SegmentRef)
+
+
+def _pack(entries):
+    # {seq: serialized message} -> compressed JSON; chat text compresses
+    # well once hundreds of messages share one stream
+    payload = json.dumps({str(seq): plaintext.decode() for seq, plaintext in entries.items()}, ensure_ascii=False)
+    return zlib.compress(payload.encode(), config.SEGMENT_COMPRESSION_LEVEL)
+
+
+def _unpack(data):
+    return {int(seq): text.encode() for seq, text in json.loads(zlib.decompress(data)).items()}
+
+
+def _segment_keys(room_id):
+    # Segments are compressed as a whole already
+    return encryption_keys(room_id)._replace(codec=None)
+
+
+def _sealed_through(room_id):
+    segments = message_store.segments(room_id)
+    return segments[-1][1] if segments else 0
+
+
+def read_sealed(refs):
+    """Return {ref: serialized message bytes (or None if unreadable)}, decrypting each segment once"""
+    wanted = {}
+    for ref in refs:
+        wanted.setdefault(ref.room_id, set()).add(ref.segment_id)
+    segment_keys, records = [], []
+    for room_id, segment_ids in wanted.items():
+        for segment_id, record in message_store.get_segments(room_id, segment_ids).items():
+            segment_keys.append((room_id, segment_id))
+            records.append(record)
+
+    entries = {}
+    for segment_key, data in zip(segment_keys, run_batched(decrypt_records, records, decryption_keys(records))):
+        if data is None:
+            print(f"Error decrypting segment {segment_key[1]} of room {segment_key[0]}")
+            continue
+        entries[segment_key] = _unpack(data)
+    return {ref: entries.get((ref.room_id, ref.segment_id), {}).get(ref.seq) for ref in refs}
+
+
+def _seal_next(room_id, size):
+    """Seal the oldest `size` unsealed encrypted messages of a room, returning how many were waiting"""
+    candidates = []
+    after_seq = _sealed_through(room_id)
+    while len(candidates) < size:
+        batch = message_store.range(room_id, after_seq=after_seq, limit=size)
+        if not batch:
+            break
+        # Messages stored unencrypted (socket messages) stay as they are
+        candidates.extend(stored for stored in batch if is_encrypted(stored.record))
+        after_seq = batch[-1].seq
+    if len(candidates) < size:
+        return len(candidates)
+    candidates = candidates[:size]
+
+    plaintexts = run_batched(decrypt_records, [stored.record for stored in candidates],
+                             decryption_keys([stored.record for stored in candidates]))
+    # Unreadable tokens are left in place rather than lost inside a segment
+    readable = [(stored, plaintext) for stored, plaintext in zip(candidates, plaintexts) if plaintext is not None]
+    segment_id, last_seq = candidates[0].seq, candidates[-1].seq
+    message_store.put_segment(room_id, segment_id, last_seq,
+                              encrypt_record(_pack({stored.seq: plaintext for stored, plaintext in readable}),
+                                             _segment_keys(room_id)))
+    # The old tokens simply age out of the decrypted-message cache
+    changed = {stored.seq for stored, _ in readable
+               if not message_store.swap_record(room_id, stored.seq, stored.record,
+                                                SegmentRef(room_id, segment_id, stored.seq))}
+    if changed:
+        # Deleted or rewritten while being sealed: drop their copies again
+        _rewrite(room_id, segment_id, last_seq, lambda seq: seq not in changed)
+    return size
+
+
+def note_append(room_id, record):
+    """Count a newly stored record, returning True once MESSAGE_SEGMENT_SIZE messages wait to be sealed.
+
+    Sealing itself is left to seal_pending(), run off the send path.
+    """
+    size = config.MESSAGE_SEGMENT_SIZE
+    if size <= 0 or not is_encrypted(record):
+        return False
+    with _count_lock:
+        if room_id in _unsealed:
+            _unsealed[room_id] += 1
+        else:
+            _unsealed[room_id] = message_store.count(room_id, after_seq=_sealed_through(room_id))
+        return _unsealed[room_id] >= size
+
+
+def seal_pending(room_id):
+    """Seal every full segment's worth of a room's unsealed messages, returning how many segments were made"""
+    size = config.MESSAGE_SEGMENT_SIZE
+    sealed = 0
+    with _lock:
+        while size > 0:
+            waiting = _seal_next(room_id, size)
+            if waiting < size:
+                # Fewer than counted (deletions, unencrypted messages)
+                with _count_lock:
+                    _unsealed[room_id] = waiting
+                break
+            sealed += 1
+    return sealed
+
+
+def _rewrite(room_id, segment_id, last_seq, keep):
+    """Re-encrypt a segment with the current keys, keeping the seqs keep() accepts.
+
+    Returns False if the segment could not be decrypted and was left as it is.
+    """
+    record = message_store.get_segments(room_id, [segment_id]).get(segment_id)
+    if record is None:
+        return True
+    data = decrypt_records([record], decryption_keys([record]))[0]
+    if data is None:
+        print(f"Error decrypting segment {segment_id} of room {room_id}")
+        return False
+    entries = {seq: plaintext for seq, plaintext in _unpack(data).items() if keep(seq)}
+    if not entries:
+        message_store.delete_segment(room_id, segment_id)
+        return True
+    message_store.put_segment(room_id, segment_id, last_seq, encrypt_record(_pack(entries), _segment_keys(room_id)))
+    return True
+
+
+def discard(room_id, seqs):
+    """Rewrite the segments holding deleted messages, so no ciphertext of them is kept"""
+    seqs = set(seqs)
+    with _lock:
+        for segment_id, last_seq in message_store.segments(room_id):
+            if any(segment_id <= seq <= last_seq for seq in seqs):
+                _rewrite(room_id, segment_id, last_seq, lambda seq: seq not in seqs)
+
+
+def discard_through(room_id, through_seq):
+    """Finish a delete_through(): rewrite the segment it only partly covered and reset the room's count"""
+    with _lock:
+        with _count_lock:
+            _unsealed.pop(room_id, None)
+        for segment_id, last_seq in message_store.segments(room_id):
+            if segment_id <= through_seq < last_seq:
+                _rewrite(room_id, segment_id, last_seq, lambda seq: seq > through_seq)
+
+
+def reseal(room_id, fernet_only=False):
+    """Re-encrypt a room's segments with the current suite and keys, returning (rewritten, unreadable) counts"""
+    rewritten = unreadable = 0
+    with _lock:
+        segment_ids = dict(message_store.segments(room_id))
+        records = message_store.get_segments(room_id, segment_ids)
+        for segment_id, record in records.items():
+            if fernet_only and not isinstance(record, str):
+                continue
+            if _rewrite(room_id, segment_id, segment_ids[segment_id], lambda seq: True):
+                rewritten += 1
+            else:
+                unreadable += 1
+    return rewritten, unreadable
+
+
+def forget_room(room_id):
+    with _count_lock:
+        _unsealed.pop(room_id, None)
@@ -0,0 +1,658 @@
+import os
+import json
+import bisect
+import sqlite3
+import threading
+from collections import namedtuple
+import config
+
+# A stored message as returned by the backends. `seq` increases monotonically
+# within a room and is the key used for ordering and range reads.
+StoredMessage = namedtuple('StoredMessage', ['seq', 'message_id', 'timestamp', 'record'])
+# Record of a message sealed into an encrypted segment (see utils/segments.py).
+# A segment is keyed by the seq of its first message and covers seqs up to
+# its last_seq.
+SegmentRef = namedtuple('SegmentRef', ['room_id', 'segment_id', 'seq'])
+
+
+class MessageStore:
+    """Interface shared by all message storage backends"""
+
+    def create_room(self, room_id):
+        """Make sure a room exists, even if it has no messages yet"""
+        raise NotImplementedError
+
+    def has_room(self, room_id):
+        """Check whether a room exists"""
+        raise NotImplementedError
+
+    def rooms(self):
+        """Return the IDs of all known rooms"""
+        raise NotImplementedError
+
+    def append(self, room_id, message_id, timestamp, record, search_tokens=None):
+        """Append a record to a room and return its sequence number.
+
+        `search_tokens` are opaque blind-index tokens kept next to the record
+        so the search index can be rebuilt without decrypting anything.
+        """
+        raise NotImplementedError
+
+    def iter_search_tokens(self, room_id):
+        """Yield (seq, search_tokens) for every message stored with tokens"""
+        raise NotImplementedError
+
+    def get(self, room_id, message_id):
+        """Return the StoredMessage with the given ID, or None"""
+        raise NotImplementedError
+
+    def replace(self, room_id, message_id, record):
+        """Replace the record of an existing message, returning True on success"""
+        raise NotImplementedError
+
+    def swap_record(self, room_id, seq, expected, record):
+        """Replace the record stored at seq if it still equals expected, returning True on success.
+
+        Addressed by seq, so it also reaches messages sharing an ID with an
+        earlier one; background rewrites use it to skip records changed since
+        they were read.
+        """
+        raise NotImplementedError
+
+    def delete(self, room_id, message_id):
+        """Delete a message and return the removed StoredMessage, or None"""
+        raise NotImplementedError
+
+    def clear(self, room_id):
+        """Remove every message in a room but keep the room itself"""
+        raise NotImplementedError
+
+    def delete_through(self, room_id, seq):
+        """Delete every message with a seq up to and including seq, returning how many were removed"""
+        raise NotImplementedError
+
+    def drop_room(self, room_id):
+        """Remove a room together with all of its messages"""
+        raise NotImplementedError
+
+    def put_segment(self, room_id, segment_id, last_seq, record):
+        """Store (or overwrite) the encrypted record of a sealed segment"""
+        raise NotImplementedError
+
+    def get_segments(self, room_id, segment_ids):
+        """Return {segment_id: record} for the given segments that are stored"""
+        raise NotImplementedError
+
+    def delete_segment(self, room_id, segment_id):
+        """Remove a sealed segment"""
+        raise NotImplementedError
+
+    def segments(self, room_id):
+        """Return (segment_id, last_seq) of a room's segments in seq order.
+
+        clear(), drop_room() and delete_through() also remove the segments
+        they cover completely.
+        """
+        raise NotImplementedError
+
+    def count(self, room_id, after_seq=None):
+        """Return the number of messages in a room, optionally only those after a seq"""
+        raise NotImplementedError
+
+    def range(self, room_id, after_seq=None, before_seq=None, since=None, until=None,
+              limit=None, newest_first=False):
+        """Return messages with after_seq < seq < before_seq and since <= timestamp <= until.
+
+        Results are ordered by seq, newest first if requested, so `limit`
+        picks either the oldest or the newest matching messages.
+        """
+        raise NotImplementedError
+
+    def get_by_seq(self, room_id, seq):
+        """Return the StoredMessage with the given sequence number, or None"""
+        found = self.range(room_id, after_seq=seq - 1, before_seq=seq + 1, limit=1)
+        return found[0] if found else None
+
+    def get_many(self, room_id, message_ids):
+        """Look up several message IDs, skipping the ones that are not stored"""
+        found = (self.get(room_id, message_id) for message_id in message_ids)
+        return [stored for stored in found if stored is not None]
+
+    def iter_messages(self, room_id, batch_size=500):
+        """Iterate over a room's messages in order, reading them in batches"""
+        after_seq = None
+        while True:
+            batch = self.range(room_id, after_seq=after_seq, limit=batch_size)
+            if not batch:
+                return
+            for stored in batch:
+                yield stored
+            after_seq = batch[-1].seq
+
+
+class _RoomMeta:
+    """Per-room bookkeeping kept alongside the record list of a MemoryMessageStore"""
+
+    __slots__ = ('seqs', 'ids', 'timestamps', 'ordered', 'index', 'duplicates', 'removed', 'search_tokens',
+                 'segments', 'next_seq')
+
+    def __init__(self):
+        self.seqs = []
+        self.ids = []
+        self.timestamps = []
+        self.ordered = True  # Whether timestamps never decrease in seq order
+        self.index = {}  # message_id -> seq of the oldest message stored under that ID
+        self.duplicates = {}  # message_id -> seqs of the newer messages sharing that ID, in order
+        self.removed = []  # sorted seqs of deleted messages whose slots have not been compacted yet
+        self.search_tokens = {}  # seq -> blind-index tokens
+        self.segments = {}  # segment_id -> (last_seq, record)
+        self.next_seq = 1
+
+    def add_id(self, message_id, seq):
+        if message_id in self.index:
+            self.duplicates.setdefault(message_id, []).append(seq)
+        else:
+            self.index[message_id] = seq
+
+    def drop_id(self, message_id, seq):
+        """Forget the oldest seq of an ID, letting the next message sharing it take its place"""
+        if self.index.get(message_id) != seq:
+            return
+        newer = self.duplicates.get(message_id)
+        if newer:
+            self.index[message_id] = newer.pop(0)
+            if not newer:
+                del self.duplicates[message_id]
+        else:
+            del self.index[message_id]
+
+
+class MemoryMessageStore(MessageStore):
+    """Keeps every room in process memory, using a dict of record lists.
+
+    Deleting a message leaves a None hole in the record list instead of
+    shifting it; holes are compacted away once they make up a quarter of a
+    room, which keeps deletes cheap in rooms with millions of messages.
+    """
+
+    def __init__(self, rooms=None):
+        # The record lists live in `rooms` (config.chat_rooms by default);
+        # deleted messages show up there as None until the room is compacted.
+        self._rooms = rooms if rooms is not None else {}
+        self._meta = {}
+        self._lock = threading.RLock()
+
+    def _room_meta(self, room_id):
+        meta = self._meta.get(room_id)
+        if meta is None:
+            meta = self._meta[room_id] = _RoomMeta()
+            self._rooms.setdefault(room_id, [])
+        return meta
+
+    def _position(self, room_id, message_id):
+        meta = self._meta.get(room_id)
+        if meta is None:
+            return -1
+        seq = meta.index.get(message_id)
+        if seq is None:
+            return -1
+        # seqs stay sorted across deletes, so the hash lookup gives the
+        # seq and a bisection turns it into the current list position.
+        return bisect.bisect_left(meta.seqs, seq)
+
+    def _compact(self, room_id, meta):
+        records = self._rooms[room_id]
+        live = [i for i, record in enumerate(records) if record is not None]
+        meta.seqs = [meta.seqs[i] for i in live]
+        meta.ids = [meta.ids[i] for i in live]
+        meta.timestamps = [meta.timestamps[i] for i in live]
+        self._rooms[room_id] = [records[i] for i in live]
+        meta.removed = []
+
+    def create_room(self, room_id):
+        with self._lock:
+            self._room_meta(room_id)
+
+    def has_room(self, room_id):
+        return room_id in self._meta
+
+    def rooms(self):
+        return list(self._meta.keys())
+
+    def append(self, room_id, message_id, timestamp, record, search_tokens=None):
+        with self._lock:
+            meta = self._room_meta(room_id)
+            seq = meta.next_seq
+            meta.next_seq += 1
+            meta.seqs.append(seq)
+            meta.ids.append(message_id)
+            # A clock step back or writers racing across workers can store
+            # an older timestamp after a newer one
+            if meta.timestamps and timestamp < meta.timestamps[-1]:
+                meta.ordered = False
+            meta.timestamps.append(timestamp)
+            meta.add_id(message_id, seq)
+            if search_tokens:
+                meta.search_tokens[seq] = list(search_tokens)
+            self._rooms[room_id].append(record)
+            return seq
+
+    def iter_search_tokens(self, room_id):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            items = list(meta.search_tokens.items()) if meta else []
+        return iter(items)
+
+    def get(self, room_id, message_id):
+        with self._lock:
+            pos = self._position(room_id, message_id)
+            if pos == -1:
+                return None
+            meta = self._meta[room_id]
+            return StoredMessage(meta.seqs[pos], meta.ids[pos], meta.timestamps[pos], self._rooms[room_id][pos])
+
+    def replace(self, room_id, message_id, record):
+        with self._lock:
+            pos = self._position(room_id, message_id)
+            if pos == -1:
+                return False
+            self._rooms[room_id][pos] = record
+            return True
+
+    def swap_record(self, room_id, seq, expected, record):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return False
+            pos = bisect.bisect_left(meta.seqs, seq)
+            if pos == len(meta.seqs) or meta.seqs[pos] != seq or self._rooms[room_id][pos] != expected:
+                return False
+            self._rooms[room_id][pos] = record
+            return True
+
+    def delete(self, room_id, message_id):
+        with self._lock:
+            pos = self._position(room_id, message_id)
+            if pos == -1:
+                return None
+            meta = self._meta[room_id]
+            records = self._rooms[room_id]
+            removed = StoredMessage(meta.seqs[pos], meta.ids[pos], meta.timestamps[pos], records[pos])
+            records[pos] = None
+            meta.drop_id(message_id, removed.seq)
+            meta.search_tokens.pop(removed.seq, None)
+            bisect.insort(meta.removed, removed.seq)
+            if len(meta.removed) * 4 > len(meta.seqs):
+                self._compact(room_id, meta)
+            return removed
+
+    def clear(self, room_id):
+        with self._lock:
+            meta = self._room_meta(room_id)
+            # Sequence numbers keep counting so cursors never point at reused seqs
+            meta.seqs, meta.ids, meta.timestamps = [], [], []
+            meta.ordered = True
+            meta.index, meta.duplicates, meta.removed = {}, {}, []
+            meta.search_tokens = {}
+            meta.segments = {}
+            self._rooms[room_id] = []
+
+    def delete_through(self, room_id, seq):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return 0
+            end = bisect.bisect_right(meta.seqs, seq)
+            records = self._rooms[room_id]
+            for i in range(end):
+                if records[i] is not None:
+                    meta.drop_id(meta.ids[i], meta.seqs[i])
+                    meta.search_tokens.pop(meta.seqs[i], None)
+            holes = bisect.bisect_right(meta.removed, seq)
+            del meta.removed[:holes]
+            del meta.seqs[:end], meta.ids[:end], meta.timestamps[:end], records[:end]
+            for segment_id, (last_seq, _) in list(meta.segments.items()):
+                if last_seq <= seq:
+                    del meta.segments[segment_id]
+            return end - holes
+
+    def drop_room(self, room_id):
+        with self._lock:
+            self._meta.pop(room_id, None)
+            self._rooms.pop(room_id, None)
+
+    def put_segment(self, room_id, segment_id, last_seq, record):
+        with self._lock:
+            self._room_meta(room_id).segments[segment_id] = (last_seq, record)
+
+    def get_segments(self, room_id, segment_ids):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return {}
+            return {segment_id: meta.segments[segment_id][1]
+                    for segment_id in segment_ids if segment_id in meta.segments}
+
+    def delete_segment(self, room_id, segment_id):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is not None:
+                meta.segments.pop(segment_id, None)
+
+    def segments(self, room_id):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return []
+            return sorted((segment_id, last_seq) for segment_id, (last_seq, _) in meta.segments.items())
+
+    def count(self, room_id, after_seq=None):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return 0
+            if after_seq is None:
+                return len(meta.seqs) - len(meta.removed)
+            return (len(meta.seqs) - bisect.bisect_right(meta.seqs, after_seq)
+                    - (len(meta.removed) - bisect.bisect_right(meta.removed, after_seq)))
+
+    def range(self, room_id, after_seq=None, before_seq=None, since=None, until=None,
+              limit=None, newest_first=False):
+        with self._lock:
+            meta = self._meta.get(room_id)
+            if meta is None:
+                return []
+
+            # Seqs increase in append order (holes keep theirs), so seq
+            # bounds narrow a contiguous slice found by bisection. So do
+            # timestamp bounds while the room's timestamps never went
+            # backwards; otherwise they are checked message by message.
+            start, end = 0, len(meta.seqs)
+            if after_seq is not None:
+                start = max(start, bisect.bisect_right(meta.seqs, after_seq))
+            if before_seq is not None:
+                end = min(end, bisect.bisect_left(meta.seqs, before_seq))
+            if meta.ordered:
+                if since is not None:
+                    start = max(start, bisect.bisect_left(meta.timestamps, since))
+                if until is not None:
+                    end = min(end, bisect.bisect_right(meta.timestamps, until))
+                since = until = None
+            if start >= end or limit == 0:
+                return []
+
+            records = self._rooms[room_id]
+            positions = range(end - 1, start - 1, -1) if newest_first else range(start, end)
+            result = []
+            for i in positions:
+                if records[i] is None:
+                    continue
+                if (since is not None and meta.timestamps[i] < since) or \
+                        (until is not None and meta.timestamps[i] > until):
+                    continue
+                result.append(StoredMessage(meta.seqs[i], meta.ids[i], meta.timestamps[i], records[i]))
+                if limit is not None and len(result) >= limit:
+                    break
+            return result
+
+
+class SQLiteMessageStore(MessageStore):
+    """Persists rooms in a SQLite database running in WAL mode"""
+
+    # How a record is encoded in the `record` column
+    KIND_TEXT = 0
+    KIND_JSON = 1
+    KIND_BYTES = 2
+    KIND_SEGMENT = 3  # SegmentRef, as a JSON list
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                room_id TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                room_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                record BLOB NOT NULL,
+                search_tokens TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_room_message ON messages (room_id, message_id);
+            CREATE INDEX IF NOT EXISTS idx_messages_room_timestamp ON messages (room_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_messages_room_seq ON messages (room_id, seq);
+            CREATE TABLE IF NOT EXISTS segments (
+                room_id TEXT NOT NULL,
+                segment_id INTEGER NOT NULL,
+                last_seq INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                record BLOB NOT NULL,
+                PRIMARY KEY (room_id, segment_id)
+            );
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        if 'search_tokens' not in columns:
+            # Databases created before blind-index search existed
+            self._conn.execute("ALTER TABLE messages ADD COLUMN search_tokens TEXT")
+
+    def _encode(self, record):
+        if isinstance(record, bytes):
+            return self.KIND_BYTES, record
+        if isinstance(record, str):
+            return self.KIND_TEXT, record
+        if isinstance(record, SegmentRef):
+            return self.KIND_SEGMENT, json.dumps(list(record))
+        return self.KIND_JSON, json.dumps(record)
+
+    def _decode(self, kind, value):
+        if kind == self.KIND_JSON:
+            return json.loads(value)
+        if kind == self.KIND_SEGMENT:
+            return SegmentRef(*json.loads(value))
+        return value
+
+    def _row_to_message(self, row):
+        seq, message_id, timestamp, kind, value = row
+        return StoredMessage(seq, message_id, timestamp, self._decode(kind, value))
+
+    def create_room(self, room_id):
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO rooms (room_id) VALUES (?)", (room_id,))
+
+    def has_room(self, room_id):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+            return row is not None
+
+    def rooms(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT room_id FROM rooms")]
+
+    def append(self, room_id, message_id, timestamp, record, search_tokens=None):
+        kind, value = self._encode(record)
+        tokens = " ".join(search_tokens) if search_tokens else None
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR IGNORE INTO rooms (room_id) VALUES (?)", (room_id,))
+                cursor = self._conn.execute(
+                    "INSERT INTO messages (room_id, message_id, timestamp, kind, record, search_tokens) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (room_id, message_id, timestamp, kind, value, tokens)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return cursor.lastrowid
+
+    def iter_search_tokens(self, room_id):
+        after_seq = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT seq, search_tokens FROM messages WHERE room_id = ? AND seq > ? "
+                    "AND search_tokens IS NOT NULL ORDER BY seq LIMIT 1000",
+                    (room_id, after_seq)
+                ).fetchall()
+            if not rows:
+                return
+            for seq, tokens in rows:
+                yield seq, tokens.split(" ")
+            after_seq = rows[-1][0]
+
+    def get(self, room_id, message_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seq, message_id, timestamp, kind, record FROM messages "
+                "WHERE room_id = ? AND message_id = ? ORDER BY seq LIMIT 1",
+                (room_id, message_id)
+            ).fetchone()
+        return self._row_to_message(row) if row else None
+
+    def replace(self, room_id, message_id, record):
+        kind, value = self._encode(record)
+        with self._lock:
+            stored = self.get(room_id, message_id)
+            if stored is None:
+                return False
+            self._conn.execute("UPDATE messages SET kind = ?, record = ? WHERE seq = ?", (kind, value, stored.seq))
+            return True
+
+    def swap_record(self, room_id, seq, expected, record):
+        kind, value = self._encode(record)
+        expected_kind, expected_value = self._encode(expected)
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE messages SET kind = ?, record = ? WHERE room_id = ? AND seq = ? AND kind = ? AND record = ?",
+                (kind, value, room_id, seq, expected_kind, expected_value)
+            )
+            return cursor.rowcount > 0
+
+    def delete(self, room_id, message_id):
+        with self._lock:
+            stored = self.get(room_id, message_id)
+            if stored is None:
+                return None
+            self._conn.execute("DELETE FROM messages WHERE seq = ?", (stored.seq,))
+            return stored
+
+    def clear(self, room_id):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+            self._conn.execute("DELETE FROM segments WHERE room_id = ?", (room_id,))
+            self._conn.execute("COMMIT")
+
+    def delete_through(self, room_id, seq):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute("DELETE FROM messages WHERE room_id = ? AND seq <= ?", (room_id, seq))
+            self._conn.execute("DELETE FROM segments WHERE room_id = ? AND last_seq <= ?", (room_id, seq))
+            self._conn.execute("COMMIT")
+            return cursor.rowcount
+
+    def drop_room(self, room_id):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+            self._conn.execute("DELETE FROM segments WHERE room_id = ?", (room_id,))
+            self._conn.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+            self._conn.execute("COMMIT")
+
+    def put_segment(self, room_id, segment_id, last_seq, record):
+        kind, value = self._encode(record)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO segments (room_id, segment_id, last_seq, kind, record) VALUES (?, ?, ?, ?, ?)",
+                (room_id, segment_id, last_seq, kind, value)
+            )
+
+    def get_segments(self, room_id, segment_ids):
+        segment_ids = list(segment_ids)
+        if not segment_ids:
+            return {}
+        placeholders = ", ".join("?" * len(segment_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT segment_id, kind, record FROM segments WHERE room_id = ? AND segment_id IN ({placeholders})",
+                [room_id, *segment_ids]
+            ).fetchall()
+        return {segment_id: self._decode(kind, value) for segment_id, kind, value in rows}
+
+    def delete_segment(self, room_id, segment_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM segments WHERE room_id = ? AND segment_id = ?", (room_id, segment_id))
+
+    def segments(self, room_id):
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute(
+                "SELECT segment_id, last_seq FROM segments WHERE room_id = ? ORDER BY segment_id", (room_id,)
+            )]
+
+    def count(self, room_id, after_seq=None):
+        with self._lock:
+            if after_seq is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM messages WHERE room_id = ?", (room_id,)).fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM messages WHERE room_id = ? AND seq > ?",
+                                         (room_id, after_seq)).fetchone()
+            return row[0]
+
+    def range(self, room_id, after_seq=None, before_seq=None, since=None, until=None,
+              limit=None, newest_first=False):
+        clauses = ["room_id = ?"]
+        params = [room_id]
+        if after_seq is not None:
+            clauses.append("seq > ?")
+            params.append(after_seq)
+        if before_seq is not None:
+            clauses.append("seq < ?")
+            params.append(before_seq)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+
+        query = (
+            "SELECT seq, message_id, timestamp, kind, record FROM messages WHERE "
+            + " AND ".join(clauses)
+            + (" ORDER BY seq DESC" if newest_first else " ORDER BY seq")
+        )
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row_to_message(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_message_store(backend=None):
+    """Create the message store selected by config.MESSAGE_STORE_BACKEND"""
+    backend = (backend or config.MESSAGE_STORE_BACKEND).lower()
+    if backend == 'sqlite':
+        return SQLiteMessageStore(config.MESSAGE_DB_PATH)
+    if backend == 'memory':
+        return MemoryMessageStore(config.chat_rooms)
+    raise ValueError(f"Unknown message store backend: {backend}")
+
+
+# Shared store used by the routes and socket handlers
+message_store = create_message_store()
@@ -0,0 +1,97 @@
+import os
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+import config
+
+# Image types that get thumbnails and previews
+VARIANT_SOURCE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp'}
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = set()  # (store root, blob_id) being rendered
+
+
+def render_variants(src_path, sizes, out_dir, quality):
+    """Render downscaled copies of an image into out_dir; runs in a worker process.
+
+    Returns {variant name: (tmp_path, blob_id, content_type)}. Images that
+    are already smaller than a variant size are skipped for that variant.
+    """
+    results = {}
+    with Image.open(src_path) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        for name, max_edge in sizes.items():
+            if max(image.size) <= max_edge:
+                continue
+            variant = image.copy()
+            variant.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as out:
+                if has_alpha:
+                    variant.convert('RGBA').save(out, 'PNG', optimize=True)
+                    content_type = 'image/png'
+                else:
+                    variant.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+                    content_type = 'image/jpeg'
+            with open(tmp_path, 'rb') as f:
+                blob_id = hashlib.sha256(f.read()).hexdigest()
+            results[name] = (tmp_path, blob_id, content_type)
+    return results
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.THUMBNAIL_WORKERS)
+        return _pool
+
+
+def wants_variants(content_type):
+    return bool(config.IMAGE_VARIANTS) and content_type in VARIANT_SOURCE_TYPES
+
+
+def schedule_variants(store, blob_id, content_type):
+    """Render the configured variants of a stored image in the worker pool.
+
+    Returns the variant names that will be available, or {} if the blob is
+    not an image. The variants are recorded on the blob once rendered; until
+    then the variant URLs serve the original.
+    """
+    if not wants_variants(content_type):
+        return {}
+    names = list(config.IMAGE_VARIANTS)
+
+    key = (store.root, blob_id)
+    with _pool_lock:
+        if store.variants(blob_id) or key in _pending:
+            return names
+        _pending.add(key)
+
+    out_dir = os.path.join(store.root, '.uploads')
+    os.makedirs(out_dir, exist_ok=True)
+
+    def done(future):
+        try:
+            store.add_variants(blob_id, future.result(), names)
+        except Exception as e:
+            print(f"Error rendering image variants for {blob_id}: {str(e)}")
+        finally:
+            with _pool_lock:
+                _pending.discard(key)
+
+    try:
+        future = _executor().submit(render_variants, store.path(blob_id), dict(config.IMAGE_VARIANTS),
+                                    out_dir, config.VARIANT_JPEG_QUALITY)
+    except Exception as e:
+        print(f"Error scheduling image variants for {blob_id}: {str(e)}")
+        with _pool_lock:
+            _pending.discard(key)
+        return {}
+    future.add_done_callback(done)
+    return names
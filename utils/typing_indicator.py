@@ -0,0 +1,90 @@
+import threading
+import time
+import config
+
+
+class TypingTracker:
+    """Buffers typing state changes per room so they can be broadcast as periodic deltas.
+
+    config.typing_users (room -> set of user IDs) holds who is typing right
+    now. Every typing event refreshes the user's deadline; users whose
+    deadline passes stop typing without the client having to say so.
+    Changes are only recorded here and handed out by flush(), which the
+    socket layer calls at most TYPING_FLUSHES_PER_SECOND times a second.
+    """
+
+    def __init__(self, typing_users, timeout):
+        self.typing_users = typing_users
+        self.timeout = timeout
+        self._deadlines = {}  # room -> {user_id: monotonic deadline}
+        self._changed = {}  # room -> {user_id: was typing at the last flush}
+        self._lock = threading.Lock()
+        self.events_received = 0
+        self.deltas_sent = 0
+
+    def _set(self, room, user_id, is_typing):
+        typing = self.typing_users.setdefault(room, set())
+        was_typing = user_id in typing
+        if was_typing == is_typing:
+            return
+        # Remember the state as of the last flush; flipping back and forth
+        # within one interval cancels out
+        self._changed.setdefault(room, {}).setdefault(user_id, was_typing)
+        if is_typing:
+            typing.add(user_id)
+        else:
+            typing.discard(user_id)
+            self._deadlines.get(room, {}).pop(user_id, None)
+
+    def update(self, room, user_id, is_typing, now=None):
+        """Record a typing event from a client"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.events_received += 1
+            if is_typing:
+                self._deadlines.setdefault(room, {})[user_id] = now + self.timeout
+            self._set(room, user_id, is_typing)
+
+    def remove(self, room, user_id):
+        """Stop a user's typing indicator, e.g. when they leave the room"""
+        with self._lock:
+            self._set(room, user_id, False)
+
+    def drop_room(self, room):
+        with self._lock:
+            self.typing_users.pop(room, None)
+            self._deadlines.pop(room, None)
+            self._changed.pop(room, None)
+
+    def flush(self, now=None):
+        """Expire stale entries and return [(room, started, stopped)] for rooms that changed"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for room, deadlines in list(self._deadlines.items()):
+                for user_id in [user_id for user_id, deadline in deadlines.items() if deadline <= now]:
+                    self._set(room, user_id, False)
+                if not deadlines:
+                    del self._deadlines[room]
+
+            deltas = []
+            for room, changed in self._changed.items():
+                typing = self.typing_users.get(room, set())
+                started = [user_id for user_id, was in changed.items() if not was and user_id in typing]
+                stopped = [user_id for user_id, was in changed.items() if was and user_id not in typing]
+                if started or stopped:
+                    deltas.append((room, started, stopped))
+            self._changed.clear()
+            self.deltas_sent += len(deltas)
+            return deltas
+
+    def stats(self):
+        with self._lock:
+            return {
+                "events_received": self.events_received,
+                "deltas_sent": self.deltas_sent,
+                "typing": sum(len(users) for users in self.typing_users.values())
+            }
+
+
+# Shared tracker used by the socket handlers
+typing_tracker = TypingTracker(config.typing_users, config.TYPING_TIMEOUT_SECONDS)
@@ -0,0 +1,155 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+import config
+from utils.blob_store import blob_store, file_store
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UnknownUpload(UploadError):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+class Upload:
+    """An upload in progress, streamed into a temporary file"""
+
+    def __init__(self, upload_id, room, user_id, content_type, name, size, path):
+        self.upload_id = upload_id
+        self.room = room
+        self.user_id = user_id
+        self.content_type = content_type
+        self.name = name
+        self.size = size
+        self.path = path
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.touched = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ChunkedUploads:
+    """Resumable chunked uploads, used for socket media and HTTP file uploads.
+
+    Chunks are appended to a temporary file in tmp_dir (on the same disk as
+    the final location, so the finished file can be renamed into place) and
+    hashed as they arrive; the whole file is never held in memory. An
+    upload is identified by its upload_id, not by the connection, so a
+    client that reconnects can ask for the current offset and continue.
+    """
+
+    def __init__(self, tmp_dir, max_bytes, ttl):
+        self.tmp_dir = tmp_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _discard(self, upload):
+        self._uploads.pop(upload.upload_id, None)
+        try:
+            os.unlink(upload.path)
+        except OSError:
+            pass
+
+    def expire(self, now=None):
+        """Drop uploads that have not received a chunk for ttl seconds"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for upload in [u for u in self._uploads.values() if now - u.touched > self.ttl]:
+                self._discard(upload)
+
+    def begin(self, room, user_id, content_type, name, size, upload_id=None):
+        """Start an upload, or resume one by ID; returns the Upload"""
+        self.expire()
+        with self._lock:
+            if upload_id:
+                upload = self._uploads.get(upload_id)
+                if upload is None or upload.user_id != user_id or upload.room != room:
+                    raise UnknownUpload("Unknown upload")
+                upload.touched = time.monotonic()
+                return upload
+
+            if not isinstance(size, int) or size <= 0:
+                raise UploadError("Upload size is required")
+            if size > self.max_bytes:
+                raise UploadTooLarge(f"File exceeds {self.max_bytes // (1024 * 1024)}MB limit")
+
+            upload_id = uuid.uuid4().hex
+            path = os.path.join(self.tmp_dir, upload_id)
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            open(path, 'wb').close()
+            upload = Upload(upload_id, room, user_id, content_type or 'application/octet-stream',
+                                 name, size, path)
+            self._uploads[upload_id] = upload
+            return upload
+
+    def get(self, upload_id, user_id, room=None):
+        """Look an upload up by ID, checking its owner and room where given"""
+        upload = self._uploads.get(upload_id)
+        if (upload is None or (user_id is not None and upload.user_id != user_id)
+                or (room is not None and upload.room != room)):
+            raise UnknownUpload("Unknown upload")
+        return upload
+
+    def write(self, upload_id, user_id, offset, data):
+        """Append a chunk at offset and return the new offset.
+
+        A chunk for an offset that was already written (e.g. resent after a
+        lost ack) is ignored, so the returned offset always tells the client
+        where to continue.
+        """
+        upload = self.get(upload_id, user_id)
+        if not isinstance(data, (bytes, bytearray)):
+            raise UploadError("Chunks must be sent as binary data")
+        with upload.lock:
+            if offset != upload.received:
+                return upload.received
+            if upload.received + len(data) > upload.size:
+                raise UploadTooLarge("Chunk exceeds the declared upload size")
+            with open(upload.path, 'ab') as f:
+                f.write(data)
+            upload.sha256.update(data)
+            upload.received += len(data)
+            upload.touched = time.monotonic()
+            return upload.received
+
+    def finish(self, upload_id, user_id, commit):
+        """Hand a complete upload to commit(upload), which must move upload.path away.
+
+        The upload is forgotten once commit returns. Returns (upload, what commit returned).
+        """
+        upload = self.get(upload_id, user_id)
+        with upload.lock:
+            if self._uploads.get(upload_id) is not upload:
+                raise UnknownUpload("Unknown upload")
+            if upload.received != upload.size:
+                raise UploadError(f"Upload incomplete: {upload.received} of {upload.size} bytes received")
+            result = commit(upload)
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        return upload, result
+
+    def abort(self, upload_id, user_id):
+        upload = self.get(upload_id, user_id)
+        with self._lock:
+            self._discard(upload)
+
+
+MAX_UPLOAD_BYTES = config.MAX_FILE_SIZE_MB * 1024 * 1024
+MAX_MEDIA_BYTES = config.MAX_MEDIA_SIZE_MB * 1024 * 1024
+
+# Socket media, committed into the blob store
+media_uploads = ChunkedUploads(os.path.join(blob_store.root, '.uploads'), MAX_MEDIA_BYTES,
+                               config.UPLOAD_TTL_SECONDS)
+# Room files uploaded over HTTP, committed into the file store
+file_uploads = ChunkedUploads(os.path.join(file_store.root, '.uploads'), MAX_UPLOAD_BYTES,
+                              config.UPLOAD_TTL_SECONDS)